@@ -1,46 +1,225 @@
 """This implements the core logic of the Telegram bot, all the message and command handlers are here"""
 
+import functools
 import logging
 import os
+import sys
 from random import choice
-from tempfile import NamedTemporaryFile
 from collections import OrderedDict
+from threading import enumerate as enumerate_threads
 
 from telegram.ext import (
     Filters,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    DispatcherHandlerStop,
 )
-from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup, ParseMode
-from telegram.ext.dispatcher import run_async
+from telegram import (
+    Update,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+    InlineKeyboardMarkup,
+    ParseMode,
+)
+from telegram.error import TelegramError
 
 
+import autoscale
 import constants as c
+import flusher
+import jobs
 import keyboards as k
+import memory
+import models
 import restapi
+import timers
+import tracing
+from announcements import AnnouncementLog
+from broadcasts import BroadcastQueue
+from callbacks import CallbackRouter
+from concurrency import ChatQueues, LockStripes
+from delivery import Delivery
+from digests import DigestBuffer, DEFAULT_WINDOW
+from directory import VolunteerDirectory
+from mediagroups import MediaGroupCollector
+from sender import Sender
+from spool import ReceiptSpool
+from statemachine import REVIEWING, StateMachine
 from timetools import utc_short_to_user_short
 
 log = logging.getLogger("ajubot")  # pylint: disable=invalid-name
 
+# The buttons shown while a request is handled -> the corresponding events of the state machine
+HANDLE_EVENTS = {
+    "handle_onmyway": "set_off",
+    "handle_done": "done",
+    "handle_no_expenses": "no_expenses",
+    "handle_cancel": "cancel",
+}
+
+# The events that give a volunteer a deadline -> its kind: they have to answer an announcement, confirm that they
+# can take on the request assigned to them, or answer the exit survey
+DEADLINE_EVENTS = {"announce": "answer", "pick": "answer", "assign": "caution", "done": "survey"}
+# The events that move a volunteer through the exit survey, the deadline stays as it is; any other event cancels it
+SURVEY_EVENTS = ("amount", "no_expenses", "receipt", "rated")
+# kind -> seconds until the volunteer gets a reminder, seconds until they are released
+DEADLINES = {
+    "answer": (15 * 60, 60 * 60),
+    "caution": (15 * 60, 60 * 60),
+    "survey": (60 * 60, 24 * 60 * 60),
+}
+# Seconds between two attempts to upload the receipts that are still in the spool, see `retry_receipts`
+RECEIPT_RETRY_INTERVAL = 60
+# kind -> the states in which the deadline applies, the reminder and the notice sent when the volunteer is released
+DEADLINE_DETAILS = {
+    "answer": ((c.State.REQUEST_SENT,), c.MSG_REMIND_ANSWER, c.MSG_EXPIRED_ANSWER),
+    "caution": ((c.State.REQUEST_ASSIGNED,), c.MSG_REMIND_CAUTION, c.MSG_EXPIRED_CAUTION),
+    "survey": (
+        (
+            c.State.EXPECTING_AMOUNT,
+            c.State.EXPECTING_RECEIPT,
+            c.State.EXPECTING_EXIT_SURVEY,
+            c.State.EXPECTING_FURTHER_COMMENTS,
+        ),
+        c.MSG_REMIND_SURVEY,
+        c.MSG_EXPIRED_SURVEY,
+    ),
+}
+
+
+def in_background(method):
+    """Like `telegram.ext.dispatcher.run_async`, it makes a method run on the dispatcher's workers. The decorator of
+    the library looks for the dispatcher when the method is invoked, which only works when there is a single one in
+    the process; this one uses the bot's own dispatcher, see `tenants.py`"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # the method stays in the span of its caller, if any
+        return self.updater.dispatcher.run_async(tracing.bind(method), self, *args, **kwargs)
+
+    return wrapper
+
 
 # pylint: disable=too-many-public-methods
 class Ajubot:
     """This class comprises the Telegram bot, a REST server for receiving input from external systems, as well as
     a client that sends data back to the backend."""
 
-    def __init__(self, updater, backend):
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        updater,
+        backend,
+        state_dir=".",
+        recorder=None,
+        sender=None,
+        urgency=None,
+        digest_window=DEFAULT_WINDOW,
+        directory=None,
+        concurrent_updates=False,
+        flush_interval=flusher.DEFAULT_INTERVAL,
+        flush_threshold=flusher.DEFAULT_THRESHOLD,
+        tracer=None,
+        deadlines=None,
+        max_workers=None,
+        admin_token=None,
+    ):
         """Constructor
         :param updater: instance of Telegram updater object
-        :param backend: instance of a Backender object, responsible for dealing with the Covid server"""
+        :param backend: instance of a Backender object, responsible for dealing with the Covid server
+        :param state_dir: str, where the bot keeps its files (pending deliveries, receipts)
+        :param recorder: optional replay.Recorder, if set, all incoming updates and REST calls are recorded
+        :param sender: optional Sender, by default the bot gets its own; see `tenants.py` for sharing one pool of
+                       workers between several bots
+        :param urgency: optional callable(HelpRequest) -> number, decides which requests are announced first when
+                        several are waiting, see `broadcasts.py`
+        :param digest_window: float, seconds during which the announcements for a volunteer are collected into a
+                              single digest, 0 to send each of them right away, see `digests.py`
+        :param directory: optional VolunteerDirectory, by default the bot gets its own; it is only started and
+                          stopped by the bot if it is its own
+        :param concurrent_updates: bool, if True, the updates are handled by the dispatcher's workers, the updates of
+                                   each volunteer in order, see `concurrency.py`; otherwise by the dispatcher's
+                                   thread, one at a time
+        :param flush_interval: float, seconds between two saves of the state, see `flusher.py`
+        :param flush_threshold: int, how many changed volunteers and requests make the state get saved before the
+                                interval is over
+        :param tracer: optional tracing.Tracer, by default the bot gets one that only keeps statistics, without
+                       exporting the spans
+        :param deadlines: optional dict, kind -> (seconds until the reminder, seconds until the release), overrides
+                          the defaults in `DEADLINES`
+        :param max_workers: optional int, the dispatcher's pool of workers grows up to this size when the work backs
+                            up, see `autoscale.py`; by default it keeps the size it was created with
+        :param admin_token: optional str, lets the REST API change the bot's settings when called from another
+                            machine, see `restapi.BotRestApi.is_admin`"""
         self.updater = updater
         self.backend = backend
+        self.state_dir = state_dir
+        self.recorder = recorder
+        # the lifecycle of each request, from the backend's announcement until it is done, see `tracing.py`
+        self.tracer = tracer or tracing.Tracer()
         self.rest = restapi.BotRestApi(
-            self.hook_request_assistance,
+            self.queue_request_assistance,
             self.hook_cancel_assistance,
             self.hook_assign_assistance,
             self.hook_introspect,
+            recorder=recorder,
+            stats_handler=self.footprint,
+            traces_handler=self.tracer.summary,
+            memory_handler=self.memory_usage,
+            admin_token=admin_token,
+        )
+        # new requests are announced in order of urgency, rather than in order of arrival
+        self.broadcasts = BroadcastQueue(self.hook_request_assistance, urgency)
+        self.sender = sender or Sender()
+        # a digest lists the most urgent requests first, and goes out through the sender, within its rate limit
+        self.digests = DigestBuffer(
+            self.send_announcements,
+            digest_window,
+            submit=self.sender.submit,
+            priority=lambda item: self.broadcasts.score(item[0]),
+        )
+        # the volunteers known to the backend, kept in memory, see `directory.py`
+        self.directory = directory or VolunteerDirectory(backend)
+        self.owns_directory = directory is None
+        # failed sends are retried in the background, announcements that were deferred are recorded once delivered
+        self.delivery = Delivery(
+            self.updater.bot, os.path.join(state_dir, "delivery.bin"), limiter=self.sender.limiter,
+        )
+        self.delivery.register(
+            "announcement", self.on_announcement_delivered, self.is_stale_announcement
+        )
+        self.delivery.register("digest", self.on_digest_delivered, self.is_stale_digest)
+        # its queue is rewritten with every receipt, and nobody else reads it
+        self.receipts = ReceiptSpool(os.path.join(state_dir, "receipts"), binary=True)
+        self.albums = MediaGroupCollector()
+        # the state of a volunteer or a request is only changed while holding its lock
+        self.locks = LockStripes()
+        self.chat_queues = (
+            ChatQueues(self.updater.dispatcher.run_async, self.locks)
+            if concurrent_updates
+            else None
+        )
+        # the pool of workers follows the load
+        self.scaler = autoscale.WorkerScaler(self.updater.dispatcher, max_workers)
+        # changes are marked as they happen and saved in batches
+        self.flusher = flusher.Flusher(self.updater.dispatcher, flush_interval, flush_threshold)
+        models.adopt(self.updater.dispatcher)
+        # the log of sent announcements is kept in bot_data, such that it survives restarts
+        self.announcements = self.updater.dispatcher.bot_data.setdefault(
+            "announcements", AnnouncementLog()
+        )
+        self.callbacks = CallbackRouter(guard=self.is_stale_callback)
+        # every change of a volunteer's state goes through the transition table, see `statemachine.py`
+        self.machine = StateMachine(
+            on_illegal=self.on_illegal_event, on_transition=self.on_transition
         )
+        # volunteers who don't answer in time get a reminder, then they are released, see `timers.py`
+        self.deadline_delays = {**DEADLINES, **(deadlines or {})}
+        self.deadlines = timers.Deadlines(os.path.join(state_dir, "timers.bin"))
+        self.deadlines.register("volunteer", self.on_deadline)
+        self.deadlines.register("receipts", self.retry_receipts)
 
     def serve(self):
         """The main loop"""
@@ -50,10 +229,37 @@ class Ajubot:
         # TODO discuss this detail once we have a better idea about the deployment environment
         restapi.run_background(self.rest, "0.0.0.0", 5001)  # nosec
 
+        self.start()
+        self.updater.idle()
+        self.stop()
+
+    def start(self):
+        """Register the handlers and start polling Telegram, without blocking"""
         log.info("Starting bot handlers")
         self.init_bot()
+        self.delivery.start()
+        self.flusher.start()
+        self.deadlines.start()
+        if self.owns_directory:
+            self.directory.start()
+        # whatever was not uploaded before the last shutdown goes out now, then periodically
+        self.deadlines.schedule(("receipts",), 0)
         self.updater.start_polling()
-        self.updater.idle()
+        self.scaler.start()
+
+    def stop(self):
+        """Release the background workers, once the updater was stopped"""
+        self.scaler.stop()
+        self.broadcasts.stop()
+        self.digests.stop()
+        self.delivery.stop()
+        self.sender.stop()
+        self.deadlines.stop()
+        if self.owns_directory:
+            self.directory.stop()
+        # the steps above may have changed the state too
+        self.flusher.stop()
+        self.tracer.stop()
 
     @staticmethod
     def get_params(raw):
@@ -63,8 +269,7 @@ class Ajubot:
         parts = raw.split(" ", 1)
         return None if len(parts) == 1 else parts[1]
 
-    @staticmethod
-    def on_bot_start(update, context):
+    def on_bot_start(self, update, context):
         """Send a message when the command /start is issued."""
         user = update.effective_user
         chat_id = update.effective_chat.id
@@ -79,7 +284,7 @@ class Ajubot:
         )
 
         # set some context data about this user, so we can rely on this later
-        context.user_data["state"] = c.State.EXPECTING_PHONE_NUMBER
+        self.machine.fire(chat_id, context.user_data, "start")
 
     @staticmethod
     def on_bot_help(update, _context):
@@ -102,12 +307,79 @@ class Ajubot:
         """Log Errors caused by Updates."""
         log.warning('Update "%s" caused error "%s"', update, context.error)
 
+    @staticmethod
+    def on_illegal_event(chat_id, state, event):
+        """Invoked by the state machine when an event is not allowed in a volunteer's state, e.g. they pressed a
+        button of an older message; the event is ignored"""
+        log.warning("Ignoring `%s` from @%s in state %s", event, chat_id, state)
+
+    def on_transition(self, chat_id, event, _target):
+        """Invoked by the state machine after a volunteer changed their state, it starts or cancels their deadline;
+        a volunteer has at most one at a time"""
+        key = ("volunteer", chat_id)
+        kind = DEADLINE_EVENTS.get(event)
+        if kind is not None:
+            self.deadlines.schedule(key, self.deadline_delays[kind][0], (kind, "remind"))
+        elif event not in SURVEY_EVENTS:
+            self.deadlines.cancel(key)
+
+    @in_background
+    def on_deadline(self, key, payload):
+        """Invoked when a volunteer's deadline is up: the first time they get a reminder, the second time they are
+        released, see `expire`
+        :param key: tuple, ("volunteer", chat_id)
+        :param payload: tuple, (kind, stage), the kind is one of `DEADLINES`, the stage is `remind` or `expire`"""
+        chat_id = key[1]
+        kind, stage = payload
+        states, reminder, notice = DEADLINE_DETAILS[kind]
+        with self.locks.chat(chat_id):
+            session = self.updater.dispatcher.user_data.get(chat_id)
+            if key in self.deadlines or session is None or session.state not in states:
+                # they answered or got a new deadline while this one was on its way
+                return
+            before = self.involved_requests(chat_id)
+            request_id = session.reviewed_request if kind == "answer" else session.current_request
+            with self.tracer.span(request_id, "deadline", chat_id=chat_id, kind=kind, stage=stage):
+                if stage == "remind":
+                    delays = self.deadline_delays[kind]
+                    self.deadlines.schedule(key, delays[1] - delays[0], (kind, "expire"))
+                    text = reminder
+                else:
+                    log.info("Vol:%s missed the %s deadline of req:%s", chat_id, kind, request_id)
+                    self.expire(chat_id, session, kind, request_id)
+                    text = notice
+            self.mark_dirty((chat_id,), before | self.involved_requests(chat_id))
+        self.delivery.send_message(chat_id, text)
+
+    def expire(self, chat_id, session, kind, request_id):
+        """Release a volunteer who missed a deadline, and tell the backend where it needs to know
+        :param kind: str, `answer`: the announcement is left to the others; `caution`: the assignment is cancelled,
+                     as if they pressed the button to cancel; `survey`: what they answered so far is sent as the
+                     result of the request"""
+        if kind == "answer":
+            self.machine.fire(chat_id, session, "withdraw")
+            session.reviewed_request = None
+        elif kind == "caution":
+            self.machine.fire(chat_id, session, "cancel")
+            session.release()
+            self.backend.update_request_status(request_id, "CANCELLED")
+        else:
+            with self.locks.request(request_id):
+                request = self.updater.dispatcher.bot_data.pop(request_id, None)
+            if request is not None:
+                self.backend.send_request_result(request_id, self.request_result(request))
+            self.machine.fire(chat_id, session, "release")
+            session.release()
+            session.symptom_keyboard = None
+            self.receipts.forget(request_id)
+            self.tracer.close(request_id, "finished")
+
     @staticmethod
     def on_status(update, context):
         """Invoked when the user sends the /status command. At the moment this is only intended for debugging
         purposes, but it may be handy if the user has a queue of multiple requests"""
-        current_state = context.user_data["state"]
-        current_request = context.user_data.get("current_request", None)
+        current_state = context.user_data.state
+        current_request = context.user_data.current_request
         message = f"State: {current_state}\nRequest: {current_request}"
 
         context.bot.send_message(chat_id=update.message.chat_id, text=message)
@@ -116,65 +388,205 @@ class Ajubot:
         """Initialize the bot's handlers, which will be invoked when certain commands or messages are received"""
         dispatcher = self.updater.dispatcher
 
-        dispatcher.add_handler(CommandHandler("start", self.on_bot_start))
-        dispatcher.add_handler(CommandHandler("help", self.on_bot_help))
-        dispatcher.add_handler(CommandHandler("about", self.on_bot_about))
-        dispatcher.add_handler(CommandHandler("vreausaajut", self.on_bot_offer_to_help))
-        dispatcher.add_handler(CommandHandler("status", self.on_status))
-        dispatcher.add_handler(CommandHandler("Da", self.on_accept))
-        dispatcher.add_handler(CommandHandler("Nu", self.on_reject))
-
-        dispatcher.add_handler(CallbackQueryHandler(self.negotiate_time, pattern="^eta.*"))
-        dispatcher.add_handler(CallbackQueryHandler(self.confirm_dispatch, pattern="^caution.*"))
-        dispatcher.add_handler(CallbackQueryHandler(self.confirm_handle, pattern="^handle.*"))
-        dispatcher.add_handler(CallbackQueryHandler(self.confirm_wellbeing, pattern="^state.*"))
-        dispatcher.add_handler(CallbackQueryHandler(self.confirm_symptom, pattern="^symptom.*"))
-        dispatcher.add_handler(CallbackQueryHandler(self.confirm_wouldyou, pattern="^wouldyou.*"))
-        dispatcher.add_handler(CallbackQueryHandler(self.confirm_further, pattern="^further.*"))
-        dispatcher.add_handler(CallbackQueryHandler(self.confirm_activities, pattern="^assist.*"))
-
-        dispatcher.add_handler(MessageHandler(Filters.photo, self.on_photo))
-        dispatcher.add_handler(MessageHandler(Filters.contact, self.on_contact))
-        dispatcher.add_handler(MessageHandler(Filters.text, self.on_text_message))
+        if self.recorder is not None:
+            self.recorder.record_state(dispatcher.user_data, dispatcher.bot_data)
+            dispatcher.add_handler(TypeHandler(Update, self.recorder.record_update), group=-3)
+
+        # these run before all the others: the first one notices that a user whose chat was unreachable is back,
+        # the second one weeds out responses to requests that are no longer available
+        dispatcher.add_handler(TypeHandler(Update, self.note_activity), group=-2)
+        dispatcher.add_handler(TypeHandler(Update, self.drop_stale_updates), group=-1)
+
+        dispatcher.add_handler(CommandHandler("start", self.serialized(self.on_bot_start)))
+        dispatcher.add_handler(CommandHandler("help", self.serialized(self.on_bot_help)))
+        dispatcher.add_handler(CommandHandler("about", self.serialized(self.on_bot_about)))
+        dispatcher.add_handler(
+            CommandHandler("vreausaajut", self.serialized(self.on_bot_offer_to_help))
+        )
+        dispatcher.add_handler(CommandHandler("status", self.serialized(self.on_status)))
+        dispatcher.add_handler(CommandHandler("Da", self.serialized(self.on_accept)))
+        dispatcher.add_handler(CommandHandler("Nu", self.serialized(self.on_reject)))
+
+        # all the inline keyboard presses go through a single handler that decodes the payload and dispatches it
+        # to the function responsible for that route, see `callbacks.py`
+        self.callbacks.add("eta", self.traced("callback.eta", self.negotiate_time))
+        self.callbacks.add("caution", self.traced("callback.caution", self.confirm_dispatch))
+        self.callbacks.add("handle", self.traced("callback.handle", self.confirm_handle))
+        self.callbacks.add("state", self.traced("callback.state", self.confirm_wellbeing))
+        self.callbacks.add("symptom", self.traced("callback.symptom", self.confirm_symptom))
+        self.callbacks.add("wouldyou", self.traced("callback.wouldyou", self.confirm_wouldyou))
+        self.callbacks.add("further", self.traced("callback.further", self.confirm_further))
+        self.callbacks.add("assist", self.traced("callback.assist", self.confirm_activities))
+        self.callbacks.add("pick", self.traced("callback.pick", self.confirm_pick))
+        dispatcher.add_handler(CallbackQueryHandler(self.serialized(self.callbacks.dispatch)))
+
+        # what the volunteers type or send is interpreted according to the state they're in
+        self.machine.on(
+            c.State.EXPECTING_AMOUNT, "text", self.traced("input.amount", self.on_amount)
+        )
+        self.machine.on(
+            c.State.EXPECTING_FURTHER_COMMENTS,
+            "text",
+            self.traced("input.further", self.on_further_comments),
+        )
+        self.machine.on(c.State.EXPECTING_PROFILE_DETAILS, "text", self.on_profile_details)
+        self.machine.on(
+            c.State.EXPECTING_RECEIPT, "photo", self.traced("input.receipt", self.on_receipt)
+        )
+
+        dispatcher.add_handler(MessageHandler(Filters.photo, self.serialized(self.on_photo)))
+        dispatcher.add_handler(MessageHandler(Filters.contact, self.serialized(self.on_contact)))
+        dispatcher.add_handler(MessageHandler(Filters.text, self.serialized(self.on_text_message)))
         dispatcher.add_error_handler(self.on_bot_error)
 
-    def confirm_further(self, update, context):
+    def serialized(self, handler):
+        """Wrap a handler, such that it runs while holding the volunteer's lock. With `concurrent_updates`, it runs on
+        one of the dispatcher's workers, after the previous updates of the same volunteer were handled"""
+
+        def run(update, context):
+            chat = update.effective_chat
+            if chat is None:
+                handler(update, context)
+            elif self.chat_queues is not None:
+                self.chat_queues.put(chat.id, self.handle_and_mark, handler, update, context)
+            else:
+                with self.locks.chat(chat.id):
+                    self.handle_and_mark(handler, update, context)
+
+        return run
+
+    def traced(self, name, handler):
+        """Wrap a handler, such that it runs in a span of the request it is about, see `tracing.py`. The request is
+        the one encoded in the callback, if any, otherwise the one the volunteer is working on or reviewing
+        :param name: str, the name of the span"""
+
+        def run(update, context, *args):
+            callback = args[0] if args else None
+            session = context.user_data
+            request_id = (
+                (callback and callback.request_id)
+                or session.current_request
+                or session.reviewed_request
+            )
+            with self.tracer.span(request_id, name, chat_id=update.effective_chat.id):
+                return handler(update, context, *args)
+
+        return run
+
+    def handle_and_mark(self, handler, update, context):
+        """Run a handler, then mark the volunteer as changed, along with the requests they were or are now
+        involved in"""
+        chat_id = update.effective_chat.id
+        before = self.involved_requests(chat_id)
+        try:
+            handler(update, context)
+        finally:
+            self.mark_dirty((chat_id,), before | self.involved_requests(chat_id))
+
+    def involved_requests(self, chat_id):
+        session = self.updater.dispatcher.user_data.get(chat_id)
+        if session is None:
+            return set()
+        return {session.reviewed_request, session.current_request} - {None}
+
+    def mark_dirty(self, chat_ids=(), request_ids=()):
+        """Record that some volunteers and requests changed, they are saved by the flusher shortly"""
+        self.flusher.mark(chat_ids, request_ids)
+
+    def note_activity(self, update, _context):
+        """Invoked before any other handler, it takes the chat off the suppression list, if it was there, because
+        the user is evidently talking to us again"""
+        if update.effective_chat is not None:
+            self.delivery.unsuppress(update.effective_chat.id)
+
+    def drop_stale_updates(self, update, context):
+        """Invoked before any other handler, it stops the processing of /Da and /Nu responses that refer to a
+        request that was already assigned to someone else or cancelled"""
+        message = update.message
+        if not (message and message.text and message.text.startswith(("/Da", "/Nu"))):
+            return
+
+        request_id = context.user_data.reviewed_request
+        if request_id is not None and not self.announcements.is_withdrawn(request_id):
+            return
+
+        log.debug("Drop stale response from %s to req:%s", update.effective_chat.id, request_id)
+        raise DispatcherHandlerStop
+
+    def is_stale_callback(self, update, context, callback):
+        """Invoked by the callback router before any handler, it tells whether a button press refers to a request
+        that is no longer relevant for this volunteer, in which case it is dropped
+        :param callback: decoded callback payload, see `callbacks.py`
+        :returns: bool, True if the callback must be dropped"""
+        reviewed = context.user_data.reviewed_request
+        if callback.route == "pick":
+            # any request in a digest can be picked, as long as it is open and the volunteer is not busy
+            request_id = callback.request_id
+            if request_id is None:
+                return False
+            stale = self.announcements.is_withdrawn(request_id) or not self.machine.allows(
+                context.user_data.state, "pick"
+            )
+        elif callback.route == "eta":
+            # offers are only accepted for the request under review, as long as it is still open
+            request_id = callback.request_id or reviewed
+            stale = (
+                request_id is None
+                or request_id != reviewed
+                or self.announcements.is_withdrawn(request_id)
+            )
+        elif callback.request_id is None:
+            # onboarding buttons, or a keyboard sent before request IDs were encoded in the payload
+            return False
+        else:
+            request_id = callback.request_id
+            stale = request_id not in (reviewed, context.user_data.current_request)
+
+        if not stale:
+            return False
+
+        log.debug("Drop stale callback from %s to req:%s", update.effective_chat.id, request_id)
+        try:
+            update.callback_query.answer(c.MSG_REQUEST_WITHDRAWN)
+        except TelegramError as err:
+            log.debug("Could not answer stale callback: %s", err)
+        return True
+
+    def confirm_further(self, update, context, callback):
         """This is invoked when they clicked "No further comments" in the end"""
-        response_code = update.callback_query["data"]  # wouldyou_{yes|no}
-        request_id = context.user_data["current_request"]
+        response_code = callback.code  # further_no
+        request_id = context.user_data.current_request
         log.info("No further comments req:%s %s", request_id, response_code)
         self.finalize_request(update, context, request_id)
 
-    def confirm_wouldyou(self, update, context):
+    def confirm_wouldyou(self, update, context, callback):
         """This is invoked when they answer yes/no to a "would you help again? question"""
         chat_id = update.effective_chat.id
-        response_code = update.callback_query["data"]  # wouldyou_{yes|no}
-        request_id = context.user_data["current_request"]
+        response_code = callback.code  # wouldyou_{yes|no}
+        request_id = context.user_data.current_request
         log.info("Wouldyou req:%s %s", request_id, response_code)
 
         if response_code == "wouldyou_yes":
             # they want to keep returning to this beneficiary
-            context.bot_data[request_id]["would_return"] = True
+            context.bot_data[request_id].would_return = True
         else:
-            context.bot_data[request_id]["would_return"] = False
+            context.bot_data[request_id].would_return = False
 
         # Send the next question, asking if they have any special comments for future volunteers
-        self.updater.bot.send_message(
+        self.delivery.send_message(
             chat_id=chat_id,
-            text=c.MSG_FEEDBACK_FURTHER_COMMENTS % context.bot_data[request_id]["beneficiary"],
+            text=c.MSG_FEEDBACK_FURTHER_COMMENTS % context.bot_data[request_id].beneficiary,
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup(k.further_comments_choices),
+            reply_markup=InlineKeyboardMarkup(k.further_comments_choices(request_id)),
         )
-        context.user_data["state"] = c.State.EXPECTING_FURTHER_COMMENTS
+        self.machine.fire(chat_id, context.user_data, "rated")
 
-    def confirm_activities(self, update, context):
+    def confirm_activities(self, update, context, callback=None):
         """This is invoked during onboarding, when the user indicates the type of assistance they can offer"""
         chat_id = update.effective_chat.id
-        try:
-            response_code = update.callback_query["data"]  # assist_{transport|delivery|phone}
-        except TypeError:
-            # This is the first time this function is invoked
-            self.updater.bot.send_message(
+        if callback is None:
+            # This is the first time this function is invoked, by `build_profile`
+            self.delivery.send_message(
                 chat_id=chat_id,
                 text=c.MSG_ONBOARD_ACTIVITIES_NUDGE,
                 parse_mode=ParseMode.MARKDOWN,
@@ -185,6 +597,7 @@ class Ajubot:
             return
 
         # we're here again after the user ticked some boxes
+        response_code = callback.code  # assist_{transport|delivery|phone|next}
         log.info("Assist chat_id:%s %s", chat_id, response_code)
 
         # Update list of assistance features in the bot's state with respect to this user's registration state
@@ -210,48 +623,50 @@ class Ajubot:
             activities.append(response_code)
 
         # This is a dynamically updated keyboard, see the example in `confirm_symptoms`
-        previous_keyboard = context.user_data.get("assist_keyboard", k.new_assistance_choices())
+        previous_keyboard = context.user_data.assist_keyboard or k.new_assistance_choices()
         updated_keyboard = k.update_dynamic_keyboard_assistance(previous_keyboard, response_code)
-        context.user_data["assist_keyboard"] = updated_keyboard
+        context.user_data.assist_keyboard = updated_keyboard
         self.updater.bot.edit_message_reply_markup(
             chat_id=chat_id,
             message_id=update.effective_message.message_id,
             reply_markup=InlineKeyboardMarkup(updated_keyboard),
         )
 
-    def confirm_symptom(self, update, context):
+    def confirm_symptom(self, update, context, callback):
         """This is invoked when the user reported the observed symptoms, if any"""
         chat_id = update.effective_chat.id
         message_id = update.effective_message.message_id
-        response_code = update.callback_query["data"]  # symptom_{fever|cough|heavybreathing}
-        request_id = context.user_data["current_request"]
+        response_code = callback.code  # symptom_{fever|cough|heavybreathing}
+        request_id = context.user_data.current_request
         log.info("Symptom req:%s %s", request_id, response_code)
 
         if response_code in ["symptom_none", "symptom_next", "symptom_noidea"]:
             # they pressed "Continue" or marked the end of all the symptoms list, move on to the next question
-            self.updater.bot.send_message(
+            self.delivery.send_message(
                 chat_id=chat_id,
-                text=c.MSG_WOULD_YOU_DO_THIS_AGAIN % context.bot_data[request_id]["beneficiary"],
+                text=c.MSG_WOULD_YOU_DO_THIS_AGAIN % context.bot_data[request_id].beneficiary,
                 parse_mode=ParseMode.MARKDOWN,
-                reply_markup=InlineKeyboardMarkup(k.would_you_do_it_again_choices),
+                reply_markup=InlineKeyboardMarkup(k.would_you_do_it_again_choices(request_id)),
             )
             # remove the last state of the symptom keyboard from this user, such that the next time they receive an
             # assistance request, the keyboard is fresh (if it exists)
-            context.user_data.pop("symptom_keyboard", None)
+            context.user_data.symptom_keyboard = None
 
             # It could happen that they ticked some symptoms first, but then they clicked "no idea" or "none", leaving
             # the other checkboxes ticked. In this case we clear the list, assuming that the user's last action is the
             # right one.
             if response_code in ["symptom_none", "symptom_noidea"]:
-                context.bot_data[request_id]["symptoms"] = []
+                context.bot_data[request_id].symptoms = []
 
         else:
             # they ticked an actual symptom, send an ACK to them as feedback. Note that we can get into this part of
             # the code multiple times, depending on how they tick the checkboxes - so we have to keep track of the
             # state and update the inline keyboard accordingly
-            previous_keyboard = context.user_data.get("symptom_keyboard", k.new_symptom_choices())
+            previous_keyboard = context.user_data.symptom_keyboard or k.new_symptom_choices(
+                request_id
+            )
             updated_keyboard = k.update_dynamic_keyboard_symptom(previous_keyboard, response_code)
-            context.user_data["symptom_keyboard"] = updated_keyboard
+            context.user_data.symptom_keyboard = updated_keyboard
 
             self.updater.bot.edit_message_reply_markup(
                 chat_id=chat_id,
@@ -260,235 +675,292 @@ class Ajubot:
             )
 
             # Update list of symptoms so we can send it to the server later in one swoop
-            if "symptoms" in context.bot_data[request_id]:
-                if response_code in context.bot_data[request_id]["symptoms"]:
-                    # it is already in the list, which means that the user unticked the checkmark, so we remove it
-                    context.bot_data[request_id]["symptoms"].remove(response_code)
-                else:
-                    # it isn't there, which means this is the first time the symptom is mentioned
-                    context.bot_data[request_id]["symptoms"].append(response_code)
+            symptoms = context.bot_data[request_id].symptoms
+            if response_code in symptoms:
+                # it is already in the list, which means that the user unticked the checkmark, so we remove it
+                symptoms.remove(response_code)
             else:
-                # the list isn't there yet, we create a new one
-                context.bot_data[request_id]["symptoms"] = [response_code]
+                # it isn't there, which means this is the first time the symptom is mentioned
+                symptoms.append(sys.intern(response_code))
 
-    def confirm_wellbeing(self, update, context):
+    def confirm_wellbeing(self, update, context, callback):
         """This is invoked when the user esimated the wellbeing of the assisted beneficiary"""
         chat_id = update.effective_chat.id
-        response_code = int(update.callback_query["data"].split("_")[-1])  # state_{0..4}
-        request_id = context.user_data["current_request"]
+        response_code = int(callback.arg)  # state_{0..4}
+        request_id = context.user_data.current_request
         log.info("Wellbeing req:%s %s", request_id, response_code)
 
         # Write this amount to the persistent state, so we can rely on it later
-        context.bot_data[request_id]["wellbeing"] = response_code
+        context.bot_data[request_id].wellbeing = response_code
 
-        self.updater.bot.send_message(
+        self.delivery.send_message(
             chat_id=chat_id,
-            text=c.MSG_SYMPTOMS % context.bot_data[request_id]["beneficiary"],
+            text=c.MSG_SYMPTOMS % context.bot_data[request_id].beneficiary,
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup(k.symptom_choices, one_time_keyboard=True),
+            reply_markup=InlineKeyboardMarkup(
+                k.new_symptom_choices(request_id), one_time_keyboard=True
+            ),
         )
 
     def finalize_request(self, update, context, request_id):
         """Thank the volunteer, send the final metadata to the server and then send the volunteer a happy GIF"""
+        if not self.machine.fire(update.effective_chat.id, context.user_data, "finish"):
+            # e.g. they pressed the button twice, the request is already gone
+            return
         self.send_message_ex(update.effective_chat.id, c.MSG_THANKS_FINAL)
 
-        # Instead of sending the whole shebang with the state of this request, send a clean dictionary that
-        # only contains the necessary parts
-        # request_payload = context.bot_data[request_id]
-        request_payload = {
-            "request_id": request_id,
-            "amount": context.bot_data[request_id].get("amount", 0),
-            "further_comments": context.bot_data[request_id].get("further_comments", ""),
-            "symptoms": context.bot_data[request_id].get("symptoms", []),
-            "wellbeing": context.bot_data[request_id]["wellbeing"],
-            "would_return": context.bot_data[request_id]["would_return"],
-        }
-
-        self.backend.send_request_result(request_id, request_payload)
+        request = context.bot_data[request_id]
+        self.backend.send_request_result(request_id, self.request_result(request))
 
         # reset the user state so they're clean and ready for new assignments
-        context.user_data["state"] = c.State.AVAILABLE
-        context.user_data["current_request"] = None
-        context.user_data["reviewed_request"] = None
+        self.machine.fire(update.effective_chat.id, context.user_data, "release")
+        context.user_data.release()
         # Remove symptom-keyboard-related info, if it is in the state
-        context.user_data.pop("symptom_keyboard", None)
-        del context.bot_data[request_id]
+        context.user_data.symptom_keyboard = None
+        with self.locks.request(request_id):
+            # the request may have been cancelled in the meantime
+            context.bot_data.pop(request_id, None)
+        self.receipts.forget(request_id)
 
         # cherry on top
         self.send_thanks_image(update.effective_chat.id)
+        self.tracer.close(request_id, "finished")
+
+    @staticmethod
+    def request_result(request):
+        """Instead of sending the whole shebang with the state of a request, send a clean dictionary that only
+        contains the answers to the exit survey
+        :param request: HelpRequest
+        :returns: dict, the payload of `Backender.send_request_result`"""
+        return {
+            "request_id": request.request_id,
+            "amount": request.amount or 0,
+            "further_comments": request.further_comments,
+            "symptoms": request.symptoms,
+            "wellbeing": request.wellbeing,
+            "would_return": request.would_return,
+        }
 
     def send_thanks_image(self, chat_id):
         """Send a random thank you GIF from our local collection, as an added bonus"""
         gifs = os.listdir(os.path.join("res", "gifs"))
         # Bandit complains this is not a proper randomizer, but this is OK for the given use case
         specific_gif = os.path.join("res", "gifs", choice(gifs))  # nosec
-        random_gif = open(specific_gif, "rb")
-        self.updater.bot.send_animation(chat_id, random_gif, disable_notification=True)
+        with open(specific_gif, "rb") as random_gif:
+            self.updater.bot.send_animation(chat_id, random_gif, disable_notification=True)
 
     def on_text_message(self, update, context):
         """Invoked when the user sends an arbitrary text to the bot. We expect this to happen when they
-        - send the receipt and indicate the amount
-        - provide some feedback about the beneficiary"""
+        - indicate the amount they spent
+        - provide some feedback about the beneficiary
+        - answer the questions about their profile
+        what the text means depends on their state, see the handlers registered in `init_bot`"""
         chat_id = update.effective_chat.id
         log.info("Msg from:%s `%s`", chat_id, update.effective_message.text)
 
-        if context.user_data["state"] == c.State.EXPECTING_AMOUNT:
-            log.info("Vol:%s spent %s MDL on this request", chat_id, update.effective_message.text)
-            # TODO validate the message and make sure it is a number, discuss whether this is necessary at all
-            # TODO send this to the server, we need to define an API for that
-            request_id = context.user_data["current_request"]
+        if not self.machine.handle("text", update, context):
+            # if we got this far it means it is some sort of an arbitrary message that we weren't yet expecting
+            log.warning("Unexpected message from @%s in state %s", chat_id, context.user_data.state)
+            self.send_message(chat_id, c.MSG_UNEXPECTED)
 
-            # Write this amount to the persistent state, so we can rely on it later
-            context.bot_data[request_id]["amount"] = update.effective_message.text
+    def on_amount(self, update, context):
+        """Invoked when the volunteer indicates how much they spent on the request"""
+        chat_id = update.effective_chat.id
+        log.info("Vol:%s spent %s MDL on this request", chat_id, update.effective_message.text)
+        # TODO validate the message and make sure it is a number, discuss whether this is necessary at all
+        # TODO send this to the server, we need to define an API for that
+        request_id = context.user_data.current_request
 
-            # Then we have to ask them to send a receipt.
-            self.send_message_ex(update.message.chat_id, c.MSG_FEEDBACK_RECEIPT)
-            context.user_data["state"] = c.State.EXPECTING_RECEIPT
-            return
+        # Write this amount to the persistent state, so we can rely on it later
+        context.bot_data[request_id].amount = update.effective_message.text
 
-        if context.user_data["state"] == c.State.EXPECTING_FURTHER_COMMENTS:
-            log.info("Vol:%s has further comments: %s", chat_id, update.effective_message.text)
-            request_id = context.user_data["current_request"]
-            context.bot_data[request_id]["further_comments"] = update.effective_message.text
-            self.finalize_request(update, context, request_id)
-            return
+        # Then we have to ask them to send a receipt.
+        self.send_message_ex(update.message.chat_id, c.MSG_FEEDBACK_RECEIPT)
+        self.machine.fire(chat_id, context.user_data, "amount")
 
-        if context.user_data["state"] == c.State.EXPECTING_PROFILE_DETAILS:
-            self.build_profile(update, context, raw_text=update.effective_message.text)
-            return
+    def on_further_comments(self, update, context):
+        """Invoked when the volunteer writes their remarks about the beneficiary, at the end of the exit survey"""
+        chat_id = update.effective_chat.id
+        log.info("Vol:%s has further comments: %s", chat_id, update.effective_message.text)
+        request_id = context.user_data.current_request
+        context.bot_data[request_id].further_comments = update.effective_message.text
+        self.finalize_request(update, context, request_id)
 
-        # if we got this far it means it is some sort of an arbitrary message that we weren't yet expecting
-        log.warning("unexpected message ..........")
+    def on_profile_details(self, update, context):
+        """Invoked when the volunteer answers one of the questions about their profile"""
+        self.build_profile(update, context, raw_text=update.effective_message.text)
 
-    def on_reject(self, update, _context):
+    def on_reject(self, update, context):
         """Invoked when the user presses `No` after receiving a request for help"""
         self.send_message(update.message.chat_id, c.MSG_THANKS_NOTHANKS)
+        self.decline(update.effective_chat.id, context.user_data)
+
+    def decline(self, chat_id, session):
+        """Make a volunteer available again after they turned down the announcement they were looking at; if they
+        had already offered a time for another request, that offer stands"""
+        if session.state == c.State.REQUEST_SENT:
+            self.machine.fire(chat_id, session, "decline")
+            session.reviewed_request = None
+
+    def confirm_pick(self, update, context, callback):
+        """Invoked when the volunteer chooses one of the requests listed in a digest, or none of them"""
+        chat_id = update.effective_chat.id
+        log.info("Pick @%s req:%s %s", chat_id, callback.request_id, callback.arg)
+
+        if callback.arg == "none":
+            self.send_message(chat_id, c.MSG_THANKS_NOTHANKS)
+            # an announcement they got before the digest is still waiting for their answer
+            if self.reviewing(context.user_data) is None:
+                self.decline(chat_id, context.user_data)
+            return
+
+        # from now on, this is the request under review, same as if it was announced alone and they said yes
+        context.user_data.reviewed_request = callback.request_id
+        self.machine.fire(chat_id, context.user_data, "pick")
+        self.on_accept(update, context)
 
-    def on_accept(self, update, _context):
+    def on_accept(self, update, context):
         """Invoked when a user presses `Yes` after receiving a request for help"""
-        self.updater.bot.send_message(
+        request_id = context.user_data.reviewed_request
+        self.delivery.send_message(
             chat_id=update.effective_chat.id,
             text="Alege timpul",
-            reply_markup=InlineKeyboardMarkup(k.build_dynamic_keyboard_first_responses()),
+            reply_markup=InlineKeyboardMarkup(k.build_dynamic_keyboard_first_responses(request_id)),
         )
 
-    def confirm_handle(self, update, context):
+    def confirm_handle(self, update, context, callback):
         """Invoked when the volunteer confirmed that they are on their way to the beneficiary or while the request
         is in progress"""
         chat_id = update.effective_chat.id
-        response_code = update.callback_query["data"]  # caution_ok or caution_cancel
-        request_id = context.user_data["reviewed_request"]
+        response_code = callback.code  # handle_{onmyway|done|no_expenses|cancel}
+        request_id = context.user_data.reviewed_request
         log.info("In progress req:%s %s", request_id, response_code)
+        if not self.machine.fire(chat_id, context.user_data, HANDLE_EVENTS[response_code]):
+            return
 
         if response_code == "handle_onmyway":
             # they pressed "I am 'on my way' in the GUI"
-            self.updater.bot.send_message(
+            self.delivery.send_message(
                 chat_id=chat_id,
                 text=f"{c.MSG_SAFETY_INSTRUCTIONS} \n\n {c.MSG_LET_ME_KNOW_ARRIVE} \n\n p.s. {c.MSG_SAFETY_REMINDER}",
                 parse_mode=ParseMode.MARKDOWN,
-                reply_markup=InlineKeyboardMarkup(k.inprogress_choices),
+                reply_markup=InlineKeyboardMarkup(k.inprogress_choices(request_id)),
             )
             self.backend.update_request_status(request_id, "onprogress")
 
         elif response_code == "handle_done":
             # they pressed 'Mission accomplished' in the GUI
             self.send_message_ex(chat_id, c.MSG_THANKS_FEEDBACK)
-            self.updater.bot.send_message(
+            self.delivery.send_message(
                 chat_id=chat_id,
                 text=c.MSG_FEEDBACK_EXPENSES,
                 parse_mode=ParseMode.MARKDOWN,
-                reply_markup=InlineKeyboardMarkup(k.endgame_choices),
+                reply_markup=InlineKeyboardMarkup(k.endgame_choices(request_id)),
             )
-            context.user_data["state"] = c.State.EXPECTING_AMOUNT
             self.backend.update_request_status(request_id, "done")
+            self.tracer.mark(request_id, "done")
 
         elif response_code == "handle_no_expenses":
             # they indicated no compensation is required; proceed to the exit survey and ask some additional questions
             # about this request
             self.send_exit_survey(update, context)
-            context.user_data["state"] = c.State.EXPECTING_EXIT_SURVEY
 
         elif response_code == "handle_cancel":
             # they bailed out at some point while the request was in progress
             self.send_message(chat_id, c.MSG_NO_WORRIES_LATER)
-            context.user_data["reviewed_request"] = None
-            context.user_data["state"] = c.State.AVAILABLE
+            context.user_data.reviewed_request = None
             self.backend.update_request_status(request_id, "cancelled")
 
-    def confirm_dispatch(self, update, context):
+    def confirm_dispatch(self, update, context, callback):
         """This is invoked when the responded to the "are you sure you are healthy?" message"""
         chat_id = update.effective_chat.id
-        response_code = update.callback_query["data"]  # caution_ok or caution_cancel
-        request_id = context.user_data["reviewed_request"]
+        response_code = callback.code  # caution_ok or caution_cancel
+        request_id = context.user_data.reviewed_request
         log.info("Confirm req:%s %s", request_id, response_code)
+        event = "confirm" if response_code == "caution_ok" else "cancel"
+        if not self.machine.fire(chat_id, context.user_data, event):
+            return
 
-        request_details = context.bot_data[request_id]
+        request = context.bot_data[request_id]
 
         if response_code == "caution_ok":
             # They're in good health, let's go
 
             # send a location message, if this info is available in the request
-            if "latitude" in request_details:
-                self.updater.bot.send_location(
-                    chat_id, request_details["latitude"], request_details["longitude"]
+            if request.latitude is not None:
+                self.delivery.send(
+                    "send_location",
+                    chat_id,
+                    latitude=request.latitude,
+                    longitude=request.longitude,
                 )
 
             # then send the rest of the details as text
-            message = c.MSG_FULL_DETAILS % request_details
-
-            if "remarks" in request_details:
-                message += "\n" + c.MSG_OTHER_REMARKS
-                for remark in request_details["remarks"]:
-                    message += "- %s\n" % remark
-
-            if "hasDisabilities" in request_details:
-                message += "\n%s\n" % (c.MSG_DISABILITY % request_details)
-
-            message += "\n" + c.MSG_LET_ME_KNOW
-            self.updater.bot.send_message(
+            self.delivery.send_message(
                 chat_id=chat_id,
-                text=message,
+                text=self.render_details(request),
                 parse_mode=ParseMode.MARKDOWN,
-                reply_markup=InlineKeyboardMarkup(k.handling_choices),
+                reply_markup=InlineKeyboardMarkup(k.handling_choices(request_id)),
             )
 
         else:  # caution_cancel
             # eventually they chose not to handle this request
             # TODO ask them why, maybe they're sick and they need help? Discuss whether this is relevant
             self.send_message(chat_id, c.MSG_NO_WORRIES_LATER)
-            context.user_data["reviewed_request"] = None
-            context.user_data["state"] = c.State.AVAILABLE
+            context.user_data.reviewed_request = None
             self.backend.update_request_status(request_id, "CANCELLED")
 
-    def negotiate_time(self, update, context):
+    @staticmethod
+    def render_details(request):
+        """Compose the message with everything the volunteer needs to know before they set off
+        :param request: HelpRequest
+        :returns: str, Markdown text"""
+        request_details = request.to_dict()
+        message = c.MSG_FULL_DETAILS % request_details
+
+        if request.remarks:
+            message += "\n" + c.MSG_OTHER_REMARKS
+            for remark in request.remarks:
+                message += "- %s\n" % remark
+
+        if request.has_disabilities:
+            message += "\n%s\n" % (c.MSG_DISABILITY % request_details)
+
+        return message + "\n" + c.MSG_LET_ME_KNOW
+
+    def negotiate_time(self, update, context, callback):
         """This is invoked when the user chooses one of the responses to an assistance request; it can be an ETA or
         a rejection."""
         chat_id = update.effective_chat.id
-        response_code = update.callback_query["data"]  # eta_later, eta_never, eta_20:45, etc.
+        request_id = context.user_data.reviewed_request
+        response_code = callback.code  # eta_later, eta_never, eta_20:45, etc.
         log.info("Offer @%s raw: @%s", update.effective_chat.id, response_code)
 
         if response_code == "eta_never":
             # the user pressed the button to say they're cancelling their offer
+            if not self.machine.fire(chat_id, context.user_data, "decline"):
+                return
             self.send_message(chat_id, c.MSG_THANKS_NOTHANKS)
-            context.user_data["reviewed_request"] = None
-            context.user_data["state"] = c.State.AVAILABLE
+            context.user_data.reviewed_request = None
 
         elif response_code == "eta_later":
             # Show them more options in the interactive menu
-            self.updater.bot.send_message(
+            self.delivery.send_message(
                 chat_id=chat_id,
                 text="Alege timpul",
-                reply_markup=InlineKeyboardMarkup(k.build_dynamic_keyboard()),
+                reply_markup=InlineKeyboardMarkup(k.build_dynamic_keyboard(request_id=request_id)),
             )
         else:
-            # This is an actual offer, ot looks like `eta_20:40`, extract the actual timestamp in UTC
-            offer = response_code.split("_")[-1]
+            # This is an actual offer, ot looks like `eta_20:40`, the argument is the actual timestamp in UTC
+            offer = callback.arg
+            if not self.machine.fire(chat_id, context.user_data, "offer"):
+                return
+            self.tracer.mark(request_id, "first_offer")
             log.info(
                 "Relaying offer @%s UTC (%s %s)", offer, utc_short_to_user_short(offer), c.TIMEZONE
             )
 
             # tell the backend about it
-            request_id = context.user_data["reviewed_request"]
             self.backend.relay_offer(request_id, chat_id, offer)
 
             # tell the user that this is now processed by the server
@@ -510,14 +982,16 @@ class Ajubot:
         # And some user-related details in update.effective_user.to_dict()
         # {'first_name': 'Alex', 'id': 253150000, 'is_bot': False, 'language_code': 'en', 'username': 'ralienpp'}
 
-        # Tell the backend about it, such that from now on it knows which chat_id corresponds to this user
-        known_user = self.backend.link_chatid_to_volunteer(
-            user.username, update.effective_chat.id, phone
-        )
+        # Tell the backend about it, such that from now on it knows which chat_id corresponds to this user; there's
+        # no need to ask if the volunteer is already in the directory
+        known_user = self.directory.get(chat_id) is not None
+        if not known_user:
+            known_user = self.backend.link_chatid_to_volunteer(user.username, chat_id, phone)
 
         if known_user:
+            self.directory.add(chat_id, phone)
             # Mark the user as available once onboarding is complete
-            context.user_data["state"] = c.State.AVAILABLE
+            self.machine.fire(chat_id, context.user_data, "registered")
             # Acknowledge receipt and tell the user that we'll contact them when new requests arrive
             update.message.reply_text(c.MSG_STANDBY)
             return
@@ -582,9 +1056,9 @@ class Ajubot:
                     continue
 
                 # if we got this far, we stumbled upon the next missing part of the profile
-                context.user_data["state"] = c.State.EXPECTING_PROFILE_DETAILS
+                self.machine.fire(chat_id, context.user_data, "ask_profile")
 
-                self.updater.bot.send_message(
+                self.delivery.send_message(
                     chat_id=chat_id,
                     text=c.PROFILE_QUESTIONS[key],
                     parse_mode=ParseMode.MARKDOWN_V2,
@@ -598,24 +1072,25 @@ class Ajubot:
                 return
 
         # if we got this far, it means the profile is complete, inform the user about it
-        self.updater.bot.send_message(
+        self.delivery.send_message(
             chat_id=chat_id, text=c.MSG_ONBOARD_NEXT_STEPS, parse_mode=ParseMode.MARKDOWN,
         )
 
         # and the backend, but first let's augment the profile with more data
         profile[c.PROFILE_CHAT_ID] = chat_id
         self.backend.register_pending_volunteer(profile)
-        context.user_data["state"] = c.State.AVAILABLE
+        self.machine.fire(chat_id, context.user_data, "profile_complete")
 
         # remove if from the state, because we don't need it anymore
         del context.bot_data["registrations"][chat_id]
 
         # Also get rid of this user's individual keyboard for assitance activities
-        context.user_data.pop("assist_keyboard", None)
+        context.user_data.assist_keyboard = None
 
     def on_photo(self, update, context):
         """Invoked when the user sends a photo to the bot. In our case, photos are always shopping receipts. Keep in
-        mind that there could be multiple photos in a message."""
+        mind that Telegram provides each photo in several sizes, we only keep the biggest one. The photos of an album
+        arrive one by one, they are collected and handled together once the whole album is here."""
         user = update.effective_user
         photo_count = len(update.message.photo)
         log.info(
@@ -626,148 +1101,538 @@ class Ajubot:
             photo_count,
         )
 
-        if context.user_data["state"] != c.State.EXPECTING_RECEIPT:
+        if not self.machine.handle("photo", update, context):
             # Got an image from someone we weren't expecting to send any. We log this, and TODO decide what
             log.debug("Got image when I was not expecting one")
-            return
 
-        # Process each photo
-        for entry in update.message.photo:
-            raw_image = entry.get_file().download_as_bytearray()
+    def on_receipt(self, update, context):
+        """Invoked when the volunteer sends a photo while we're waiting for the receipt"""
+        request_id = context.user_data.current_request
+        raw_image = update.message.photo[-1].get_file().download_as_bytearray()
 
-            # At this point the image is in the memory
-            with NamedTemporaryFile(delete=False, prefix=str(update.effective_chat.id)) as pic:
-                pic.write(raw_image)
-                log.debug("Image written to %s", pic.name)
+        # At this point the image is in the memory, put it in the spool, so it is not lost if the upload fails
+        digest, is_new = self.receipts.add(request_id, bytes(raw_image))
+        if not is_new:
+            log.debug("Receipt %s for req:%s was already sent", digest[:12], request_id)
 
-            # Note: you can disable this line when testing locally, if you don't have an actual backend that will
-            # serve this request
-            self.backend.upload_shopping_receipt(raw_image, context.user_data["current_request"])
+        group_id = update.message.media_group_id
+        if group_id is None:
+            self.complete_receipts(update, context, [digest])
+        else:
+            self.albums.add(
+                group_id, digest, lambda digests: self.complete_receipts(update, context, digests)
+            )
+
+    @in_background
+    def retry_receipts(self, key, _payload):
+        """Invoked periodically by the deadlines, it uploads the receipts that are still in the spool, e.g. because
+        the backend was down when they arrived, then schedules the next attempt
+        :param key: tuple, ("receipts",)"""
+        try:
+            uploaded = self.receipts.drain(self.backend.upload_shopping_receipt)
+            if uploaded:
+                log.info("Uploaded %i receipts left in the spool", uploaded)
+        finally:
+            self.deadlines.schedule(key, RECEIPT_RETRY_INTERVAL)
+
+    def complete_receipts(self, update, context, digests):
+        """Invoked once all the receipts a volunteer sent in one go are in the spool: a single photo, or a whole
+        album. They are uploaded in parallel, then we move on to the exit survey.
+        :param digests: list of str, the receipts' digests in the spool"""
+        log.debug(
+            "Uploading %i receipts for req:%s", len(digests), context.user_data.current_request
+        )
+        # Note: you can disable this line when testing locally, if you don't have an actual backend that will
+        # serve this request. Only this volunteer's receipts are uploaded here, the ones that failed before are left
+        # to `retry_receipts`
+        self.receipts.drain(
+            self.backend.upload_shopping_receipt, workers=min(len(digests), 4), digests=set(digests)
+        )
+
+        with self.locks.chat(update.effective_chat.id):
+            if context.user_data.state != c.State.EXPECTING_RECEIPT:
+                # another batch of receipts got here first and already started the survey
+                return
+            self.machine.fire(update.effective_chat.id, context.user_data, "receipt")
 
         # if we got this far it means that we're ready to proceed to the exit survey and ask some additional questions
         # about this request
         self.send_exit_survey(update, context)
-        context.user_data["state"] = c.State.EXPECTING_EXIT_SURVEY
+        # albums are completed outside of the handler, which would otherwise mark the change
+        self.mark_dirty((update.effective_chat.id,), (context.user_data.current_request,))
 
     def send_exit_survey(self, update, context):
         """Initiate the questionnaire that asks about the beneficiary's mood and symptoms"""
         chat_id = update.effective_chat.id
-        request_id = context.user_data["current_request"]
+        request_id = context.user_data.current_request
 
-        self.updater.bot.send_message(
+        self.delivery.send_message(
             chat_id=chat_id,
-            text=c.MSG_FEEDBACK_BENEFICIARY_MOOD % context.bot_data[request_id]["beneficiary"],
+            text=c.MSG_FEEDBACK_BENEFICIARY_MOOD % context.bot_data[request_id].beneficiary,
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup(k.wellbeing_choices, one_time_keyboard=True),
+            reply_markup=InlineKeyboardMarkup(
+                k.wellbeing_choices(request_id), one_time_keyboard=True
+            ),
         )
 
-    @run_async
-    def hook_request_assistance(self, data):
-        """This will be invoked by the REST API when a new request for
-        assistance was received from the backend.
-        :param data: dict, the format is defined in `assistance_request`, see readme"""
-        request_id = data["request_id"]
+    def queue_request_assistance(self, request, job=None):
+        """This will be invoked by the REST API when a new request for assistance was received from the backend. The
+        request waits for its turn in `self.broadcasts`, which then calls `hook_request_assistance`
+        :param request: HelpRequest, built from `assistance_request`, see readme
+        :param job: optional jobs.Job, it stays pending while the request is queued"""
+        self.tracer.open(request.request_id)
+        self.broadcasts.put(request, job or jobs.Job("help_request", request.request_id))
+
+    def hook_request_assistance(self, request, job=None):
+        """This is invoked by the broadcast queue when it is the turn of a new request for
+        assistance received from the backend.
+        :param request: HelpRequest, built from `assistance_request`, see readme
+        :param job: optional jobs.Job, where the outcome for each volunteer is recorded"""
+        request_id = request.request_id
+        job = job or jobs.Job("help_request", request_id)
         log.info("NEW request for assistance %s", request_id)
-        volunteers_to_contact = data["volunteers"]
-
-        needs = ""
-        for item in data["needs"]:
-            needs += f"- {item}\n"
+        user_data = self.updater.dispatcher.user_data
+
+        with job, self.tracer.span(request_id, "announce", volunteers=len(request.volunteers)):
+            with self.locks.request(request_id):
+                self.updater.dispatcher.bot_data[request_id] = request
+                # the backend may announce a request again, after it was cancelled or its volunteer gave up
+                if self.announcements.reopen(request_id):
+                    log.info("Request %s is open again", request_id)
+            job.expect(len(request.volunteers))
+            for chat_id in request.volunteers:
+                if not self.is_registered(chat_id):
+                    log.debug(
+                        "User %s hasn't added the updater to their contacts, skipping.", chat_id
+                    )
+                    job.record(chat_id, jobs.SKIPPED_UNKNOWN)
+                    continue
 
-        assistance_request = c.MSG_REQUEST_ANNOUNCEMENT % (data["address"], needs)
+                # the volunteer's session may be loaded or changed by one of their updates right now
+                with self.locks.chat(chat_id):
+                    busy = self.is_busy(user_data[chat_id])
+                if busy:
+                    log.debug("Vol%s is already working on a request, skipping", chat_id)
+                    job.record(chat_id, jobs.SKIPPED_BUSY)
+                    continue
 
-        for chat_id in volunteers_to_contact:
-            if chat_id not in self.updater.persistence.user_data:
-                log.debug("User %s hasn't added the updater to their contacts, skipping.", chat_id)
-                continue
+                # other requests for the same volunteer may follow shortly, they will get a single message; the
+                # job is over once it is sent
+                job.record(chat_id, jobs.BATCHED)
+                job.hold()
+                self.digests.add(chat_id, (request, job))
 
-            current_state = self.updater.persistence.user_data[chat_id].get("state", None)
+            self.mark_dirty(request_ids=(request_id,))
 
-            if current_state in [c.State.REQUEST_IN_PROGRESS, c.State.REQUEST_ASSIGNED]:
-                log.debug("Vol%s is already working on a request, skippint")
-                continue
+    def send_announcements(self, chat_id, items):
+        """Invoked by the digest buffer with the requests collected for a volunteer: a single request is announced
+        as usual, several requests are announced in one message, where the volunteer picks one of them
+        :param chat_id: int, the volunteer
+        :param items: list of (HelpRequest, jobs.Job) tuples, the most urgent first"""
+        try:
+            self.announce(chat_id, items)
+        finally:
+            for _, job in items:
+                job.release()
+
+    def announce(self, chat_id, items):
+        """Send the announcements collected for a volunteer, see `send_announcements`"""
+        with self.locks.chat(chat_id):
+            session = self.updater.dispatcher.user_data[chat_id]
+            relevant = []
+            for request, job in items:
+                if self.announcements.is_withdrawn(request.request_id):
+                    job.record(chat_id, jobs.WITHDRAWN)
+                elif self.is_busy(session):
+                    job.record(chat_id, jobs.SKIPPED_BUSY)
+                else:
+                    relevant.append((request, job))
+            if not relevant:
+                return
 
-            self.updater.bot.send_message(
-                chat_id=chat_id,
-                text=assistance_request,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=ReplyKeyboardMarkup(k.initial_responses, one_time_keyboard=True),
+            requests = [request for request, _ in relevant]
+            # a volunteer who has yet to answer another announcement gets a digest, its buttons name the request they
+            # refer to, while /Da and /Nu keep referring to the one they are looking at
+            if len(requests) == 1 and self.reviewing(session) is None:
+                text = self.render_announcement(requests[0])
+                tag = ("announcement", requests[0].request_id)
+                markup = ReplyKeyboardMarkup(k.initial_responses, one_time_keyboard=True)
+            else:
+                text = self.render_digest(requests)
+                tag = ("digest", tuple(request.request_id for request in requests))
+                markup = InlineKeyboardMarkup(k.digest_choices(requests))
+
+            job = relevant[0][1]
+            # a digest is traced as part of its first request
+            span = self.tracer.span(
+                requests[0].request_id, "announce.send", chat_id=chat_id, requests=len(requests)
             )
+            try:
+                with span:
+                    message = self.deliver(
+                        job,
+                        chat_id,
+                        text,
+                        tag=tag,
+                        parse_mode=ParseMode.MARKDOWN,
+                        reply_markup=markup,
+                    )
+            except TelegramError as err:
+                log.warning("Could not announce %s to @%s: %s", tag, chat_id, err)
+                message = None
+
+            # the other requests in the digest share the fate of the first one
+            outcome, elapsed, error = job.recipients[chat_id]
+            for _, other in relevant[1:]:
+                other.record(chat_id, outcome, elapsed, error)
+
+            if message is not None:
+                if tag[0] == "announcement":
+                    self.record_announcement(tag[1], chat_id, message)
+                else:
+                    self.record_digest(tag[1], chat_id, message)
+                self.mark_dirty((chat_id,), [request.request_id for request in requests])
 
-            # update this user's state and keep the request_id as well, so we can use it later
-            updated_state = {"state": c.State.REQUEST_SENT, "reviewed_request": request_id}
-            self.updater.dispatcher.user_data[chat_id].update(updated_state)
+    @staticmethod
+    def render_announcement(request):
+        """Compose the announcement of a single request
+        :param request: HelpRequest
+        :returns: str, Markdown text"""
+        needs = ""
+        for item in request.needs:
+            needs += f"- {item}\n"
+        return c.MSG_REQUEST_ANNOUNCEMENT % (request.address, needs)
 
-        self.updater.dispatcher.bot_data.update({request_id: data})
-        self.updater.dispatcher.update_persistence()
+    @staticmethod
+    def render_digest(requests):
+        """Compose the announcement of several requests, they are numbered in the same order as the buttons of
+        `keyboards.digest_choices`
+        :param requests: list of HelpRequest
+        :returns: str, Markdown text"""
+        items = ""
+        for number, request in enumerate(requests, 1):
+            items += c.MSG_DIGEST_ITEM % (number, request.address, ", ".join(request.needs))
+        return c.MSG_DIGEST % items
+
+    def record_announcement(self, request_id, chat_id, message):
+        """Remember that a volunteer got the announcement about a request, such that it can be withdrawn later"""
+        self.announcements.record(request_id, chat_id, message.message_id)
+        self.tracer.mark(request_id, "announced")
+
+        # update this user's state and keep the request_id as well, so we can use it later
+        session = self.updater.dispatcher.user_data[chat_id]
+        if self.machine.fire(chat_id, session, "announce"):
+            session.reviewed_request = request_id
+
+    def record_digest(self, request_ids, chat_id, message):
+        """Remember that a volunteer got a digest; the request under review is left as it is, the volunteer chooses
+        one of the requests with the digest's buttons"""
+        self.announcements.record_digest(request_ids, chat_id, message.message_id)
+        for request_id in request_ids:
+            self.tracer.mark(request_id, "announced")
+        session = self.updater.dispatcher.user_data[chat_id]
+        # while they are looking at another request, they stay where they are in the conversation about it
+        if self.reviewing(session) is None:
+            self.machine.fire(chat_id, session, "announce")
+
+    def on_digest_delivered(self, tag, chat_id, message):
+        """Invoked by the delivery layer when a digest that could not be sent right away got through"""
+        with self.locks.chat(chat_id):
+            self.record_digest(tag[1], chat_id, message)
+        self.mark_dirty((chat_id,), tag[1])
+
+    def is_stale_digest(self, tag, chat_id):
+        """Invoked by the delivery layer before retrying a digest, it is pointless to send it once all of its requests
+        were withdrawn, or if the volunteer took on another request in the meantime"""
+        if all(self.announcements.is_withdrawn(request_id) for request_id in tag[1]):
+            return True
+        return self.is_busy(self.updater.dispatcher.user_data[chat_id])
+
+    def on_announcement_delivered(self, tag, chat_id, message):
+        """Invoked by the delivery layer when an announcement that could not be sent right away got through"""
+        with self.locks.chat(chat_id):
+            self.record_announcement(tag[1], chat_id, message)
+        self.mark_dirty((chat_id,), (tag[1],))
+
+    def is_stale_announcement(self, tag, chat_id):
+        """Invoked by the delivery layer before retrying an announcement, it tells whether it is pointless to send it
+        by now, i.e. the request was withdrawn or the volunteer took on another request in the meantime. It is also
+        dropped if they are looking at another announcement, otherwise their /Da and /Nu would refer to this one"""
+        if self.announcements.is_withdrawn(tag[1]):
+            return True
+        session = self.updater.dispatcher.user_data[chat_id]
+        return self.is_busy(session) or self.reviewing(session) not in (None, tag[1])
+
+    def is_registered(self, chat_id):
+        """Tell whether a chat belongs to a volunteer. The directory answers from memory; until it is ready, the
+        volunteers who have a session with the bot are considered registered, which may cost a trip to the disk
+        with LazyPersistence"""
+        if self.directory.ready:
+            return chat_id in self.directory
+        return chat_id in self.updater.dispatcher.user_data
+
+    def is_busy(self, session):
+        """Tell whether a volunteer must not get new announcements, because they are handling a request or they're
+        in the middle of a questionnaire"""
+        return not self.machine.allows(session.state, "announce")
+
+    def reviewing(self, session):
+        """Return the request a volunteer is looking at: an announcement they haven't answered yet, or a request
+        they offered a time for; None if there is none, or it is no longer open"""
+        request_id = session.reviewed_request
+        if session.state not in REVIEWING or request_id is None:
+            return None
+        if self.announcements.is_withdrawn(request_id):
+            return None
+        return request_id
 
     def hook_introspect(self):
         """Return a dictionary with the user_data and bot_data, to make introspection easier"""
-        # NOTE that this doesn't use @run_async, unlike other hooks, because it has to return right away
+        # NOTE that this doesn't run in the background, unlike other hooks, because it has to return right away
         user_state = self.updater.persistence.user_data
         bot_state = self.updater.persistence.bot_data
-        return {"volunteers": user_state, "requests": bot_state}
+        return {
+            "volunteers": user_state,
+            "requests": bot_state,
+            "callbacks": self.callbacks.stats(),
+            "delivery": self.delivery.stats(),
+            "receipts": self.receipts.stats(),
+            "time_in_state": {
+                chat_id: self.machine.time_in_state(chat_id)
+                for chat_id in list(self.machine.histograms)
+            },
+        }
+
+    def memory_usage(self):
+        """Return the size of each part of the state, and of the bot's own buffers, see `memory.py`"""
+        dispatcher = self.updater.dispatcher
+        sizes = memory.state_sizes(dispatcher.user_data, dispatcher.bot_data)
+        sizes["buffers"] = {
+            "digests": memory.deep_size(self.digests.pending),
+            "delivery": memory.deep_size((self.delivery.queue, self.delivery.suppressed)),
+            "traces": memory.deep_size(self.tracer.traces),
+            "conversations": memory.deep_size(
+                (self.machine.entered, self.machine.histograms, self.machine.durations)
+            ),
+            "jobs": memory.deep_size(self.rest.jobs.jobs),
+            "deadlines": memory.deep_size(self.deadlines.wheel),
+        }
+        return sizes
+
+    def footprint(self):
+        """Return the resources used by this bot, to compare several bots running in the same process"""
+        dispatcher = self.updater.dispatcher
+        prefix = "Bot:%s:" % self.updater.bot.id
+        disk = self.receipts.size
+        for path in (self.delivery.path, self.deadlines.path):
+            if os.path.exists(path):
+                disk += os.path.getsize(path)
+        return {
+            "volunteers": len(dispatcher.user_data),
+            "requests": sum(
+                isinstance(item, models.HelpRequest) for item in dispatcher.bot_data.values()
+            ),
+            "threads": sum(thread.name.startswith(prefix) for thread in enumerate_threads()),
+            "jobs": len(self.rest.jobs),
+            "delivery": self.delivery.stats(),
+            "receipts": self.receipts.stats(),
+            "broadcasts": self.broadcasts.stats(),
+            "digests": len(self.digests),
+            "conversations": self.machine.stats(),
+            "directory": self.directory.stats(),
+            "locks": self.locks.stats(),
+            "queued_updates": 0 if self.chat_queues is None else len(self.chat_queues),
+            "workers": self.scaler.stats(),
+            "persistence": self.flusher.stats(),
+            "deadlines": self.deadlines.stats(),
+            "disk_bytes": disk,
+        }
 
-    @run_async
-    def hook_cancel_assistance(self, data):
+    @in_background
+    def hook_cancel_assistance(self, data, job=None):
         """This will be invoked by the REST API when an assigned request for
         assistance was CANCELED from the backend.
-        :param data: dict, see `cancel_help_request` in the readme"""
+        :param data: dict, see `cancel_help_request` in the readme
+        :param job: optional jobs.Job, where the outcome for each volunteer is recorded"""
         request_id = data["request_id"]
         assignee_chat_id = data["volunteer"]
+        job = job or jobs.Job("cancel_help_request", request_id)
         log.info("CANCEL req:%s", request_id)
-        self.send_message(assignee_chat_id, c.MSG_REQUEST_CANCELED)
-
-        self.updater.dispatcher.user_data[assignee_chat_id].update(
-            {"current_request": None, "reviewed_request": None, "state": c.State.AVAILABLE}
-        )
-        del self.updater.dispatcher.bot_data[request_id]
-        self.updater.dispatcher.update_persistence()
 
-    @run_async
-    def hook_assign_assistance(self, data):
+        with job, self.tracer.span(request_id, "cancel"):
+            # the others might still be looking at the announcement, take it back and release them
+            announced, _ = self.withdraw_announcements(request_id, c.MSG_REQUEST_CANCELED, job)
+            job.expect(len(set(announced) | {assignee_chat_id}))
+            for chat_id in announced:
+                if chat_id == assignee_chat_id:
+                    continue
+                with self.locks.chat(chat_id):
+                    session = self.updater.dispatcher.user_data[chat_id]
+                    if session.reviewed_request == request_id:
+                        self.machine.fire(chat_id, session, "withdraw")
+                        session.reviewed_request = None
+
+            with self.locks.chat(assignee_chat_id):
+                assignee = self.updater.dispatcher.user_data[assignee_chat_id]
+                self.machine.fire(assignee_chat_id, assignee, "release")
+                assignee.release()
+            with self.locks.request(request_id):
+                self.updater.dispatcher.bot_data.pop(request_id, None)
+            self.mark_dirty(set(announced) | {assignee_chat_id}, (request_id,))
+
+            try:
+                self.deliver(job, assignee_chat_id, c.MSG_REQUEST_CANCELED)
+            except TelegramError as err:
+                log.warning("Could not notify @%s about cancellation: %s", assignee_chat_id, err)
+        self.tracer.close(request_id, "cancelled")
+
+    @in_background
+    def hook_assign_assistance(self, data, job=None):
         """This will be invoked by the REST API when a new request for
         assistance was ASSIGNED to a specific volunteer.
-        :param data: dict, see `assign_assistance` in the readme"""
+        :param data: dict, see `assign_assistance` in the readme
+        :param job: optional jobs.Job, where the outcome for each volunteer is recorded"""
         request_id = data["request_id"]
         assignee_chat_id = data["volunteer"]
+        job = job or jobs.Job("assign_help_request", request_id)
         log.info("ASSIGN req:%s to vol:%s", request_id, assignee_chat_id)
 
-        try:
-            request_details = self.updater.persistence.bot_data[request_id]
-        except KeyError:
-            log.debug("No such request %s, ignoring", request_id)
-            return
-        else:
-            self.updater.dispatcher.bot_data[request_id].update(
-                {"time": utc_short_to_user_short(data["time"])}
+        with job, self.tracer.span(request_id, "assign", chat_id=assignee_chat_id):
+            with self.locks.request(request_id):
+                try:
+                    request = self.updater.dispatcher.bot_data[request_id]
+                except KeyError:
+                    log.debug("No such request %s, ignoring", request_id)
+                    job.error = "Unknown request"
+                    return
+                else:
+                    request.time = utc_short_to_user_short(data["time"])
+
+            user_data = self.updater.dispatcher.user_data
+            with self.locks.chat(assignee_chat_id):
+                assignee = user_data[assignee_chat_id]
+                assigned = self.machine.fire(assignee_chat_id, assignee, "assign")
+                if assigned:
+                    assignee.reviewed_request = request_id
+                    assignee.current_request = request_id
+                else:
+                    job.error = "Volunteer is busy"
+            if assigned:
+                self.tracer.mark(request_id, "assigned")
+
+            # first of all, take back the announcements, notify the others that they are off the hook and update
+            # their state accordingly; the backend assigned the request either way, it is no longer open to them
+            announced, deleted = self.withdraw_announcements(
+                request_id, c.MSG_ANOTHER_ASSIGNEE, job, keep=assignee_chat_id
+            )
+            job.expect(len(set(announced) | {assignee_chat_id}))
+            notices = []
+            for chat_id in dict.fromkeys(announced):
+                if chat_id == assignee_chat_id:
+                    continue
+                with self.locks.chat(chat_id):
+                    session = user_data[chat_id]
+                    reviewing = session.reviewed_request == request_id
+                    if reviewing:
+                        self.machine.fire(chat_id, session, "withdraw")
+                        session.reviewed_request = None
+                # an announcement that could not be deleted already shows the notice
+                if chat_id in deleted:
+                    # deleting the announcement leaves its /Da and /Nu keyboard behind
+                    markup = ReplyKeyboardRemove() if reviewing else None
+                    notices.append(
+                        (
+                            self.delivery.send_message,
+                            (chat_id, c.MSG_ANOTHER_ASSIGNEE),
+                            {"reply_markup": markup},
+                        )
+                    )
+            # the notices are not part of the job, its outcome for these volunteers is that of the withdrawal
+            for (_, args, _), result in zip(notices, self.sender.run_all(notices)):
+                if result.exception() is not None:
+                    log.debug("Could not notify @%s: %s", args[0], result.exception())
+            self.mark_dirty(set(announced) | {assignee_chat_id}, (request_id,))
+            if not assigned:
+                return
+
+            # notify the assigned volunteer, so they know they're responsible; at this point they still have to
+            # confirm that they're in good health and they still have an option to cancel
+            self.deliver(
+                job,
+                assignee_chat_id,
+                c.MSG_CAUTION,
+                reply_markup=InlineKeyboardMarkup(k.caution_choices(request_id)),
             )
 
-        # first of all, notify the others that they are off the hook and update their state accordingly
-        for chat_id in request_details["volunteers"]:
-            if chat_id != assignee_chat_id:
-                self.send_message(chat_id, c.MSG_ANOTHER_ASSIGNEE)
-                updated_state = {"state": c.State.AVAILABLE, "reviewed_request": None}
-                self.updater.dispatcher.user_data[chat_id].update(updated_state)
-
-        self.updater.dispatcher.user_data[assignee_chat_id].update({"current_request": request_id})
-        self.updater.dispatcher.update_persistence()
-
-        # notify the assigned volunteer, so they know they're responsible; at this point they still have to confirm
-        # that they're in good health and they still have an option to cancel
-        self.updater.bot.send_message(
-            chat_id=assignee_chat_id,
-            text=c.MSG_CAUTION,
-            reply_markup=InlineKeyboardMarkup(k.caution_choices),
+    def withdraw_announcements(self, request_id, notice, job=None, keep=None):
+        """Delete the announcements about a request, so that volunteers can no longer respond to it. The deletions
+        are performed in parallel; since Telegram only allows deleting messages that are less than 48h old, the
+        announcements that can't be deleted are edited to show `notice` instead.
+        :param request_id: str, identifier of request
+        :param notice: str, the text that replaces an announcement that could not be deleted
+        :param job: optional jobs.Job, where the outcome of each withdrawal is recorded
+        :param keep: optional int, chat_id whose announcement will be left intact (e.g. the assignee's)
+        :returns: tuple(list of chat_ids that got an announcement about this request, set of chat_ids whose
+                  announcements were all deleted)"""
+        announced = self.announcements.withdraw(request_id)
+        bot = self.updater.bot
+        job = job or jobs.Job("withdraw", request_id)
+
+        # a digest that lists other requests that are still open stays, its button for this request is ignored
+        calls = [
+            (job.call, (chat_id, jobs.WITHDRAWN, bot.delete_message, chat_id, message_id), {})
+            for chat_id, message_id in announced
+            if chat_id != keep and self.announcements.release(chat_id, message_id)
+        ]
+        deleted, kept = set(), set()
+        fallback = []
+        for (_, args, _), result in zip(calls, self.sender.run_all(calls)):
+            if result.exception() is None:
+                deleted.add(args[0])
+            else:
+                kept.add(args[0])
+                fallback.append(
+                    (
+                        job.call,
+                        (args[0], jobs.EDITED, bot.edit_message_text, notice),
+                        {"chat_id": args[0], "message_id": args[4]},
+                    )
+                )
+        for (_, _, kwargs), result in zip(fallback, self.sender.run_all(fallback)):
+            if result.exception() is not None:
+                log.debug("Could not withdraw msg %s @%s", kwargs["message_id"], kwargs["chat_id"])
+
+        log.info("Withdrew %i announcements for req:%s", len(calls), request_id)
+        return [chat_id for chat_id, _ in announced], deleted - kept
+
+    def deliver(self, job, chat_id, text, tag=None, **kwargs):
+        """Send a message that is part of a fan-out, recording the outcome in the job: it can be sent right away,
+        deferred for a retry, or skipped because the chat is unreachable
+        :param job: jobs.Job
+        :param chat_id: int, the recipient
+        :param text: str, the message
+        :param tag: optional tuple, see `Delivery.send_message`
+        :returns: the Message, or None if it wasn't sent (yet)
+        :raises TelegramError: if the message cannot be sent and retrying won't help"""
+        if self.delivery.is_suppressed(chat_id):
+            job.record(chat_id, jobs.SKIPPED_BLOCKED)
+            return None
+
+        message = job.call(
+            chat_id, jobs.SENT, self.delivery.send_message, chat_id, text, tag, **kwargs
         )
+        if message is None:
+            blocked = self.delivery.is_suppressed(chat_id)
+            job.record(chat_id, jobs.SKIPPED_BLOCKED if blocked else jobs.DEFERRED)
+        return message
 
-    @run_async
+    @in_background
     def send_message(self, chat_id, text):
         """Send a message to a specific chat session. Note that this is an async sender, these messages may arrive
         slightly out of order
         :param chat_id: int, chat identifier
         :param text: str, the text to be sent to the user"""
-        self.updater.bot.sendMessage(chat_id=chat_id, text=text)
+        self.delivery.send_message(chat_id, text)
         log.info("Send msg @%s: %s..", chat_id, text[:20])
 
     def send_message_ex(self, chat_id, text, parse_mode=ParseMode.MARKDOWN):
@@ -776,5 +1641,5 @@ class Ajubot:
         :param chat_id: int, chat identifier
         :param text: str, the text to be sent to the user
         :param parse_mode: e.g. ParseMode.MARKDOWN"""
-        self.updater.bot.sendMessage(chat_id=chat_id, text=text, parse_mode=parse_mode)
+        self.delivery.send_message(chat_id, text, parse_mode=parse_mode)
         log.info("SendEx msg @%s: %s..", chat_id, text[:20])
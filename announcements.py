@@ -0,0 +1,152 @@
+"""Keeps track of the announcements that were sent to volunteers for each request for assistance. When a request is
+assigned or cancelled, these messages are withdrawn, so that volunteers do not keep responding to a request that is
+no longer available.
+
+A digest (see `digests.py`) is a single message that announces several requests; it is only taken down once all of
+them were withdrawn.
+
+The log is stored in `bot_data`, so it is persisted along with the rest of the bot's state."""
+
+from array import array
+from collections import OrderedDict
+from threading import Lock
+
+# How many withdrawn request IDs we remember, in order to reject late responses to them
+WITHDRAWN_HISTORY = 4096
+
+
+class AnnouncementLog:
+    """Compact mapping of request_id -> [(chat_id, message_id), ...]. Each request is stored as a flat array of
+    64-bit integers: chat_id0, message_id0, chat_id1, message_id1, etc."""
+
+    def __init__(self):
+        self.sent = {}
+        self.withdrawn = OrderedDict()
+        # (chat_id, message_id) of a digest -> how many of the requests it lists are still open
+        self.shared = {}
+        self.lock = Lock()
+
+    def __getstate__(self):
+        """Called when the log is pickled, the lock cannot be serialized, so we leave it out"""
+        return {"sent": self.sent, "withdrawn": self.withdrawn, "shared": self.shared}
+
+    def __setstate__(self, state):
+        """Called when the log is unpickled, the lock is recreated"""
+        self.sent = state["sent"]
+        self.withdrawn = state["withdrawn"]
+        self.shared = state.get("shared", {})
+        self.lock = Lock()
+
+    def record(self, request_id, chat_id, message_id):
+        """Remember that an announcement about a request was sent to a volunteer
+        :param request_id: str, identifier of request
+        :param chat_id: int, the volunteer who got the announcement
+        :param message_id: int, the identifier of the message that contains the announcement"""
+        with self.lock:
+            entries = self.sent.get(request_id)
+            if entries is None:
+                entries = self.sent[request_id] = array("q")
+            entries.append(chat_id)
+            entries.append(message_id)
+
+    def record_digest(self, request_ids, chat_id, message_id):
+        """Remember that a single message announced several requests to a volunteer
+        :param request_ids: list of str, the requests listed in the message"""
+        for request_id in request_ids:
+            self.record(request_id, chat_id, message_id)
+        with self.lock:
+            self.shared[(chat_id, message_id)] = len(request_ids)
+
+    def release(self, chat_id, message_id):
+        """Invoked for each announcement returned by `withdraw`, it tells whether the message can be taken down
+        :returns: bool, False if it is a digest that still lists requests that are open"""
+        key = (chat_id, message_id)
+        with self.lock:
+            remaining = self.shared.get(key)
+            if remaining is None:
+                return True
+            if remaining > 1:
+                self.shared[key] = remaining - 1
+                return False
+            del self.shared[key]
+            return True
+
+    def withdraw(self, request_id):
+        """Mark a request as withdrawn and return the announcements that were sent about it
+        :param request_id: str, identifier of request
+        :returns: list of (chat_id, message_id) tuples, it is empty if nothing was sent"""
+        with self.lock:
+            entries = self.sent.pop(request_id, ())
+            self.withdrawn[request_id] = True
+            self.withdrawn.move_to_end(request_id)
+            while len(self.withdrawn) > WITHDRAWN_HISTORY:
+                self.withdrawn.popitem(last=False)
+
+        return list(zip(entries[::2], entries[1::2]))
+
+    def reopen(self, request_id):
+        """Make a withdrawn request open to offers again, e.g. the backend announces it anew after the volunteer it
+        was assigned to gave up; the announcements of the earlier round are forgotten, they were taken down when it
+        was withdrawn
+        :param request_id: str, identifier of request
+        :returns: bool, True if the request had been withdrawn"""
+        with self.lock:
+            self.sent.pop(request_id, None)
+            return self.withdrawn.pop(request_id, None) is not None
+
+    def to_dict(self):
+        """Return the log as plain lists and dicts, e.g. to export it as JSON, see `statedump.py`"""
+        with self.lock:
+            return {
+                "sent": {request_id: entries.tolist() for request_id, entries in self.sent.items()},
+                "withdrawn": list(self.withdrawn),
+                "shared": [
+                    [chat_id, message_id, count]
+                    for (chat_id, message_id), count in self.shared.items()
+                ],
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a log out of what `to_dict` returned
+        :raises ValueError: if the data does not have the expected layout"""
+        if not isinstance(data, dict):
+            raise ValueError("Expected a JSON object")
+        sent, withdrawn, shared = (
+            data.get("sent", {}),
+            data.get("withdrawn", []),
+            data.get("shared", []),
+        )
+        if not isinstance(sent, dict) or not all(
+            isinstance(entries, list)
+            and len(entries) % 2 == 0
+            and all(isinstance(number, int) and not isinstance(number, bool) for number in entries)
+            for entries in sent.values()
+        ):
+            raise ValueError("Field `sent` must map request IDs to pairs of chat and message IDs")
+        if not isinstance(withdrawn, list) or not all(isinstance(item, str) for item in withdrawn):
+            raise ValueError("Field `withdrawn` must be a list of request IDs")
+        if not isinstance(shared, list) or not all(
+            isinstance(item, list)
+            and len(item) == 3
+            and all(isinstance(number, int) and not isinstance(number, bool) for number in item)
+            for item in shared
+        ):
+            raise ValueError("Field `shared` must be a list of [chat_id, message_id, count]")
+
+        log = cls()
+        try:
+            log.sent = {request_id: array("q", entries) for request_id, entries in sent.items()}
+        except OverflowError as err:
+            raise ValueError("Field `sent` has an ID that does not fit in 64 bits") from err
+        log.withdrawn = OrderedDict.fromkeys(withdrawn, True)
+        log.shared = {(chat_id, message_id): count for chat_id, message_id, count in shared}
+        return log
+
+    def is_withdrawn(self, request_id):
+        """Tell whether a request was withdrawn, i.e. it is no longer open to offers
+        :param request_id: str, identifier of request"""
+        return request_id in self.withdrawn
+
+    def __len__(self):
+        return len(self.sent)
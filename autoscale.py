@@ -0,0 +1,181 @@
+"""Sizing of the dispatcher's pool of workers, the threads behind `in_background` and, with `concurrent_updates`,
+behind the handlers too. The pool is created with a fixed number of workers; during the morning peak the work backs
+up, at night most of them sit idle. `WorkerScaler` adds workers when the work waits too long and removes them once
+it stays idle for a while.
+
+Every `interval` seconds it looks at
+- the lag: how long a probe sent to the workers waits before one of them picks it up; while a probe is still on its
+  way, the time it has waited so far counts
+- the backlog: the updates waiting for the dispatcher and the work waiting for a worker
+
+The pool grows by half of its size once the lag is above `high_lag` or the backlog is larger than the pool, for
+`grow_after` samples in a row; it shrinks by one worker once the lag is below `low_lag` and nothing is waiting, for
+`shrink_after` samples in a row. The different thresholds and the longer wait before shrinking keep the pool from
+flapping when the load hovers around a threshold.
+
+The pool is a private part of `telegram.ext.Dispatcher` (v12): workers are added by starting more threads that run
+its own loop, and removed by queueing the same sentinel it uses when it stops."""
+
+import logging
+import time
+from collections import deque
+from itertools import count
+from threading import Event, Lock, Thread
+
+from stats import percentile_ms
+
+log = logging.getLogger("autoscale")  # pylint: disable=invalid-name
+
+# Seconds between two samples
+DEFAULT_INTERVAL = 1.0
+# Upper bound of the pool, unless told otherwise
+DEFAULT_MAXIMUM = 16
+# Seconds of lag above which the pool grows, and below which it may shrink
+HIGH_LAG = 0.5
+LOW_LAG = 0.05
+# How many samples in a row must agree before the pool grows or shrinks
+GROW_AFTER = 2
+SHRINK_AFTER = 30
+# How many lags are kept, for the percentiles
+LAG_SAMPLES = 256
+
+
+class WorkerScaler:
+    """Grows and shrinks the pool of workers of a dispatcher, between a lower and an upper bound"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self, dispatcher, maximum=None, minimum=None, interval=DEFAULT_INTERVAL,
+    ):
+        """Initialize the scaler, nothing changes until `start` is invoked
+        :param dispatcher: telegram.ext.Dispatcher
+        :param maximum: optional int, the most workers, by default the pool keeps its initial size
+        :param minimum: optional int, the fewest workers, the initial size of the pool by default
+        :param interval: float, seconds between two samples"""
+        self.dispatcher = dispatcher
+        self.minimum = dispatcher.workers if minimum is None else minimum
+        self.maximum = max(self.minimum, dispatcher.workers if maximum is None else maximum)
+        self.interval = interval
+        # pylint: disable=protected-access
+        self.work_queue = dispatcher._Dispatcher__async_queue
+        self.threads = dispatcher._Dispatcher__async_threads
+        self.size = dispatcher.workers
+        self.names = count()
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        # perf_counter() when the probe on its way was sent, None if there is none
+        self.probe_sent = None
+        self.lag = 0.0
+        self.lags = deque(maxlen=LAG_SAMPLES)
+        self.busy = 0
+        self.idle = 0
+        self.grown = 0
+        self.shrunk = 0
+
+    def start(self):
+        """Sample the load in the background"""
+        if self.thread is not None:
+            return
+        self.thread = Thread(target=self.run, name="autoscale", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Body of the background thread"""
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:  # pylint: disable=broad-except
+                # this runs in its own thread, nobody else would hear about it
+                log.exception("Could not resize the pool")
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def probe(self, sent):
+        """Runs on a worker, it measures how long it waited for one"""
+        self.lag = time.perf_counter() - sent
+        self.lags.append(self.lag)
+        self.probe_sent = None
+
+    def current_lag(self):
+        """Return the lag in seconds: the last one measured, or the wait of the probe on its way, if that is longer"""
+        sent = self.probe_sent
+        if sent is None:
+            return self.lag
+        return max(self.lag, time.perf_counter() - sent)
+
+    def backlog(self):
+        """Return how many updates and pieces of work are waiting"""
+        return self.dispatcher.update_queue.qsize() + self.work_queue.qsize()
+
+    def sample(self):
+        """Look at the load and resize the pool if needed
+        :returns: int, how many workers were added (positive) or removed (negative)"""
+        if not self.dispatcher.running:
+            # the dispatcher's own threads come and go with it
+            return 0
+
+        lag, backlog = self.current_lag(), self.backlog()
+        if self.probe_sent is None:
+            self.probe_sent = time.perf_counter()
+            self.dispatcher.run_async(self.probe, self.probe_sent)
+
+        self.busy = self.busy + 1 if lag >= HIGH_LAG or backlog > self.size else 0
+        self.idle = self.idle + 1 if lag <= LOW_LAG and backlog == 0 else 0
+        if self.busy >= GROW_AFTER and self.size < self.maximum:
+            return self.resize(min(self.maximum, self.size + max(1, self.size // 2)), lag, backlog)
+        if self.idle >= SHRINK_AFTER and self.size > self.minimum:
+            return self.resize(self.size - 1, lag, backlog)
+        return 0
+
+    def resize(self, size, lag=0.0, backlog=0):
+        """Add or remove workers, such that there are `size` of them
+        :returns: int, how many workers were added (positive) or removed (negative)"""
+        with self.lock:
+            change = size - self.size
+            # the threads of the workers that were removed are gone by now
+            self.threads.difference_update(
+                [thread for thread in list(self.threads) if not thread.is_alive()]
+            )
+            for _ in range(change):
+                thread = Thread(
+                    # pylint: disable=protected-access
+                    target=self.dispatcher._pooled,
+                    name="Bot:%s:worker:scaled_%i" % (self.dispatcher.bot.id, next(self.names)),
+                    # the dispatcher may be stopping, it must not wait for a worker it doesn't know about
+                    daemon=True,
+                )
+                self.threads.add(thread)
+                thread.start()
+            for _ in range(-change):
+                # one of the workers takes it and quits, once it is done with the work queued before it
+                self.work_queue.put(None)
+            self.size = size
+            self.busy = self.idle = 0
+            if change > 0:
+                self.grown += 1
+            elif change < 0:
+                self.shrunk += 1
+        log.info(
+            "Workers: %i (%+i), lag %.0f ms, %i waiting", size, change, lag * 1000, backlog,
+        )
+        return change
+
+    def stats(self):
+        """Return the size of the pool, how long the work waits for a worker and how often the pool was resized"""
+        lags = sorted(self.lags)
+        return {
+            "workers": self.size,
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+            "waiting_updates": self.dispatcher.update_queue.qsize(),
+            "waiting_work": self.work_queue.qsize(),
+            "lag_ms": round(self.current_lag() * 1000, 1),
+            "p50_lag_ms": percentile_ms(lags, 0.5),
+            "p95_lag_ms": percentile_ms(lags, 0.95),
+            "grown": self.grown,
+            "shrunk": self.shrunk,
+        }
@@ -10,52 +10,86 @@ The easiest way to work on this client is to run `python backend_api.py`, adjust
 `if __name__ == "__main__"` - this way you can test it without touching any Telegram functionality whatsoever."""
 
 import logging
-import base64
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import constants as c
+import serialization
+import tracing
 
 log = logging.getLogger("back")  # pylint: disable=invalid-name
 
+# Connections kept alive by a client, see `Backender.__init__`
+DEFAULT_POOL_SIZE = 10
+# Volunteers fetched per call by `list_volunteers`
+VOLUNTEER_PAGE_SIZE = 500
+
 
 class Backender:
     """This is a client that talks to the backend, transmitting information from the Telegram bot"""
 
-    def __init__(self, url, username, password):
-        """Initialize the backend REST API client"""
+    def __init__(self, url, username, password, pool_size=DEFAULT_POOL_SIZE):
+        """Initialize the backend REST API client
+        :param pool_size: int, how many connections to the backend are kept open for reuse; the client is safe to
+                          share between several bots, in which case this should be large enough for all of them"""
         self.base_url = url
         self.username = username
         self.password = password
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def _get(self, url):
         """Function for internal use, that sends GET requests to the server
         :param url: str, this will be added to the base_url to which the request is sent"""
-        res = requests.get(self.base_url + url, auth=(self.username, self.password))
+        with tracing.child("backend.GET", url=url.split("?")[0]):
+            res = self.session.get(self.base_url + url, headers=tracing.headers())
         # log.debug('Got %s', res.status_code)
         if res.status_code == 200:
             return res
 
         raise ValueError("Bad response")
 
+    @staticmethod
+    def _encode(payload):
+        """Serialize a payload, unless it is JSON already, see `serialization.py`
+        :param payload: dict, or bytes with the JSON"""
+        return payload if isinstance(payload, bytes) else serialization.dumps(payload)
+
+    @staticmethod
+    def _headers():
+        headers = tracing.headers()
+        headers["Content-Type"] = serialization.CONTENT_TYPE
+        return headers
+
     def _post(self, payload, url=""):
         """Function for internal use, it sends POST requests to the server
-        :param payload: what needs to be sent within the POST request
-        :param url: str, this will be added to the base_url to which the request is sent"""
-        requests.post(self.base_url + url, auth=(self.username, self.password), json=payload)
+        :param payload: what needs to be sent within the POST request, a dict or bytes with the JSON
+        :param url: str, this will be added to the base_url to which the request is sent
+        :returns: requests.Response"""
+        with tracing.child("backend.POST", url=url):
+            return self.session.post(
+                self.base_url + url, data=self._encode(payload), headers=self._headers()
+            )
 
     def _put(self, payload, url=""):
         """Function for internal use, it sends PUT requests to the server
         :param payload: what needs to be sent within the PUT request
         :param url: str, this will be added to the base_url to which the request is sent"""
-        requests.put(self.base_url + url, auth=(self.username, self.password), json=payload)
+        with tracing.child("backend.PUT", url=url):
+            self.session.put(
+                self.base_url + url, data=self._encode(payload), headers=self._headers()
+            )
 
     def get_request_details(self, request_id):
         """Retrieve the details of a request
         :param request_id: str, request id
         :returns: dict with the metadata"""
         response = self._get("beneficiary/filters/1/10?id=" + request_id)
-        raw = response.json()
+        raw = serialization.loads(response.content)
 
         # if there are no results, it means that such a request ID doesn't exist
         if raw["count"] == 0:
@@ -73,7 +107,28 @@ class Backender:
         :returns: bool, True if the user is known to the backend, otherwise False"""
         log.debug("Link vol:%s to chat %s and tel %s", nickname, chat_id, phone)
         response = self._get(url=f"volunteer?telegram_chat_id={chat_id}")
-        return response.json()["exists"] if "exists" in response else False
+        return bool(serialization.loads(response.content).get("exists", False))
+
+    def list_volunteers(self, since=None, page_size=VOLUNTEER_PAGE_SIZE):
+        """Retrieve the volunteers who use the bot, or only the ones that changed since a previous call. This is
+        what `directory.VolunteerDirectory` is kept up to date with.
+        :param since: optional str, the cursor returned by a previous call; if None, all the volunteers are returned
+        :param page_size: int, how many volunteers are fetched per call to the backend
+        :returns: tuple (list of dicts, cursor for the next call), each dict has the `telegram_chat_id`, `phone`,
+                  `activities` and `status` of a volunteer; the ones that were removed have the `deleted` status"""
+        volunteers = []
+        cursor = since
+        page = 1
+        while True:
+            url = f"volunteer/telegram/{page}/{page_size}"
+            if since is not None:
+                url += f"?updated_since={since}"
+            raw = serialization.loads(self._get(url).content)
+            volunteers.extend(raw["list"])
+            cursor = raw.get("cursor", cursor)
+            if len(raw["list"]) < page_size:
+                return volunteers, cursor
+            page += 1
 
     def register_pending_volunteer(self, data):
         """Tell the backend that we have a new volunteer who wants to help
@@ -101,10 +156,14 @@ class Backender:
         beneficiary. Note that it is possible that a volunteer will send several photos that are linked to the same
         request in the system.
         :param data: bytearray, raw data corresponding to the image
-        :param request_id: str, identifier of request"""
+        :param request_id: str, identifier of request
+        :raises ValueError: if the server did not accept the receipt, so that the upload can be attempted again"""
         log.debug("Send receipt (%i bytes) for req:%s", len(data), request_id)
-        payload = {"beneficiary_id": request_id, "data": base64.b64encode(data).decode()}
-        self._post(payload=payload, url="receipt")
+        # the photo is hundreds of KiB, it goes into the JSON without an intermediate str
+        payload = serialization.embed({"beneficiary_id": request_id}, "data", data)
+        response = self._post(payload=payload, url="receipt")
+        if not response.ok:
+            raise ValueError("Bad response")
 
     def relay_offer(self, request_id, volunteer_id, offer):
         """Notify the server that an offer to handle a request was provided by a volunteer. Note that this function
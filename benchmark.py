@@ -0,0 +1,307 @@
+"""Micro-benchmarks of the code that runs on every interaction with a volunteer: building keyboards, converting
+times, building profiles and rendering messages, as well as parsing and serializing the JSON exchanged with the
+backend, with each of the libraries that are installed (see `serialization.py`). Nothing leaves the machine, the Telegram API is answered locally
+and no token is needed.
+
+    python benchmark.py                              # run everything, print the results
+    python benchmark.py --only keyboard              # only the benchmarks whose name contains `keyboard`
+    python benchmark.py --only serialization         # how the JSON libraries compare
+    python benchmark.py --save bench.json            # store the results as a baseline
+    python benchmark.py --baseline bench.json --tolerance 0.2
+
+Each benchmark reports the best time per call over several rounds, the number of memory blocks that are still
+allocated after one call (i.e. what the result keeps alive) and the peak memory used during that call. With
+`--baseline`, the exit code is 1 if any function got slower by more than the tolerance. Only compare results
+obtained on the same machine and Python version."""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime, time
+from types import SimpleNamespace
+
+from telegram import Bot
+
+import constants as c
+import keyboards as k
+import serialization
+import timetools
+from ajubot import Ajubot
+from delivery import Delivery
+from models import HelpRequest, VolunteerSession
+from replay import FakeRequest, NullBackend
+from statemachine import StateMachine
+
+log = logging.getLogger("benchmark")  # pylint: disable=invalid-name
+
+# Differences smaller than this are noise, regardless of the tolerance
+NOISE_NS = 200
+
+REQUEST_ID = "5e84c10a9938cfffc0217ed1"
+
+# A request for assistance, as in the README, sent to 50 volunteers
+HELP_REQUEST = {
+    "request_id": REQUEST_ID,
+    "beneficiary": "Martina Cojocaru",
+    "address": "str. 31 August",
+    "needs": ["Medicamente", "Produse alimentare"],
+    "gotSymptoms": False,
+    "hasDisabilities": False,
+    "safetyCode": "Izvor-45",
+    "phoneNumber": "+373 777 77 777",
+    "remarks": ["Nu lucreaza ascensorul", "Are caine rau"],
+    "volunteers": list(range(100000000, 100000050)),
+    "latitude": 47.0255165,
+    "longitude": 28.8303149,
+}
+# A photo of a receipt, as sent by Telegram
+RECEIPT_SIZE = 256 * 1024
+
+
+def etas_origin():
+    """The keyboards offer times until the end of the current day, start from a fixed hour so that every run builds
+    keyboards of the same size"""
+    return datetime.combine(datetime.today().date(), time(6, 0))
+
+
+def profile_benchmark(workdir):
+    """Prepare a complete registration: the first call with the phone number, then the answers to the questions
+    about availability, activities and e-mail"""
+    bot = Bot("123456:benchmark-token-not-used", request=FakeRequest())
+    owner = SimpleNamespace(
+        delivery=Delivery(bot, os.path.join(workdir, "delivery.bin")),
+        backend=NullBackend(),
+        machine=StateMachine(),
+        confirm_activities=lambda update, context: None,
+    )
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(first_name="Ion", last_name="Popescu"),
+        effective_chat=SimpleNamespace(id=42),
+    )
+    context = SimpleNamespace(bot_data={}, user_data=VolunteerSession())
+    answers = ("Seara, după 18", "transport", "ion@example.com")
+
+    def register():
+        Ajubot.build_profile(owner, update, context, phone=c.LOCAL_PREFIX + "69000000")
+        for answer in answers:
+            Ajubot.build_profile(owner, update, context, raw_text=answer)
+        return context.bot_data
+
+    return register
+
+
+def render_benchmark():
+    """The details of a request with remarks and a beneficiary with disabilities, so that every part of the message
+    is rendered"""
+    request = HelpRequest(
+        REQUEST_ID,
+        "str. Ismail 33, ap. 12",
+        needs=["groceries", "medicine"],
+        volunteers=[11, 12, 13],
+        beneficiary="Maria",
+        has_disabilities=True,
+        safety_code="1234",
+        phone_number="+37369000000",
+        remarks=["Sunați la interfon de două ori", "Are un câine mic"],
+        time="14:30",
+    )
+    return lambda: Ajubot.render_details(request)
+
+
+def json_lines():
+    """A batch of JSON lines with longer texts, like a recording of the traffic or a backlog of requests"""
+    body = (
+        "Volunteer Ion Popescu picked up the medicine and the groceries, str. Ismail 33, ap. 12. "
+        * 6
+    )
+    return [
+        {"request_id": "req-%03i" % i, "title": "Delivery %i, după 18:00" % i, "body": body}
+        for i in range(25)
+    ]
+
+
+def serialization_benchmarks():
+    """Parse and serialize the same payloads with each of the JSON libraries, then compare the ways of sending a
+    receipt and of keeping the spool's queue
+    :returns: list of (name, callable)"""
+    body = json.dumps(HELP_REQUEST).encode()
+    lines = json_lines()
+    raw_lines = [json.dumps(line).encode() for line in lines]
+    photo = os.urandom(RECEIPT_SIZE)
+    queue = {
+        "pending": [["req-%03i" % i, "%064x" % i] for i in range(200)],
+        "uploaded": {"req-%03i" % i: ["%064x" % i] for i in range(200)},
+    }
+    packed = serialization.pack(queue)
+
+    result = []
+    for backend, (loads, dumps) in serialization.BACKENDS.items():
+        prefix = "serialization.%s." % backend
+        result += [
+            (prefix + "loads_help_request", lambda loads=loads: loads(memoryview(body))),
+            (prefix + "dumps_help_request", lambda dumps=dumps: dumps(HELP_REQUEST)),
+            (prefix + "loads_json_lines", lambda loads=loads: [loads(line) for line in raw_lines],),
+            (prefix + "dumps_json_lines", lambda dumps=dumps: [dumps(line) for line in lines]),
+        ]
+    return result + [
+        (
+            "serialization.receipt_base64_str",
+            lambda: serialization.dumps(
+                {"beneficiary_id": REQUEST_ID, "data": base64.b64encode(photo).decode()}
+            ),
+        ),
+        (
+            "serialization.receipt_embed",
+            lambda: serialization.embed({"beneficiary_id": REQUEST_ID}, "data", photo),
+        ),
+        ("serialization.dumps_spool_queue", lambda: serialization.dumps(queue)),
+        ("serialization.pack_spool_queue", lambda: serialization.pack(queue)),
+        ("serialization.unpack_spool_queue", lambda: serialization.unpack(packed)),
+    ]
+
+
+def benchmarks(workdir):
+    """Return an OrderedDict name -> callable, each callable performs one operation"""
+    origin = etas_origin()
+    symptoms = k.new_symptom_choices(REQUEST_ID)
+    return OrderedDict(
+        [
+            (
+                "keyboards.build_dynamic_keyboard",
+                lambda: k.build_dynamic_keyboard(origin, REQUEST_ID),
+            ),
+            (
+                "keyboards.build_dynamic_keyboard_first_responses",
+                lambda: k.build_dynamic_keyboard_first_responses(REQUEST_ID),
+            ),
+            ("keyboards.get_etas_today", lambda: k.get_etas_today(origin)),
+            (
+                "keyboards.update_dynamic_keyboard_symptom",
+                lambda: k.update_dynamic_keyboard_symptom(symptoms, "symptom_cough"),
+            ),
+            (
+                "timetools.utc_short_to_user_short",
+                lambda: timetools.utc_short_to_user_short("12:35"),
+            ),
+            ("Ajubot.build_profile", profile_benchmark(workdir)),
+            ("Ajubot.render_details", render_benchmark()),
+        ]
+        + serialization_benchmarks()
+    )
+
+
+def allocations(func):
+    """Measure the memory used by one call
+    :returns: tuple (blocks still allocated after the call, peak bytes during the call)"""
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot().filter_traces(ignored)
+    result = func()
+    after = tracemalloc.take_snapshot().filter_traces(ignored)
+    tracemalloc.stop()
+    blocks = sum(
+        stat.count_diff for stat in after.compare_to(before, "lineno") if stat.count_diff > 0
+    )
+    del result
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return blocks, peak
+
+
+def measure(func, repeat):
+    """Time a function
+    :param repeat: int, how many rounds to run, the best one is kept
+    :returns: dict with the time per call in nanoseconds and the allocations"""
+    func()  # warm up, e.g. the imports performed lazily by strptime
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    blocks, peak = allocations(func)
+    return {"ns": round(best * 1e9, 1), "calls": number, "blocks": blocks, "peak_bytes": peak}
+
+
+def run(only=None, repeat=5):
+    """Run the benchmarks
+    :param only: optional str, run only the benchmarks whose name contains it
+    :returns: dict, the results"""
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as workdir:
+        for name, func in benchmarks(workdir).items():
+            if only and only not in name:
+                continue
+            results[name] = measure(func, repeat)
+            log.info("%s: %.1f ns, %i blocks", name, results[name]["ns"], results[name]["blocks"])
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Compare the timings of a report with those of a baseline
+    :param tolerance: float, e.g. 0.2 means that up to 20% slower is acceptable
+    :returns: list of str, one line per regression"""
+    if report["python"] != baseline.get("python"):
+        log.warning(
+            "Baseline was made with Python %s, the comparison is unreliable", baseline.get("python")
+        )
+
+    regressions = []
+    for name, stats in report["benchmarks"].items():
+        reference = baseline["benchmarks"].get(name)
+        if reference is None:
+            continue
+        current, previous = stats["ns"], reference["ns"]
+        if current > previous * (1 + tolerance) and current - previous > NOISE_NS:
+            regressions.append(
+                "REGRESSION %s: %.1f -> %.1f ns/call (blocks %i -> %i)"
+                % (name, previous, current, reference["blocks"], stats["blocks"])
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the bot's hot paths")
+    parser.add_argument("--only", help="run only the benchmarks whose name contains this")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="rounds per benchmark, the best is kept"
+    )
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare the results with the ones in this file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="acceptable slowdown, 0.2 = 20%%"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run(args.only, args.repeat)
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        with open(args.save, "w") as target:
+            json.dump(report, target, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as source:
+            regressions = compare(report, json.load(source), args.tolerance)
+        for line in regressions:
+            print(line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""Priority queue for the announcements of new requests. When many requests arrive at once, the ones where somebody is
+sick, has disabilities or needs medicine are announced to the volunteers first, instead of waiting behind routine
+grocery runs.
+
+The order is given by a scoring function over the request, see `urgency`. To make sure routine requests are not
+postponed forever, a request gains one point for every `aging` seconds it spends in the queue; technically, a request
+with score S is queued as if it had arrived S * `aging` seconds earlier.
+
+The time each request spent in the queue is kept per score, `stats` shows whether the urgent ones get through faster."""
+
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from stats import percentile_ms
+
+log = logging.getLogger("broadcasts")  # pylint: disable=invalid-name
+
+# Seconds of waiting that are worth one point of urgency
+DEFAULT_AGING = 60.0
+# How many announcements are sent at the same time. Keep this small, otherwise all the requests are picked up right
+# away and their order does not matter
+DEFAULT_WORKERS = 2
+# How many wait times are kept per score, for the percentiles
+WAIT_SAMPLES = 256
+
+# Fragments of the `needs` that refer to medicine, in lowercase
+MEDICINE_NEEDS = ("medicament", "medicine", "pastil", "farmac", "reţet", "rețet")
+
+
+def urgency(request):
+    """Default scoring function, the higher the score, the sooner a request is announced
+    :param request: models.HelpRequest
+    :returns: int, 0 for a routine request"""
+    score = 0
+    if request.got_symptoms:
+        score += 2
+    if any(fragment in need.lower() for need in request.needs for fragment in MEDICINE_NEEDS):
+        score += 2
+    if request.has_disabilities:
+        score += 1
+    return score
+
+
+class BroadcastQueue:
+    """Runs the announcements in order of urgency, with a small pool of workers"""
+
+    def __init__(self, handler, score=None, workers=DEFAULT_WORKERS, aging=DEFAULT_AGING):
+        """Initialize the queue, the workers are started when the first request arrives
+        :param handler: callable(request, job), does the actual announcement
+        :param score: optional callable(request) -> number, `urgency` by default
+        :param workers: int, how many announcements are made in parallel
+        :param aging: float, seconds of waiting after which a request's score is increased by one"""
+        self.handler = handler
+        self.score = score or urgency
+        self.workers = workers
+        self.aging = aging
+        # heap of (virtual arrival time, sequence number, score, arrival time, request, job)
+        self.queue = []
+        self.sequence = itertools.count()
+        self.cond = Condition()
+        self.threads = []
+        self.running = True
+        # score -> recent wait times in seconds
+        self.waits = {}
+        # score -> number of requests taken out of the queue
+        self.served = {}
+
+    def put(self, request, job):
+        """Queue a request for announcement
+        :param request: models.HelpRequest
+        :param job: jobs.Job, it stays `pending` while the request waits in the queue"""
+        score = self.score(request)
+        now = time.monotonic()
+        with self.cond:
+            if not self.running:
+                raise RuntimeError("The broadcast queue was stopped")
+            heapq.heappush(
+                self.queue,
+                (now - score * self.aging, next(self.sequence), score, now, request, job),
+            )
+            if len(self.threads) < self.workers:
+                thread = Thread(
+                    target=self.run, name="broadcast_%i" % len(self.threads), daemon=True
+                )
+                self.threads.append(thread)
+                thread.start()
+            self.cond.notify()
+        log.debug(
+            "Queued req:%s with score %s, %i waiting", request.request_id, score, len(self.queue)
+        )
+
+    def run(self):
+        """Body of a worker"""
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                _, _, score, arrived, request, job = heapq.heappop(self.queue)
+                waited = time.monotonic() - arrived
+                self.waits.setdefault(score, deque(maxlen=WAIT_SAMPLES)).append(waited)
+                self.served[score] = self.served.get(score, 0) + 1
+
+            try:
+                self.handler(request, job)
+            except Exception:  # pylint: disable=broad-except
+                # the job records the failure, this only keeps the worker alive
+                log.exception("Announcement of req:%s failed", request.request_id)
+
+    def stop(self):
+        """Announce whatever is still queued, then stop the workers"""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        """Return, for each score, how many requests are waiting, how many were served and how long they waited"""
+        with self.cond:
+            queued = {}
+            for entry in self.queue:
+                queued[entry[2]] = queued.get(entry[2], 0) + 1
+            waits = {score: sorted(samples) for score, samples in self.waits.items()}
+            served = dict(self.served)
+
+        result = {}
+        for score in sorted(set(queued) | set(waits), reverse=True):
+            samples = waits.get(score, [])
+            result[score] = {
+                "queued": queued.get(score, 0),
+                "served": served.get(score, 0),
+                "wait_p50_ms": percentile_ms(samples, 0.5),
+                "wait_p95_ms": percentile_ms(samples, 0.95),
+                "wait_max_ms": percentile_ms(samples, 1),
+            }
+        return result
+
+    def __len__(self):
+        return len(self.queue)
@@ -0,0 +1,180 @@
+"""Encoding and routing of the `callback_data` attached to inline keyboard buttons.
+
+The payload of a button looks like this: `1e<request>:<arg>`, where
+- `1` is the version of the encoding
+- `e` is a single character that identifies the route (i.e. the handler), see `ROUTES`
+- `<request>` is the compact form of the request ID the button refers to, or `-` if it is not tied to a request
+- `<arg>` is the route-specific argument, e.g. `20:45` for an ETA, or `onmyway` for the handling buttons
+
+Telegram limits callback_data to 64 bytes, so request IDs are packed: Mongo object IDs and UUIDs are transmitted as
+url-safe base64 of their raw bytes, everything else as url-safe base64 of the UTF-8 text.
+
+Buttons that were sent before this encoding was introduced carry `<route>_<arg>` payloads, e.g. `eta_20:45`, these
+are still understood, but they don't carry a request ID."""
+
+import base64
+import logging
+import re
+import time
+import uuid
+from collections import namedtuple
+from threading import Lock
+
+log = logging.getLogger("callbacks")  # pylint: disable=invalid-name
+
+VERSION = "1"
+MAX_LENGTH = 64  # imposed by Telegram
+NO_REQUEST = "-"
+
+# Route name -> single character code
+ROUTES = {
+    "eta": "e",
+    "caution": "c",
+    "handle": "h",
+    "state": "s",
+    "symptom": "y",
+    "wouldyou": "w",
+    "further": "f",
+    "assist": "a",
+    "pick": "p",
+}
+ROUTE_NAMES = {code: name for name, code in ROUTES.items()}
+
+# Legacy payload prefixes that don't match the route name
+LEGACY_ALIASES = {"furthercomments": "further"}
+
+OBJECT_ID = re.compile(r"^[0-9a-f]{24}$")
+UUID = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+class Callback(namedtuple("Callback", ["route", "request_id", "arg"])):
+    """Decoded callback payload"""
+
+    __slots__ = ()
+
+    @property
+    def code(self):
+        """The payload in the legacy form, e.g. `handle_onmyway`, it is what the handlers compare against"""
+        return f"{self.route}_{self.arg}"
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _unb64(text):
+    # unlike `urlsafe_b64decode`, this refuses characters that are not in the alphabet, instead of skipping them
+    return base64.b64decode(text + "=" * (-len(text) % 4), altchars=b"-_", validate=True)
+
+
+def pack_request_id(request_id):
+    """Return the compact form of a request ID
+    :param request_id: str or None"""
+    if request_id is None:
+        return NO_REQUEST
+    if OBJECT_ID.match(request_id):
+        return "o" + _b64(bytes.fromhex(request_id))
+    if UUID.match(request_id):
+        return "u" + _b64(uuid.UUID(request_id).bytes)
+    return "s" + _b64(request_id.encode())
+
+
+def unpack_request_id(packed):
+    """Reverse of `pack_request_id`
+    :raises ValueError: if it is not the compact form of a request ID"""
+    if packed == NO_REQUEST:
+        return None
+    kind, body = packed[0], _unb64(packed[1:])
+    if kind == "o" and len(body) == 12:
+        return body.hex()
+    if kind == "u":
+        return str(uuid.UUID(bytes=body))
+    if kind == "s":
+        return body.decode()
+    raise ValueError("Bad request ID `%s`" % packed)
+
+
+def encode(route, arg, request_id=None):
+    """Build the callback_data for a button
+    :param route: str, one of the keys in ROUTES
+    :param arg: str, route-specific argument
+    :param request_id: optional str, the request that this button refers to
+    :returns: str, the payload, guaranteed to fit in Telegram's limits"""
+    data = f"{VERSION}{ROUTES[route]}{pack_request_id(request_id)}:{arg}"
+    if len(data.encode()) > MAX_LENGTH:
+        raise ValueError("Callback data too long: %s" % data)
+    return data
+
+
+def decode(data):
+    """Parse callback_data produced by `encode`, or a legacy `<route>_<arg>` payload
+    :returns: Callback
+    :raises ValueError: if the payload cannot be parsed"""
+    if data[:1] == VERSION:
+        packed, _, arg = data[2:].partition(":")
+        try:
+            return Callback(ROUTE_NAMES[data[1]], unpack_request_id(packed), arg)
+        except (KeyError, IndexError, ValueError) as err:
+            raise ValueError("Bad callback data `%s`" % data) from err
+
+    route, _, arg = data.partition("_")
+    route = LEGACY_ALIASES.get(route, route)
+    if route not in ROUTES:
+        raise ValueError("Unknown callback route `%s`" % data)
+    return Callback(route, None, arg)
+
+
+class CallbackRouter:
+    """Single entry point for all the callback queries: the payload is decoded once, then the handler is looked up
+    by route. Handlers are invoked as `handler(update, context, callback)`"""
+
+    def __init__(self, guard=None):
+        """Initialize the router
+        :param guard: optional callable(update, context, callback) that returns True if the callback must be
+                      dropped, e.g. because it refers to a stale request"""
+        self.routes = {}
+        self.guard = guard
+        self.timings = {}
+        self.lock = Lock()
+
+    def add(self, route, handler):
+        """Register the handler for a route
+        :param route: str, one of the keys in ROUTES"""
+        if route not in ROUTES:
+            raise KeyError(route)
+        self.routes[route] = handler
+
+    def dispatch(self, update, context):
+        """Invoked by the dispatcher for every callback query"""
+        try:
+            callback = decode(update.callback_query.data)
+        except ValueError as err:
+            log.warning("%s", err)
+            return
+
+        if self.guard is not None and self.guard(update, context, callback):
+            return
+
+        started = time.perf_counter()
+        try:
+            self.routes[callback.route](update, context, callback)
+        finally:
+            self._account(callback.route, time.perf_counter() - started)
+
+    def _account(self, route, elapsed):
+        """Update the timing statistics for a route"""
+        with self.lock:
+            count, total, worst = self.timings.get(route, (0, 0.0, 0.0))
+            self.timings[route] = (count + 1, total + elapsed, max(worst, elapsed))
+
+    def stats(self):
+        """Return a dictionary with per-route timings: calls, average and worst duration in milliseconds"""
+        with self.lock:
+            return {
+                route: {
+                    "calls": count,
+                    "avg_ms": round(total / count * 1000, 3),
+                    "max_ms": round(worst * 1000, 3),
+                }
+                for route, (count, total, worst) in self.timings.items()
+            }
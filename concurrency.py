@@ -0,0 +1,134 @@
+"""Locking of the bot's state. The dispatcher's handlers, the hooks invoked by the REST API and the background
+threads (albums, digests, deliveries) all change the same `user_data` and `bot_data`; every change is made while
+holding the lock of the volunteer or of the request it affects.
+
+There is one lock per stripe rather than one per volunteer, a volunteer or request is mapped to a stripe by its hash.
+To avoid deadlocks, keep this order: the lock of at most one volunteer, then the lock of at most one request.
+
+With `ChatQueues`, the updates are handled by a pool of workers instead of the dispatcher's thread: the updates of
+one volunteer are still handled one at a time and in order, but different volunteers are served in parallel."""
+
+import logging
+import time
+from collections import deque
+from threading import Condition, Lock, RLock
+
+log = logging.getLogger("concurrency")  # pylint: disable=invalid-name
+
+# Number of locks of each kind; two volunteers that share a stripe wait for each other
+DEFAULT_STRIPES = 256
+
+
+class LockStripes:
+    """A fixed set of re-entrant locks for the volunteers and another one for the requests"""
+
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        """:param stripes: int, how many locks of each kind"""
+        self.chats = [RLock() for _ in range(stripes)]
+        self.requests = [RLock() for _ in range(stripes)]
+        self.stats_lock = Lock()
+        self.acquired = 0
+        self.contended = 0
+        self.waited = 0.0
+
+    def chat(self, chat_id):
+        """Return a context manager that holds the lock of a volunteer"""
+        return _Held(self, self.chats[hash(chat_id) % len(self.chats)])
+
+    def request(self, request_id):
+        """Return a context manager that holds the lock of a request"""
+        return _Held(self, self.requests[hash(request_id) % len(self.requests)])
+
+    def _account(self, waited):
+        with self.stats_lock:
+            self.acquired += 1
+            if waited is not None:
+                self.contended += 1
+                self.waited += waited
+
+    def stats(self):
+        """Return how often a lock was already taken when it was needed, and how long it took to get it"""
+        with self.stats_lock:
+            return {
+                "acquired": self.acquired,
+                "contended": self.contended,
+                "waited_ms": round(self.waited * 1000, 1),
+            }
+
+
+class _Held:
+    """Context manager that acquires a stripe and accounts for the time spent waiting for it"""
+
+    __slots__ = ("stripes", "lock")
+
+    def __init__(self, stripes, lock):
+        self.stripes = stripes
+        self.lock = lock
+
+    def __enter__(self):
+        if self.lock.acquire(blocking=False):
+            self.stripes._account(None)  # pylint: disable=protected-access
+            return self
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.stripes._account(time.perf_counter() - started)  # pylint: disable=protected-access
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+class ChatQueues:
+    """Runs the work of each volunteer in order, one item at a time, on a shared pool of workers"""
+
+    def __init__(self, submit, locks):
+        """Initialize the queues
+        :param submit: callable(func, *args), runs `func` on a worker, e.g. `Dispatcher.run_async`
+        :param locks: LockStripes, each item runs while holding its volunteer's lock"""
+        self.submit = submit
+        self.locks = locks
+        # chat_id -> deque of (func, args) waiting for their turn; a chat is here while one of its items runs
+        self.queues = {}
+        self.cond = Condition()
+        self.pending = 0
+
+    def put(self, chat_id, func, *args):
+        """Queue an item, it runs after the ones already queued for the same volunteer"""
+        with self.cond:
+            self.pending += 1
+            queue = self.queues.get(chat_id)
+            if queue is not None:
+                queue.append((func, args))
+                return
+            self.queues[chat_id] = deque([(func, args)])
+        self.submit(self.drain, chat_id)
+
+    def drain(self, chat_id):
+        """Run the items of a volunteer until there are none left, invoked on a worker"""
+        while True:
+            with self.cond:
+                queue = self.queues[chat_id]
+                if not queue:
+                    del self.queues[chat_id]
+                    return
+                func, args = queue.popleft()
+
+            try:
+                with self.locks.chat(chat_id):
+                    func(*args)
+            except Exception:  # pylint: disable=broad-except
+                # the other items of this volunteer must still run
+                log.exception("Handler failed for @%s", chat_id)
+            finally:
+                with self.cond:
+                    self.pending -= 1
+                    self.cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until all the queued items ran
+        :returns: bool, False if the timeout expired first"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.pending == 0, timeout)
+
+    def __len__(self):
+        return self.pending
@@ -24,6 +24,8 @@ MSG_COORDINATING = "coordonez cu alți voluntari."
 MSG_PHONE_QUERY = "Te rog să ne transmiți numărul de contact, pentru a începe înregistrarea."
 MSG_ANOTHER_ASSIGNEE = "Altcineva merge acolo. Te anunțăm când apar noi cereri"
 MSG_REQUEST_CANCELED = "Cererea de ajutor a fost anulată."
+MSG_REQUEST_WITHDRAWN = "Această cerere nu mai este disponibilă."
+MSG_UNEXPECTED = "Nu am înțeles mesajul, te rog să folosești butoanele de mai sus."
 MSG_LET_ME_KNOW = "Anunță-mă când te-ai pornit"
 MSG_LET_ME_KNOW_ARRIVE = "Anunță-mă când e gata"
 MSG_DISABILITY = "♿ Atenție, %(beneficiary)s are careva dizabilități, posibil va deschide mai lent ușa sau va răspunde întârziat, să ai răbdare."
@@ -63,6 +65,16 @@ MSG_SAFETY_REMINDER = """Când ajungi, întreabă-i despre:
 - Își măsoară regulat temperatura?"""
 
 MSG_REQUEST_ANNOUNCEMENT = "O persoană din *%s* are nevoie de:\n%s\nPoți ajuta?"
+MSG_DIGEST = "Mai multe persoane au nevoie de ajutor:\n\n%s\nPe cine poți ajuta?"
+MSG_DIGEST_ITEM = "*%i.* *%s*: %s\n"
+
+# Sent when a volunteer takes too long to answer, see `DEADLINES` in `ajubot.py`
+MSG_REMIND_ANSWER = "Mai poți ajuta? Te rog să răspunzi la cererea de mai sus."
+MSG_REMIND_CAUTION = "Te rog să confirmi dacă poți merge la cererea atribuită."
+MSG_REMIND_SURVEY = "Te rog să răspunzi la întrebările despre cererea finalizată."
+MSG_EXPIRED_ANSWER = "Cererea a fost oferită altor voluntari. Te vom alerta când apar cereri noi."
+MSG_EXPIRED_CAUTION = "Nu ai confirmat, așa că cererea va fi atribuită altcuiva."
+MSG_EXPIRED_SURVEY = "Am închis chestionarul, mulțumim pentru ajutor!"
 
 MSG_THANKS_FEEDBACK = (
     "Îți mulțumesc pentru ajutor. Te rog să-mi spui câte ceva despre această experiență:"
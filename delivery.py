@@ -0,0 +1,292 @@
+"""Reliable delivery of Telegram messages. A send that fails is not simply lost, the error is classified first:
+
+- flood control (`RetryAfter`), timeouts and other network errors are transient, the send is retried later, with an
+  exponential backoff, and never earlier than Telegram asked us to wait
+- a chat that blocked the bot or no longer exists is put on a suppression list, nothing is sent there until the user
+  talks to the bot again
+- anything else (e.g. malformed Markdown) is a bug on our side, the error is raised to the caller, as before
+
+Pending retries and the suppression list are saved to disk by the retry thread, at most every `save_interval`
+seconds and when it stops, so they survive restarts; a burst of failures costs one write, not one per failure. The
+retries go through the same rate limiter as the bulk sends, see `sender.RateLimiter`. A retry
+can carry a `tag`, e.g. `("announcement", request_id)`, which lets the bot find out when a deferred message is finally
+delivered, or decide that it is no longer worth sending, see `Delivery.register`.
+
+Note that a timeout does not necessarily mean the message was not delivered, so a retry after a timeout can result in
+a duplicate message. For our use case, a duplicate is better than a volunteer never hearing about a request."""
+
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import time
+from threading import Condition, Thread
+
+from telegram.error import (
+    BadRequest,
+    ChatMigrated,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+    Unauthorized,
+)
+
+import tracing
+
+log = logging.getLogger("delivery")  # pylint: disable=invalid-name
+
+# Error classes
+RETRY = "retry"
+BLOCKED = "blocked"
+PERMANENT = "permanent"
+
+# Retry schedule: the first retry happens after BACKOFF_BASE seconds, then the delay doubles up to BACKOFF_MAX
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 600.0
+MAX_ATTEMPTS = 10
+# Seconds between two writes of the pending retries
+DEFAULT_SAVE_INTERVAL = 5.0
+
+# Fragments of the error descriptions that mean the chat is gone for good, as far as we're concerned
+BLOCKED_REASONS = (
+    "chat not found",
+    "user is deactivated",
+    "bot was blocked",
+    "bot was kicked",
+    "bot can't initiate conversation",
+)
+
+
+def classify(err):
+    """Tell what should be done about an error raised by a Telegram API call
+    :param err: Exception
+    :returns: str, one of RETRY, BLOCKED or PERMANENT"""
+    if isinstance(err, (RetryAfter, ChatMigrated)):
+        return RETRY
+    if isinstance(err, Unauthorized):
+        return BLOCKED
+    if isinstance(err, BadRequest):
+        # BadRequest is a subclass of NetworkError, but retrying it won't help
+        reason = str(err).lower()
+        return BLOCKED if any(text in reason for text in BLOCKED_REASONS) else PERMANENT
+    if isinstance(err, NetworkError):
+        return RETRY
+    return PERMANENT
+
+
+def backoff(attempt, err=None):
+    """Return the delay in seconds before the next attempt
+    :param attempt: int, how many attempts were made so far, starting from 1
+    :param err: optional exception raised by the last attempt, its `retry_after` is honoured"""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+    if isinstance(err, RetryAfter):
+        delay = max(delay, err.retry_after)
+    if isinstance(err, ChatMigrated):
+        # not a failure, the message has to be sent to the new chat right away
+        delay = 0
+    return delay
+
+
+class Delivery:
+    """Sends messages through a bot, retrying the ones that fail because of transient errors"""
+
+    def __init__(self, bot, path="delivery.bin", limiter=None, save_interval=DEFAULT_SAVE_INTERVAL):
+        """Initialize the delivery layer, loading the pending retries and the suppressed chats from disk
+        :param bot: telegram.Bot
+        :param path: str, the file where the state is kept
+        :param limiter: optional sender.RateLimiter, each retry waits for a token, e.g. the one of the bot's `Sender`
+        :param save_interval: float, seconds between two writes of the file"""
+        self.bot = bot
+        self.path = path
+        self.limiter = limiter
+        self.save_interval = save_interval
+        # whether the queue or the suppression list changed since they were saved
+        self.changed = False
+        self.saved = time.monotonic()
+        # heap of [due timestamp, sequence number, attempts, method name, chat_id, kwargs, tag]
+        self.queue = []
+        self.suppressed = set()
+        self.handlers = {}
+        self.sequence = itertools.count()
+        self.cond = Condition()
+        self.running = False
+        self.worker = None
+        self.load()
+
+    def load(self):
+        """Read the pending retries and the suppression list from disk"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as source:
+            # Bandit warns about unpickling untrusted data; this file is only ever written by us
+            state = pickle.load(source)  # nosec
+        self.suppressed = state["suppressed"]
+        self.queue = state["queue"]
+        heapq.heapify(self.queue)
+        self.sequence = itertools.count(max((entry[1] for entry in self.queue), default=-1) + 1)
+        log.info(
+            "Loaded %i pending retries, %i suppressed chats", len(self.queue), len(self.suppressed)
+        )
+
+    def save(self):
+        """Write the pending retries and the suppression list to disk; only the snapshot is taken under the lock"""
+        with self.cond:
+            state = pickle.dumps({"queue": self.queue, "suppressed": self.suppressed})
+            self.changed = False
+        self.saved = time.monotonic()
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as target:
+            target.write(state)
+        os.replace(temporary, self.path)
+
+    def register(self, kind, delivered=None, stale=None):
+        """Subscribe to the fate of the deferred messages tagged with `(kind, ...)`
+        :param kind: str, the first element of the tag
+        :param delivered: optional callable(tag, chat_id, message), invoked when a deferred message is delivered
+        :param stale: optional callable(tag, chat_id) -> bool, invoked before each retry, if it returns True the
+                      message is dropped"""
+        self.handlers[kind] = (delivered, stale)
+
+    def start(self):
+        """Start the thread that performs the retries"""
+        self.running = True
+        self.worker = Thread(target=self.run, name="delivery", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        """Stop the retry thread, the pending retries stay on disk for the next run"""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.worker is not None:
+            self.worker.join()
+        if self.changed:
+            self.save()
+
+    def is_suppressed(self, chat_id):
+        """Tell whether a chat is on the suppression list"""
+        return chat_id in self.suppressed
+
+    def unsuppress(self, chat_id):
+        """Take a chat off the suppression list, e.g. because the user talked to the bot again"""
+        if chat_id not in self.suppressed:
+            return
+        with self.cond:
+            self.suppressed.discard(chat_id)
+            self.changed = True
+            self.cond.notify()
+        log.info("Chat @%s is no longer suppressed", chat_id)
+
+    def send_message(self, chat_id, text, tag=None, **kwargs):
+        """Send a text message, same as `bot.send_message`, but failures are handled as described above
+        :param tag: optional tuple of picklable values, the first one identifies the handlers set via `register`
+        :returns: the Message, or None if it was deferred or the chat is suppressed"""
+        return self.send("send_message", chat_id, tag, text=text, **kwargs)
+
+    def send(self, method, chat_id, tag=None, **kwargs):
+        """Invoke a method of the bot that sends something to a chat
+        :param method: str, the name of the method, e.g. `send_message` or `send_animation`
+        :param chat_id: int, the recipient
+        :param tag: optional tuple, see `send_message`
+        :param kwargs: the rest of the arguments of the method, they must be picklable
+        :returns: whatever the method returns, or None if the call was deferred or the chat is suppressed"""
+        if chat_id in self.suppressed:
+            log.debug("Not sending %s to suppressed chat @%s", method, chat_id)
+            return None
+        try:
+            with tracing.child("telegram." + method, chat_id=chat_id):
+                return getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+        except TelegramError as err:
+            if not self.handle_failure(err, 1, method, chat_id, kwargs, tag):
+                raise
+        return None
+
+    def handle_failure(self, err, attempt, method, chat_id, kwargs, tag):
+        """Decide what to do after a failed attempt: schedule a retry or suppress the chat
+        :returns: bool, False if the error is permanent and must be reported to the caller"""
+        kind = classify(err)
+        if kind == PERMANENT:
+            return False
+
+        with self.cond:
+            if kind == BLOCKED:
+                log.info("Chat @%s is unreachable (%s), suppressing it", chat_id, err)
+                self.suppressed.add(chat_id)
+            elif attempt >= MAX_ATTEMPTS:
+                log.error("Giving up %s @%s after %i attempts: %s", method, chat_id, attempt, err)
+            else:
+                if isinstance(err, ChatMigrated):
+                    chat_id = err.new_chat_id
+                delay = backoff(attempt, err)
+                log.warning(
+                    "%s @%s failed (%s), retry #%i in %.1fs", method, chat_id, err, attempt, delay
+                )
+                entry = [
+                    time.time() + delay,
+                    next(self.sequence),
+                    attempt,
+                    method,
+                    chat_id,
+                    kwargs,
+                    tag,
+                ]
+                heapq.heappush(self.queue, entry)
+            self.changed = True
+            self.cond.notify()
+        return True
+
+    def _timeout(self):
+        """Return how long the retry thread can sleep before it has something to do, None if it can sleep until it
+        is woken up; the caller must hold `self.cond`"""
+        delays = []
+        if self.queue:
+            delays.append(self.queue[0][0] - time.time())
+        if self.changed:
+            delays.append(self.saved + self.save_interval - time.monotonic())
+        return min(delays) if delays else None
+
+    def run(self):
+        """Body of the retry thread, it also writes the changes to disk"""
+        while True:
+            with self.cond:
+                timeout = self._timeout()
+                while self.running and (timeout is None or timeout > 0):
+                    self.cond.wait(timeout)
+                    timeout = self._timeout()
+                if not self.running:
+                    return
+                entry = None
+                if self.queue and self.queue[0][0] <= time.time():
+                    entry = heapq.heappop(self.queue)
+                    self.changed = True
+
+            if self.changed and time.monotonic() - self.saved >= self.save_interval:
+                self.save()
+            if entry is not None:
+                _, _, attempt, method, chat_id, kwargs, tag = entry
+                self.retry(attempt, method, chat_id, kwargs, tag)
+
+    def retry(self, attempt, method, chat_id, kwargs, tag):
+        """Make another attempt at a deferred call"""
+        delivered, stale = self.handlers.get(tag[0], (None, None)) if tag else (None, None)
+        if chat_id in self.suppressed or (stale is not None and stale(tag, chat_id)):
+            log.debug("Dropping deferred %s @%s, tag %s", method, chat_id, tag)
+            return
+
+        if self.limiter is not None:
+            self.limiter.acquire()
+        try:
+            result = getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+        except TelegramError as err:
+            if not self.handle_failure(err, attempt + 1, method, chat_id, kwargs, tag):
+                log.error("Deferred %s @%s failed: %s", method, chat_id, err)
+            return
+
+        log.info("Deferred %s @%s delivered after %i attempts", method, chat_id, attempt + 1)
+        if delivered is not None:
+            delivered(tag, chat_id, result)
+
+    def stats(self):
+        """Return the number of pending retries and of suppressed chats"""
+        return {"pending": len(self.queue), "suppressed": len(self.suppressed)}
@@ -0,0 +1,113 @@
+"""Coalescing of the announcements sent to a volunteer. During peaks, the same volunteer is listed in many requests that
+arrive at about the same time; instead of one message per request, each of them replacing the previous one as the
+request under review, the announcements that arrive within a short window are sent as a single digest, where the
+volunteer picks the request they want to handle.
+
+The window starts with the first announcement for a volunteer and is not extended by the ones that follow, so an
+announcement is never delayed by more than the window. The windows of all the volunteers are kept in a single heap,
+ordered by the time they close, and watched by one thread; the flushes themselves are handed over to `submit`, e.g.
+the workers of a `sender.Sender`, so a burst of digests stays within Telegram's rate limit."""
+
+import heapq
+import logging
+import time
+from threading import Condition, Thread
+
+log = logging.getLogger("digests")  # pylint: disable=invalid-name
+
+# How long announcements for a volunteer are held back, in seconds
+DEFAULT_WINDOW = 3.0
+
+
+class DigestBuffer:
+    """Per-volunteer buffer of pending announcements"""
+
+    def __init__(self, flush, window=DEFAULT_WINDOW, submit=None, priority=None):
+        """Initialize the buffer, the thread that watches the windows is started when the first item arrives
+        :param flush: callable(chat_id, items), invoked with the items collected for a volunteer during the window
+        :param window: float, seconds; if it is 0, each item is flushed right away
+        :param submit: optional callable(func, *args), runs a flush, e.g. `Sender.submit`; by default the flushes
+                       run in the buffer's own thread, or in the caller's thread if `window` is 0
+        :param priority: optional callable(item) -> number, the items with the highest priority are passed to
+                         `flush` first; by default, and among items with the same priority, in order of arrival"""
+        self.flush = flush
+        self.window = window
+        self.submit = submit
+        self.priority = priority
+        # chat_id -> list of items
+        self.pending = {}
+        # heap of (time the window closes, chat_id)
+        self.due = []
+        self.cond = Condition()
+        self.running = True
+        self.thread = None
+
+    def add(self, chat_id, item):
+        """Add an item to a volunteer's buffer, starting the window if it is the first one
+        :param chat_id: int, the volunteer
+        :param item: anything, it is passed to `flush` along with the other items"""
+        with self.cond:
+            # once the buffer is stopped, nothing is held back anymore
+            held = self.window > 0 and self.running
+            if held and chat_id in self.pending:
+                self.pending[chat_id].append(item)
+                return
+            if held:
+                self.pending[chat_id] = [item]
+                heapq.heappush(self.due, (time.monotonic() + self.window, chat_id))
+                if self.thread is None:
+                    self.thread = Thread(target=self.run, name="digests", daemon=True)
+                    self.thread.start()
+                self.cond.notify()
+                return
+        self._submit(chat_id, [item])
+
+    def run(self):
+        """Body of the thread that closes the windows"""
+        while True:
+            with self.cond:
+                while self.running and (not self.due or self.due[0][0] > time.monotonic()):
+                    self.cond.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                if not self.running:
+                    return
+                _, chat_id = heapq.heappop(self.due)
+                items = self.pending.pop(chat_id, None)
+            if items:
+                self._submit(chat_id, items)
+
+    def _submit(self, chat_id, items):
+        if self.priority is not None:
+            # the sort is stable, items with the same priority keep their order of arrival
+            items.sort(key=self.priority, reverse=True)
+        if self.submit is None:
+            self._flush(chat_id, items)
+        else:
+            self.submit(self._flush, chat_id, items)
+
+    def _flush(self, chat_id, items):
+        log.debug("Flushing %i announcements for @%s", len(items), chat_id)
+        try:
+            self.flush(chat_id, items)
+        except Exception:  # pylint: disable=broad-except
+            # this runs in a background thread, nobody else would hear about it
+            log.exception("Could not send the announcements for @%s", chat_id)
+
+    def flush_all(self):
+        """Flush all the buffers right away, e.g. before shutting down"""
+        with self.cond:
+            pending, self.pending = self.pending, {}
+            self.due = []
+        for chat_id, items in pending.items():
+            self._submit(chat_id, items)
+
+    def stop(self):
+        """Stop the thread that closes the windows, flushing whatever is still buffered"""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush_all()
+
+    def __len__(self):
+        return len(self.pending)
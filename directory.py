@@ -0,0 +1,205 @@
+"""Local copy of the backend's list of volunteers who use the bot, so that the bot can tell whether a chat belongs to a
+registered volunteer without asking the backend, or probing the persistence, every time.
+
+The whole list is fetched when the bot starts; after that, only the volunteers that changed since the previous sync
+are fetched, every `interval` seconds. Lookups are served from memory, unless the last successful sync is older than
+`max_age`, in which case a sync is attempted first. If the backend cannot be reached, the lookups are served from
+the data that is already here, a stale answer is better than no answer.
+
+Until the first sync succeeds the directory is not `ready`, and the callers fall back to whatever they did before.
+
+Several bots can share one directory (see `tenants.py`), but the backend's list covers the volunteers of all of them,
+while a bot can only write to the chats that were started with it. Each bot looks at the directory through a
+`TenantView`, which only shows the volunteers who have a session with that bot."""
+
+import logging
+import time
+from collections import namedtuple
+from threading import Event, Lock, Thread
+
+log = logging.getLogger("directory")  # pylint: disable=invalid-name
+
+# Seconds between two syncs
+DEFAULT_INTERVAL = 60.0
+# Lookups never rely on data older than this, in seconds, as long as the backend can be reached
+DEFAULT_MAX_AGE = 300.0
+# Volunteers with this status are dropped from the directory
+REMOVED = "deleted"
+
+
+class Volunteer(namedtuple("Volunteer", ["chat_id", "phone", "activities", "status"])):
+    """What the directory knows about a volunteer"""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_payload(cls, data):
+        """Build an entry out of an item returned by `Backender.list_volunteers`
+        :raises ValueError: if the item does not have a chat ID"""
+        chat_id = data.get("telegram_chat_id")
+        if not isinstance(chat_id, int) or isinstance(chat_id, bool):
+            raise ValueError("Missing or invalid `telegram_chat_id`")
+        return cls(
+            chat_id,
+            data.get("phone"),
+            tuple(data.get("activities") or ()),
+            data.get("status", "active"),
+        )
+
+
+class VolunteerDirectory:
+    """The volunteers known to the backend, keyed by chat ID"""
+
+    def __init__(self, backend, interval=DEFAULT_INTERVAL, max_age=DEFAULT_MAX_AGE):
+        """Initialize the directory, it is empty until `sync` or `start` are invoked
+        :param backend: Backender, its `list_volunteers` is used to fetch the volunteers
+        :param interval: float, seconds between the syncs performed in the background
+        :param max_age: float, seconds after which a lookup triggers a sync"""
+        self.backend = backend
+        self.interval = interval
+        self.max_age = max_age
+        self.volunteers = {}
+        # opaque value returned by the backend, it marks where the next delta starts; None for a full fetch
+        self.cursor = None
+        # monotonic time of the last successful sync, None until the first one
+        self.synced = None
+        # monotonic time of the last attempt, so that lookups don't retry over and over while the backend is down
+        self.attempted = 0
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.syncs = 0
+        self.failures = 0
+        self.last_sync_ms = None
+
+    @property
+    def ready(self):
+        return self.synced is not None
+
+    def sync(self):
+        """Fetch the volunteers that changed since the last sync, or all of them if there was none yet
+        :returns: bool, whether the sync succeeded"""
+        with self.lock:
+            started = self.attempted = time.monotonic()
+            try:
+                result = self.backend.list_volunteers(since=self.cursor)
+            except Exception as err:  # pylint: disable=broad-except
+                # the backend is down or replied with garbage, keep what we have
+                self.failures += 1
+                log.warning("Could not sync the volunteers: %s", err)
+                return False
+            if result is None:
+                # this backend cannot list the volunteers
+                return False
+
+            items, cursor = result
+            full = self.cursor is None
+            volunteers = {} if full else self.volunteers
+            for item in items:
+                try:
+                    volunteer = Volunteer.from_payload(item)
+                except ValueError as err:
+                    log.debug("Skipping volunteer %s: %s", item, err)
+                    continue
+                if volunteer.status == REMOVED:
+                    volunteers.pop(volunteer.chat_id, None)
+                else:
+                    volunteers[volunteer.chat_id] = volunteer
+
+            self.volunteers = volunteers
+            self.cursor = cursor
+            self.synced = time.monotonic()
+            self.syncs += 1
+            self.last_sync_ms = round((self.synced - started) * 1000, 1)
+        log.debug(
+            "%s sync: %i changes, %i volunteers",
+            "Full" if full else "Delta",
+            len(items),
+            len(volunteers),
+        )
+        return True
+
+    def get(self, chat_id):
+        """Look up a volunteer
+        :param chat_id: int
+        :returns: Volunteer, or None if the backend does not know about them"""
+        now = time.monotonic()
+        if (
+            self.synced is not None
+            and now - self.synced > self.max_age
+            and now - self.attempted > self.interval
+        ):
+            self.sync()
+        return self.volunteers.get(chat_id)
+
+    def add(self, chat_id, phone=None):
+        """Record a volunteer the backend told us about in the meantime, until the next sync brings the details"""
+        with self.lock:
+            self.volunteers.setdefault(chat_id, Volunteer(chat_id, phone, (), "active"))
+
+    def start(self):
+        """Fetch all the volunteers, then keep syncing in the background"""
+        if self.thread is not None:
+            return
+        self.sync()
+        self.thread = Thread(target=self.run, name="directory", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Body of the background thread"""
+        while not self.stopped.wait(self.interval):
+            self.sync()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        """Return the size of the directory and how fresh it is"""
+        return {
+            "volunteers": len(self.volunteers),
+            "ready": self.ready,
+            "age_s": None if self.synced is None else round(time.monotonic() - self.synced, 1),
+            "syncs": self.syncs,
+            "failures": self.failures,
+            "last_sync_ms": self.last_sync_ms,
+        }
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __len__(self):
+        return len(self.volunteers)
+
+
+class TenantView:
+    """The volunteers of a shared directory who have a session with a given bot"""
+
+    def __init__(self, directory, members):
+        """Initialize the view
+        :param directory: VolunteerDirectory, it is started and stopped by its owner
+        :param members: callable(chat_id) -> bool, whether the chat has a session with the bot, e.g. `__contains__`
+                        of its `user_data`"""
+        self.directory = directory
+        self.members = members
+
+    @property
+    def ready(self):
+        return self.directory.ready
+
+    def get(self, chat_id):
+        """Look up a volunteer
+        :returns: Volunteer, or None if the backend does not know about them or they never talked to this bot"""
+        if not self.members(chat_id):
+            return None
+        return self.directory.get(chat_id)
+
+    def add(self, chat_id, phone=None):
+        self.directory.add(chat_id, phone)
+
+    def stats(self):
+        return self.directory.stats()
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
@@ -0,0 +1,155 @@
+"""Coalesced saving of the bot's state. The hooks and handlers only mark the volunteers and requests they changed; the
+flusher writes them out every `interval` seconds, or sooner, once `threshold` of them are waiting, so that a burst
+of requests results in a few writes rather than one per event. Whatever is still waiting is written when the bot
+stops.
+
+The persistence is expected to keep the changes in memory until it is flushed (`on_flush=True`, see
+`tenants.make_persistence`), otherwise it writes each record as soon as it hears about it and the flusher only
+decides when that happens. If the process dies, the changes of the last `interval` seconds are lost."""
+
+import logging
+import time
+from collections import Counter, deque
+from threading import Event, Lock, Thread
+
+from stats import percentile_ms
+
+log = logging.getLogger("flusher")  # pylint: disable=invalid-name
+
+# Seconds between two flushes
+DEFAULT_INTERVAL = 2.0
+# A flush starts right away once this many volunteers and requests are waiting to be saved
+DEFAULT_THRESHOLD = 200
+# How many durations are kept, for the percentiles
+DURATION_SAMPLES = 256
+
+
+class Flusher:
+    """Keeps track of the volunteers and requests that changed since the last flush, and saves them"""
+
+    def __init__(self, dispatcher, interval=DEFAULT_INTERVAL, threshold=DEFAULT_THRESHOLD):
+        """Initialize the flusher, nothing is saved in the background until `start` is invoked
+        :param dispatcher: telegram.ext.Dispatcher, its user_data and bot_data are saved to its persistence
+        :param interval: float, seconds between two flushes
+        :param threshold: int, how many changed records trigger a flush before the interval is over"""
+        self.dispatcher = dispatcher
+        self.interval = interval
+        self.threshold = threshold
+        self.chats = set()
+        self.requests = set()
+        # guards the sets above
+        self.lock = Lock()
+        # one flush at a time
+        self.flush_lock = Lock()
+        self.wakeup = Event()
+        self.stopped = Event()
+        self.thread = None
+        self.flushes = 0
+        self.failures = 0
+        self.records = 0
+        self.last_records = 0
+        self.durations = deque(maxlen=DURATION_SAMPLES)
+        self.reasons = Counter()
+
+    def mark(self, chat_ids=(), request_ids=()):
+        """Record that some volunteers and requests changed
+        :param chat_ids: iterable of int, the volunteers whose session changed
+        :param request_ids: iterable of str, the requests that were added, changed or removed"""
+        with self.lock:
+            self.chats.update(chat_ids)
+            self.requests.update(request_ids)
+            due = len(self.chats) + len(self.requests) >= self.threshold
+        if not due:
+            return
+        if self.thread is None:
+            # nobody else would save them, e.g. in the tools that don't start the bot
+            self.flush("threshold")
+        else:
+            self.wakeup.set()
+
+    def flush(self, reason="interval"):
+        """Save the records that changed
+        :param reason: str, why this flush happened, it is counted in the stats
+        :returns: int, how many records were saved"""
+        with self.flush_lock:
+            with self.lock:
+                chats, self.chats = self.chats, set()
+                requests, self.requests = self.requests, set()
+            if not chats and not requests:
+                return 0
+
+            persistence = self.dispatcher.persistence
+            if persistence is None:
+                return 0
+
+            started = time.perf_counter()
+            try:
+                user_data = self.dispatcher.user_data
+                for chat_id in chats:
+                    if chat_id in user_data:
+                        persistence.update_user_data(chat_id, user_data[chat_id])
+                if requests:
+                    # the persistence API only knows about bot_data as a whole
+                    persistence.update_bot_data(self.dispatcher.bot_data)
+                persistence.flush()
+            except Exception:  # pylint: disable=broad-except
+                # e.g. a session changed while it was pickled; keep the records for the next flush
+                with self.lock:
+                    self.chats.update(chats)
+                    self.requests.update(requests)
+                self.failures += 1
+                log.exception("Could not save %i records", len(chats) + len(requests))
+                return 0
+
+            elapsed = time.perf_counter() - started
+            count = len(chats) + len(requests)
+            self.flushes += 1
+            self.records += count
+            self.last_records = count
+            self.durations.append(elapsed)
+            self.reasons[reason] += 1
+        log.debug("Saved %i volunteers and %i requests (%s)", len(chats), len(requests), reason)
+        return count
+
+    def start(self):
+        """Flush in the background"""
+        if self.thread is not None:
+            return
+        self.thread = Thread(target=self.run, name="flusher", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Body of the background thread"""
+        while not self.stopped.is_set():
+            reason = "threshold" if self.wakeup.wait(self.interval) else "interval"
+            self.wakeup.clear()
+            if not self.stopped.is_set():
+                self.flush(reason)
+
+    def stop(self):
+        """Stop the background thread and save whatever is left"""
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush("shutdown")
+
+    def stats(self):
+        """Return how many records are waiting, how many were saved and how long the flushes take"""
+        with self.lock:
+            dirty = len(self.chats) + len(self.requests)
+        durations = sorted(self.durations)
+        return {
+            "dirty": dirty,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "records": self.records,
+            "last_records": self.last_records,
+            "last_flush_ms": round(self.durations[-1] * 1000, 1) if self.durations else None,
+            "p50_ms": percentile_ms(durations, 0.5),
+            "p95_ms": percentile_ms(durations, 0.95),
+            "reasons": dict(self.reasons),
+        }
+
+    def __len__(self):
+        return len(self.chats) + len(self.requests)
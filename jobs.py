@@ -0,0 +1,279 @@
+"""Tracking of the jobs started by the backend through the REST API. Announcing a request, assigning it or cancelling
+it means sending messages to several volunteers in the background; each of these operations is a job, and the
+backend gets its ID right away. It can then poll `/jobs/<id>` to find out how far the job got, who received the
+message, who was skipped (unknown or busy volunteers) and whose message failed, along with how long each send took.
+
+Only the most recent jobs are kept, in a bounded ring buffer, they are not persisted. The tracker also knows how many
+jobs of each kind are still waiting or running, which lets the REST API turn away new work when it is saturated."""
+
+import time
+import uuid
+from collections import Counter, OrderedDict
+from threading import Lock
+
+# How many jobs are remembered, the oldest ones are forgotten first
+DEFAULT_CAPACITY = 1024
+
+# Job statuses
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+PARTIAL = "partial"  # finished, but some of the recipients could not be reached
+FAILED = "failed"  # the job itself crashed
+
+# Per-recipient outcomes
+SENT = "sent"
+SKIPPED_UNKNOWN = "skipped_unknown"  # the volunteer hasn't started a chat with the bot
+SKIPPED_BUSY = "skipped_busy"  # the volunteer is already dealing with a request
+SKIPPED_BLOCKED = "skipped_blocked"  # the chat is unreachable, e.g. the volunteer blocked the bot
+DEFERRED = "deferred"  # sending failed for a transient reason, it will be retried in the background
+WITHDRAWN = "withdrawn"  # an announcement was deleted
+EDITED = "edited"  # an announcement was too old to be deleted, it was edited instead
+BATCHED = "batched"  # the announcement will be sent shortly, in a digest, see `digests.py`
+UNDELIVERED = "failed"
+
+# Weight of the most recent job in the average duration of a kind of job
+DURATION_SMOOTHING = 0.2
+
+OUTCOMES = (
+    SENT,
+    SKIPPED_UNKNOWN,
+    SKIPPED_BUSY,
+    SKIPPED_BLOCKED,
+    DEFERRED,
+    WITHDRAWN,
+    EDITED,
+    BATCHED,
+    UNDELIVERED,
+)
+
+
+class QueueFull(Exception):
+    """Raised when a job cannot be accepted because too many jobs are already waiting or running"""
+
+    def __init__(self, kind, pending, overall):
+        """:param kind: str, the kind of job that was refused
+        :param pending: int, how many jobs of this kind are waiting or running
+        :param overall: bool, True if it is the limit for all the kinds of jobs together that was reached"""
+        super().__init__("%i %s jobs pending" % (pending, kind))
+        self.kind = kind
+        self.pending = pending
+        self.overall = overall
+
+
+class Job:
+    """The progress of a single fan-out. It is meant to be used as a context manager by the function that does the
+    work, the job is marked as running when the block starts and as finished (or failed) when it ends, or once the
+    work it left pending is done, see `hold`."""
+
+    def __init__(self, kind, request_id=None, job_id=None, on_finish=None):
+        """Initialize the job
+        :param kind: str, what the job does, e.g. `help_request`
+        :param request_id: optional str, the request the job is about
+        :param job_id: optional str, a random ID is generated if not provided
+        :param on_finish: optional callable(job), invoked when the job is over, successful or not"""
+        self.job_id = job_id or uuid.uuid4().hex
+        self.on_finish = on_finish
+        self.kind = kind
+        self.request_id = request_id
+        self.status = PENDING
+        self.error = None
+        self.total = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # chat_id -> [outcome, elapsed seconds, error]
+        self.recipients = OrderedDict()
+        # how many parts of the work are still pending after the block is over, see `hold`
+        self.holds = 0
+        self.exited = False
+        self.lock = Lock()
+
+    def __enter__(self):
+        self.started = time.time()
+        self.status = RUNNING
+        return self
+
+    def __exit__(self, exc_type, exc_value, _traceback):
+        with self.lock:
+            if exc_type is not None:
+                self.error = "%s: %s" % (exc_type.__name__, exc_value)
+            self.exited = True
+            held = self.holds > 0
+        if not held:
+            self._finish()
+        # exceptions are not swallowed, they're still reported by the dispatcher
+        return False
+
+    def hold(self):
+        """Keep the job open after its block is over, until `release` is invoked, e.g. while some of its messages
+        wait to be sent in a digest"""
+        with self.lock:
+            self.holds += 1
+
+    def release(self):
+        """Let go of a `hold`; the job is over once its block is over and nothing holds it anymore"""
+        with self.lock:
+            self.holds -= 1
+            over = self.holds == 0 and self.exited
+        if over:
+            self._finish()
+
+    def _finish(self):
+        self.finished = time.time()
+        if self.error is not None:
+            # the job crashed, or the work was abandoned, e.g. the request is unknown
+            self.status = FAILED
+        elif any(entry[0] == UNDELIVERED for entry in self.recipients.values()):
+            self.status = PARTIAL
+        else:
+            self.status = DONE
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def abandon(self, error):
+        """Give up on a job that never got to run, e.g. its work could not be queued, so that it stops counting as
+        pending; a job that already started is left to finish on its own
+        :param error: str, why it was given up"""
+        if self.started is not None or self.finished is not None:
+            return
+        self.finished = time.time()
+        self.status = FAILED
+        self.error = error
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def expect(self, count):
+        """Announce how many recipients the job is going to deal with, so that progress can be computed"""
+        self.total += count
+
+    def record(self, chat_id, outcome, elapsed=0.0, error=None):
+        """Store the outcome for a recipient. If the recipient already has one (e.g. a deletion failed and the
+        message was edited instead, or a batched announcement was sent), the outcome is replaced and the time is added
+        up.
+        :param chat_id: int, the recipient
+        :param outcome: str, one of OUTCOMES
+        :param elapsed: float, how long it took, in seconds
+        :param error: optional exception or str, the reason of a failure"""
+        with self.lock:
+            previous = self.recipients.get(chat_id)
+            if previous is not None:
+                elapsed += previous[1]
+            self.recipients[chat_id] = [outcome, elapsed, None if error is None else str(error)]
+
+    def call(self, recipient, outcome, func, *args, **kwargs):
+        """Perform a call on behalf of a recipient, timing it and recording the outcome: `outcome` if it succeeds,
+        `UNDELIVERED` if it raises. Exceptions are re-raised, so the caller can still react to them.
+        :param recipient: int, the chat_id of the recipient
+        :param outcome: str, one of OUTCOMES, e.g. SENT
+        :param func: callable, e.g. `bot.send_message`, invoked with the rest of the arguments
+        :returns: whatever `func` returns"""
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as err:
+            self.record(recipient, UNDELIVERED, time.perf_counter() - started, err)
+            raise
+        self.record(recipient, outcome, time.perf_counter() - started)
+        return result
+
+    def summary(self):
+        """Return the job's status and counters, without the per-recipient details"""
+        with self.lock:
+            counts = dict.fromkeys(OUTCOMES, 0)
+            for outcome, _, _ in self.recipients.values():
+                counts[outcome] += 1
+            processed = len(self.recipients)
+
+        end = self.finished or time.time()
+        return {
+            "job": self.job_id,
+            "kind": self.kind,
+            "request_id": self.request_id,
+            "status": self.status,
+            "error": self.error,
+            "total": self.total,
+            "processed": processed,
+            "outcomes": counts,
+            "created": round(self.created, 3),
+            "queued_ms": round(((self.started or end) - self.created) * 1000, 1),
+            "elapsed_ms": round((end - self.started) * 1000, 1) if self.started else None,
+        }
+
+    def to_dict(self):
+        """Return the job's status along with the outcome of each recipient"""
+        result = self.summary()
+        with self.lock:
+            result["recipients"] = [
+                {
+                    "chat_id": chat_id,
+                    "outcome": outcome,
+                    "elapsed_ms": round(elapsed * 1000, 1),
+                    "error": error,
+                }
+                for chat_id, (outcome, elapsed, error) in self.recipients.items()
+            ]
+        return result
+
+
+class JobTracker:
+    """Ring buffer with the most recent jobs, indexed by job ID"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        # kind -> number of jobs that are waiting or running
+        self.active = Counter()
+        # kind -> average duration of the finished jobs, in seconds
+        self.durations = {}
+
+    def create(self, kind, request_id=None, limit=None, overall_limit=None):
+        """Start tracking a new job, forgetting the oldest one if the buffer is full
+        :param limit: optional int, maximum number of jobs of this kind that can be waiting or running
+        :param overall_limit: optional int, the same, for all the kinds of jobs together
+        :raises QueueFull: if one of the limits is reached, in which case the job is not created
+        :returns: Job"""
+        job = Job(kind, request_id, on_finish=self._finished)
+        with self.lock:
+            if limit is not None and self.active[kind] >= limit:
+                raise QueueFull(kind, self.active[kind], False)
+            if overall_limit is not None and sum(self.active.values()) >= overall_limit:
+                raise QueueFull(kind, self.active[kind], True)
+            self.active[kind] += 1
+            self.jobs[job.job_id] = job
+            while len(self.jobs) > self.capacity:
+                self.jobs.popitem(last=False)
+        return job
+
+    def _finished(self, job):
+        """Invoked by a job when it is over"""
+        duration = job.finished - (job.started or job.created)
+        with self.lock:
+            self.active[job.kind] -= 1
+            average = self.durations.get(job.kind, duration)
+            self.durations[job.kind] = average + DURATION_SMOOTHING * (duration - average)
+
+    def pending(self):
+        """Return a dict kind -> number of jobs that are waiting or running"""
+        with self.lock:
+            return {kind: count for kind, count in self.active.items() if count}
+
+    def average_duration(self, kind):
+        """Return the average duration of the jobs of a kind, in seconds, or None if none has finished yet"""
+        with self.lock:
+            return self.durations.get(kind)
+
+    def get(self, job_id):
+        """Return the job with the given ID, or None if it is unknown or was forgotten"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def recent(self):
+        """Return the summaries of the tracked jobs, newest first"""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [job.summary() for job in reversed(jobs)]
+
+    def __len__(self):
+        return len(self.jobs)
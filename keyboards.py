@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 
 from telegram import KeyboardButton, InlineKeyboardButton
 
+import callbacks
 import constants as c
 import timetools
 
@@ -22,109 +23,108 @@ initial_responses = [
     [KeyboardButton("/Nu")],
 ]
 
-# this one is not used at the moment
-eta_first_responses = [
-    [
-        InlineKeyboardButton("În 30min", callback_data="eta_30min"),
-        InlineKeyboardButton("Într-o oră", callback_data="eta_1h"),
-        InlineKeyboardButton("În 2 ore", callback_data="eta_2h"),
-    ],
-    [InlineKeyboardButton("Altă oră", callback_data="eta_later")],
-    [InlineKeyboardButton("Anulează", callback_data="eta_never")],
-]
 
+def button(text, route, arg, request_id=None):
+    """Build an inline button whose callback data is encoded by `callbacks.encode`
+    :param text: str, the label of the button
+    :param route: str, name of the route that will handle a press, e.g. `eta`
+    :param arg: str, route-specific argument
+    :param request_id: optional str, identifier of the request this button refers to"""
+    return InlineKeyboardButton(text, callback_data=callbacks.encode(route, arg, request_id))
 
-# this keyboard is sent to them before dispatching the volunteer to a beneficiary, to make sure they are
-# healthy themselves
-caution_choices = [
-    [InlineKeyboardButton("Sunt sănătos și fără simptome", callback_data="caution_ok")],
-    [InlineKeyboardButton("Hmm... Mai bine anulez", callback_data="caution_cancel")],
-]
 
-# this keyboard is sent to them before dispatching the volunteer to a beneficiary, to keep track of their progress
-handling_choices = [
-    [InlineKeyboardButton("M-am pornit", callback_data="handle_onmyway")],
-    [InlineKeyboardButton("Anulează", callback_data="handle_cancel")],
-]
+def caution_choices(request_id):
+    """This keyboard is sent to them before dispatching the volunteer to a beneficiary, to make sure they are
+    healthy themselves"""
+    return [
+        [button("Sunt sănătos și fără simptome", "caution", "ok", request_id)],
+        [button("Hmm... Mai bine anulez", "caution", "cancel", request_id)],
+    ]
 
-# shown after the volunteer pressed "I'm on my way"
-inprogress_choices = [
-    [InlineKeyboardButton("Misiune îndeplinită", callback_data="handle_done")],
-    [InlineKeyboardButton("Anulează", callback_data="handle_cancel")],
-]
 
-# shown when they pressed "mission accomplished"
-endgame_choices = [
-    [
-        InlineKeyboardButton(
-            "Nu am avut cheltuieli sau mi s-au întors banii", callback_data="handle_no_expenses"
-        )
-    ],
-]
+def handling_choices(request_id):
+    """This keyboard is sent to them before dispatching the volunteer to a beneficiary, to keep track of their
+    progress"""
+    return [
+        [button("M-am pornit", "handle", "onmyway", request_id)],
+        [button("Anulează", "handle", "cancel", request_id)],
+    ]
 
-# shown when the user is inquired about the beneficiary's wellbeing
-wellbeing_choices = [
-    [
-        InlineKeyboardButton(
-            "🥵 Foarte rea", callback_data="state_0"
-        ),  # there's an invisible emoji in the beginning
-        InlineKeyboardButton("😟 Rea", callback_data="state_1"),
-    ],
-    [InlineKeyboardButton("😐 Neutră", callback_data="state_2")],
-    [
-        InlineKeyboardButton("😃 Bună", callback_data="state_3"),
-        InlineKeyboardButton("😁 Foarte bună", callback_data="state_4"),
-    ],
-]
 
+def inprogress_choices(request_id):
+    """Shown after the volunteer pressed `I'm on my way`"""
+    return [
+        [button("Misiune îndeplinită", "handle", "done", request_id)],
+        [button("Anulează", "handle", "cancel", request_id)],
+    ]
 
-# shown when asking whether the beneficiary has any symptoms
-symptom_choices = [
-    [
-        InlineKeyboardButton("☐ Febră", callback_data="symptom_fever"),
-        InlineKeyboardButton("☐ Tuse", callback_data="symptom_cough"),
-        InlineKeyboardButton("☐ Respiră greu", callback_data="symptom_heavybreathing"),
-    ],
-    [InlineKeyboardButton("👍 Nu are simptome", callback_data="symptom_none")],
-    [InlineKeyboardButton("Nu știu", callback_data="symptom_noidea")],
-    [InlineKeyboardButton("Mai departe", callback_data="symptom_next")],
-]
 
+def endgame_choices(request_id):
+    """Shown when they pressed `mission accomplished`"""
+    return [
+        [
+            button(
+                "Nu am avut cheltuieli sau mi s-au întors banii",
+                "handle",
+                "no_expenses",
+                request_id,
+            )
+        ],
+    ]
 
-def new_symptom_choices():
-    """Return a new symptom-choice keyboard. Since they're user-specific, everyone needs their own keyboard"""
+
+def wellbeing_choices(request_id):
+    """Shown when the user is inquired about the beneficiary's wellbeing"""
     return [
         [
-            InlineKeyboardButton("☐ Febră", callback_data="symptom_fever"),
-            InlineKeyboardButton("☐ Tuse", callback_data="symptom_cough"),
-            InlineKeyboardButton("☐ Respiră greu", callback_data="symptom_heavybreathing"),
+            # there's an invisible emoji in the beginning
+            button("🥵 Foarte rea", "state", "0", request_id),
+            button("😟 Rea", "state", "1", request_id),
+        ],
+        [button("😐 Neutră", "state", "2", request_id)],
+        [
+            button("😃 Bună", "state", "3", request_id),
+            button("😁 Foarte bună", "state", "4", request_id),
         ],
-        [InlineKeyboardButton("ð Nu are simptome", callback_data="symptom_none")],
-        [InlineKeyboardButton("Nu știu", callback_data="symptom_noidea")],
-        [InlineKeyboardButton("Mai departe", callback_data="symptom_next")],
     ]
 
 
-# shown when onboarding volunteers, they select which type of contribution they can make
-assistance_choices = [
-    [
-        InlineKeyboardButton("☐ Transport", callback_data="assist_transport"),
-        InlineKeyboardButton("☐ Livrare", callback_data="assist_delivery"),
-        InlineKeyboardButton("☐ Apeluri", callback_data="assist_phone"),
-    ],
-    [InlineKeyboardButton("Mai departe", callback_data="assist_next")],
-]
+def new_symptom_choices(request_id):
+    """Return a new symptom-choice keyboard, shown when asking whether the beneficiary has any symptoms. Since
+    they're user-specific, everyone needs their own keyboard"""
+    return [
+        [
+            button("☐ Febră", "symptom", "fever", request_id),
+            button("☐ Tuse", "symptom", "cough", request_id),
+            button("☐ Respiră greu", "symptom", "heavybreathing", request_id),
+        ],
+        [button("ð Nu are simptome", "symptom", "none", request_id)],
+        [button("Nu știu", "symptom", "noidea", request_id)],
+        [button("Mai departe", "symptom", "next", request_id)],
+    ]
+
+
+def digest_choices(requests):
+    """Shown along with a digest of several requests, one button per request, in the same order as in the message
+    :param requests: list of models.HelpRequest"""
+    keyboard = [
+        [button("%i. %s" % (number, request.address[:40]), "pick", "yes", request.request_id)]
+        for number, request in enumerate(requests, 1)
+    ]
+    keyboard.append([button("Nu pot acum", "pick", "none")])
+    return keyboard
 
 
 def new_assistance_choices():
-    """Return a new assistance-choice keyboard. Since they're user-specific, everyone needs their own keyboard"""
+    """Return a new assistance-choice keyboard, shown when onboarding volunteers, they select which type of
+    contribution they can make. Since they're user-specific, everyone needs their own keyboard"""
     return [
         [
-            InlineKeyboardButton("☐ Transport", callback_data="assist_transport"),
-            InlineKeyboardButton("☐ Livrare", callback_data="assist_delivery"),
-            InlineKeyboardButton("☐ Apeluri", callback_data="assist_phone"),
+            button("☐ Transport", "assist", "transport"),
+            button("☐ Livrare", "assist", "delivery"),
+            button("☐ Apeluri", "assist", "phone"),
         ],
-        [InlineKeyboardButton("Mai departe", callback_data="assist_next")],
+        [button("Mai departe", "assist", "next")],
     ]
 
 
@@ -166,40 +166,37 @@ def update_dynamic_keyboard_symptom(keyboard, symptom):
     return keyboard
 
 
-# shown when asking whether the beneficiary has any symptoms
-would_you_do_it_again_choices = [
-    [InlineKeyboardButton("Da", callback_data="wouldyou_yes")],
-    [InlineKeyboardButton("Nu", callback_data="wouldyou_no")],
-]
+def would_you_do_it_again_choices(request_id):
+    """Shown when asking whether they would help this beneficiary again"""
+    return [
+        [button("Da", "wouldyou", "yes", request_id)],
+        [button("Nu", "wouldyou", "no", request_id)],
+    ]
 
-# shown when asking whether the volunteer has further comments about the beneficiary
-further_comments_choices = [
-    [InlineKeyboardButton("Nu am comentarii", callback_data="furthercomments_no")],
-]
+
+def further_comments_choices(request_id):
+    """Shown when asking whether the volunteer has further comments about the beneficiary"""
+    return [
+        [button("Nu am comentarii", "further", "no", request_id)],
+    ]
 
 
-def build_dynamic_keyboard_first_responses():
-    """Build a dynamic keyboard that looks like `eta_first_responses`, but where the callback data contains
-    timestamps that are N minutes in the future from now"""
+def build_dynamic_keyboard_first_responses(request_id=None):
+    """Build a dynamic keyboard with the first ETA choices, where the callback data contains timestamps that are N
+    minutes in the future from now
+    :param request_id: optional str, identifier of the request the volunteer is responding to"""
     # NOTE: in this case none of the actual timestamps are shown to the user, so the callback info
     #       is in UTC, users will only see relative offsets, like "in 30min" or "in 1 h", so they're unchanged
     now = datetime.utcnow()
-    timedelta(minutes=30)
 
     return [
         [
-            InlineKeyboardButton(
-                "În 30min", callback_data="eta_" + (now + timedelta(minutes=30)).strftime("%H:%M")
-            ),
-            InlineKeyboardButton(
-                "Într-o oră", callback_data="eta_" + (now + timedelta(hours=1)).strftime("%H:%M")
-            ),
-            InlineKeyboardButton(
-                "În 2 ore", callback_data="eta_" + (now + timedelta(hours=2)).strftime("%H:%M")
-            ),
+            button("În 30min", "eta", (now + timedelta(minutes=30)).strftime("%H:%M"), request_id),
+            button("Într-o oră", "eta", (now + timedelta(hours=1)).strftime("%H:%M"), request_id),
+            button("În 2 ore", "eta", (now + timedelta(hours=2)).strftime("%H:%M"), request_id),
         ],
-        [InlineKeyboardButton("Altă oră", callback_data="eta_later")],
-        [InlineKeyboardButton("Anulează", callback_data="eta_never")],
+        [button("Altă oră", "eta", "later", request_id)],
+        [button("Anulează", "eta", "never", request_id)],
     ]
 
 
@@ -227,14 +224,15 @@ def chunkify(lst, n=4):
         yield lst[i : i + n]
 
 
-def build_dynamic_keyboard(time_from=None):
+def build_dynamic_keyboard(time_from=None, request_id=None):
     """Construct a keyboard with various time options to choose from
     :param time_from: optional datetime, by default it is now
+    :param request_id: optional str, identifier of the request the volunteer is responding to
     :returns: Telegram keyboard that has 4 time options per row, it looks like this:
     keyboard = [
-        [InlineKeyboardButton("15:32", callback_data="eta_15:32"),
-        InlineKeyboardButton("16:02", callback_data="eta_16:02"),
-        InlineKeyboardButton("16:32", callback_data="eta_16:32")],
+        [button("15:32", "eta", "15:32", request_id),
+        button("16:02", "eta", "16:02", request_id),
+        button("16:32", "eta", "16:32", request_id)],
         ...
     ]
     """
@@ -251,7 +249,7 @@ def build_dynamic_keyboard(time_from=None):
     for entry in chunkified_times:
         row = []
         for utc_time, user_time in entry:
-            row.append(InlineKeyboardButton(user_time, callback_data="eta_" + utc_time))
+            row.append(button(user_time, "eta", utc_time, request_id))
         keyboard.append(row)
     return keyboard
 
@@ -260,4 +258,4 @@ if __name__ == "__main__":
     # print(build_dynamic_keyboard())
     print(build_dynamic_keyboard_first_responses())
 
-    # print(update_dynamic_keyboard_symptom(symptom_choices, "symptom_fever"))
+    # print(update_dynamic_keyboard_symptom(new_symptom_choices(None), "symptom_fever"))
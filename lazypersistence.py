@@ -0,0 +1,449 @@
+"""A persistence backend that does not load the whole state at startup. Unlike `PicklePersistence`, which unpickles
+every volunteer's `user_data` and every open request before the first update is processed, this one keeps
+
+- `<name>.dat` - an append-only file with pickled records, one per chat_id (user_data) or per key of bot_data
+- `<name>.idx` - a memory-mapped hash table that maps a key to the offset and length of its latest record
+
+Opening the state only maps the index, so startup time does not depend on the number of volunteers. A record is
+read and unpickled the first time its key is accessed, and rewritten (appended) whenever it changes. Obsolete
+records are dropped by compacting the data file once they take up more than half of it.
+
+Run `python lazypersistence.py` to see a startup-time comparison against PicklePersistence."""
+
+import logging
+import mmap
+import os
+import pickle
+import struct
+import zlib
+from collections import defaultdict
+from hashlib import blake2b
+from threading import RLock
+
+from telegram.ext import BasePersistence
+
+log = logging.getLogger("lazy")  # pylint: disable=invalid-name
+
+MAGIC = b"AJIX"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sIIIQ")  # magic, version, capacity, used slots, live bytes
+SLOT = struct.Struct("<qQIB3x")  # key, offset, length, kind
+INITIAL_CAPACITY = 1024
+MAX_LOAD = 0.7
+
+# values of the `kind` field of a slot
+EMPTY = 0
+USER = 1
+BOT = 2
+DELETED = 255
+
+MASK64 = (1 << 64) - 1
+
+
+def key_hash(key):
+    """Map a user_data or bot_data key to a signed 64-bit integer. Chat IDs are used as they are, everything else
+    (i.e. request IDs) is hashed"""
+    if isinstance(key, int):
+        return key
+    digest = blake2b(str(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class RecordStore:
+    """The on-disk part: data file + memory-mapped index"""
+
+    def __init__(self, name):
+        """Open (or create) a store
+        :param name: str, path prefix, `.idx` and `.dat` are appended to it"""
+        self.index_path = name + ".idx"
+        self.data_path = name + ".dat"
+        self.lock = RLock()
+        # crc32 of the last record read or written for each key, this way we can tell if something changed
+        self.checksums = {}
+
+        self.data = open(self.data_path, "a+b")
+        self.data_size = self.data.seek(0, os.SEEK_END)
+        if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) == 0:
+            self._create_index(self.index_path, INITIAL_CAPACITY)
+        self._map_index()
+
+    @staticmethod
+    def _create_index(path, capacity, live_bytes=0):
+        with open(path, "wb") as index:
+            index.write(HEADER.pack(MAGIC, FORMAT_VERSION, capacity, 0, live_bytes))
+            index.truncate(HEADER.size + capacity * SLOT.size)
+
+    def _map_index(self):
+        self.index_file = open(self.index_path, "r+b")
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+        magic, version, self.capacity, self.used, self.live_bytes = HEADER.unpack_from(self.index)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise TypeError("File %s is not a state index" % self.index_path)
+
+    def _write_header(self):
+        HEADER.pack_into(
+            self.index, 0, MAGIC, FORMAT_VERSION, self.capacity, self.used, self.live_bytes
+        )
+
+    def _probe(self, kind, key64):
+        """Find the slot of a key
+        :returns: tuple(position, found), if not found, position is where the key can be inserted"""
+        mask = self.capacity - 1
+        position = ((key64 * 0x9E3779B97F4A7C15 + kind) & MASK64) >> 20 & mask
+        free = None
+        while True:
+            slot_key, _, _, slot_kind = SLOT.unpack_from(
+                self.index, HEADER.size + position * SLOT.size
+            )
+            if slot_kind == EMPTY:
+                return (position if free is None else free), False
+            if slot_kind == DELETED:
+                if free is None:
+                    free = position
+            elif slot_kind == kind and slot_key == key64:
+                return position, True
+            position = (position + 1) & mask
+
+    def _slot(self, position):
+        return SLOT.unpack_from(self.index, HEADER.size + position * SLOT.size)
+
+    def _set_slot(self, position, key64, offset, length, kind):
+        SLOT.pack_into(self.index, HEADER.size + position * SLOT.size, key64, offset, length, kind)
+
+    def exists(self, kind, key):
+        """Tell whether there is a record for a key"""
+        with self.lock:
+            return self._probe(kind, key_hash(key))[1]
+
+    def read(self, kind, key):
+        """Load the record of a key
+        :returns: tuple(found, value)"""
+        with self.lock:
+            position, found = self._probe(kind, key_hash(key))
+            if not found:
+                return False, None
+            _, offset, length, _ = self._slot(position)
+            raw = os.pread(self.data.fileno(), length, offset)
+
+            stored_key, value = pickle.loads(raw)  # nosec, this is our own file
+            if stored_key != key:
+                # two different request IDs ended up with the same hash; practically impossible with 64 bits
+                raise KeyError("Hash collision between %r and %r" % (stored_key, key))
+            self.checksums[(kind, key)] = zlib.crc32(raw)
+        return True, value
+
+    def write(self, kind, key, value):
+        """Save a record, if it is different from the one that is already saved
+        :returns: bool, True if something was written"""
+        raw = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        checksum = zlib.crc32(raw)
+        with self.lock:
+            if self.checksums.get((kind, key)) == checksum:
+                return False
+
+            key64 = key_hash(key)
+            position, found = self._probe(kind, key64)
+            if found:
+                self.live_bytes -= self._slot(position)[2]
+            elif self._slot(position)[3] == EMPTY:
+                self.used += 1
+
+            offset = self.data_size
+            self.data.write(raw)
+            self.data.flush()
+            self.data_size += len(raw)
+            self.live_bytes += len(raw)
+            self._set_slot(position, key64, offset, len(raw), kind)
+            self._write_header()
+            self.checksums[(kind, key)] = checksum
+
+            self._maintain()
+        return True
+
+    def delete(self, kind, key):
+        """Remove the record of a key
+        :returns: bool, True if there was such a record"""
+        with self.lock:
+            self.checksums.pop((kind, key), None)
+            position, found = self._probe(kind, key_hash(key))
+            if not found:
+                return False
+            key64, _, length, _ = self._slot(position)
+            self._set_slot(position, key64, 0, 0, DELETED)
+            self.live_bytes -= length
+            self._write_header()
+        return True
+
+    def _maintain(self):
+        """Grow the index when it gets too full, compact the data file when most of it is garbage"""
+        if self.used > self.capacity * MAX_LOAD or self.data_size > 2 * self.live_bytes + (1 << 20):
+            self.rebuild()
+
+    def entries(self):
+        """Iterate over (kind, offset, length) of all the live records"""
+        with self.lock:
+            for position in range(self.capacity):
+                _, offset, length, kind = self._slot(position)
+                if kind not in (EMPTY, DELETED):
+                    yield kind, offset, length
+
+    def rebuild(self):
+        """Rewrite the data file and the index, keeping only live records. The new files are built next to the old
+        ones and then moved into place."""
+        with self.lock:
+            live = list(self.entries())
+            capacity = INITIAL_CAPACITY
+            while len(live) > capacity * MAX_LOAD / 2:
+                capacity *= 2
+            log.info("Rebuilding state, %i records, index capacity %i", len(live), capacity)
+
+            self._create_index(self.index_path + ".tmp", capacity)
+            fresh = RecordStore.__new__(RecordStore)
+            fresh.index_file = open(self.index_path + ".tmp", "r+b")
+            fresh.index = mmap.mmap(fresh.index_file.fileno(), 0)
+            fresh.capacity, fresh.used, fresh.live_bytes = capacity, 0, 0
+
+            with open(self.data_path + ".tmp", "wb") as data:
+                for kind, offset, length in live:
+                    raw = os.pread(self.data.fileno(), length, offset)
+                    key64 = key_hash(pickle.loads(raw)[0])  # nosec, this is our own file
+                    position, _ = fresh._probe(kind, key64)  # pylint: disable=protected-access
+                    fresh._set_slot(  # pylint: disable=protected-access
+                        position, key64, data.tell(), length, kind
+                    )
+                    fresh.used += 1
+                    fresh.live_bytes += length
+                    data.write(raw)
+            fresh._write_header()  # pylint: disable=protected-access
+            fresh.index.close()
+            fresh.index_file.close()
+
+            self.close()
+            os.replace(self.data_path + ".tmp", self.data_path)
+            os.replace(self.index_path + ".tmp", self.index_path)
+            self.data = open(self.data_path, "a+b")
+            self.data_size = self.data.seek(0, os.SEEK_END)
+            self._map_index()
+
+    def flush(self):
+        """Make sure everything reached the disk"""
+        with self.lock:
+            self.index.flush()
+            self.data.flush()
+            os.fsync(self.data.fileno())
+
+    def close(self):
+        with self.lock:
+            self.index.close()
+            self.index_file.close()
+            self.data.close()
+
+
+class LazyDict(defaultdict):
+    """A dictionary whose values are loaded from a RecordStore the first time they are accessed. Iterating over it
+    only yields the keys that were loaded (or added) so far, use `stored_keys` to list everything."""
+
+    def __init__(self, store, kind, default_factory=None):
+        super().__init__(default_factory)
+        self.store = store
+        self.kind = kind
+        # optional callable applied to each value as it is loaded, e.g. to upgrade records saved in an older format
+        self.convert = None
+
+    def __reduce__(self):
+        # when copied or pickled, it turns into an ordinary dictionary with whatever was loaded
+        return dict, (dict(self),)
+
+    def __missing__(self, key):
+        # two threads may ask for the same key at once; the loading is done under the store's lock, and whichever
+        # gets there second finds the value loaded by the first, so both change the same object
+        with self.store.lock:
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+            found, value = self.store.read(self.kind, key)
+            if found:
+                if self.convert is not None:
+                    value = self.convert(value)
+            elif self.default_factory is None:
+                raise KeyError(key)
+            else:
+                value = self.default_factory()
+            return dict.setdefault(self, key, value)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self.store.exists(self.kind, key)
+
+    def __delitem__(self, key):
+        loaded = dict.__contains__(self, key)
+        if loaded:
+            dict.__delitem__(self, key)
+        if not self.store.delete(self.kind, key) and not loaded:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def stored_keys(self):
+        """Return the keys of all the records, loading all of them in the process. Meant for introspection."""
+        loaded = set(dict.keys(self))
+        for kind, offset, length in list(self.store.entries()):
+            if kind == self.kind:
+                raw = os.pread(self.store.data.fileno(), length, offset)
+                loaded.add(pickle.loads(raw)[0])  # nosec, this is our own file
+        return loaded
+
+    def save(self):
+        """Write the loaded records that changed since they were read"""
+        for key, value in list(dict.items(self)):
+            self.store.write(self.kind, key, value)
+
+
+class LazyPersistence(BasePersistence):
+    """Drop-in replacement for PicklePersistence, that only loads the parts of the state that are actually used.
+    It keeps user_data and bot_data; chat_data and conversations are not used by the bot, so they are not stored."""
+
+    def __init__(self, name, store_user_data=True, store_bot_data=True, on_flush=False):
+        """Open the state
+        :param name: str, path prefix of the state files
+        :param store_user_data: bool, whether user_data should be persisted
+        :param store_bot_data: bool, whether bot_data should be persisted
+        :param on_flush: bool, like in PicklePersistence, if True, the changes are only written by `flush`"""
+        super().__init__(
+            store_user_data=store_user_data, store_chat_data=False, store_bot_data=store_bot_data
+        )
+        self.store = RecordStore(name)
+        self.user_data = LazyDict(self.store, USER, dict)
+        self.bot_data = LazyDict(self.store, BOT)
+        self.on_flush = on_flush
+        # user_id -> data, the changes that wait for `flush`; the dispatcher adds to it while the flusher drains it
+        self.pending = {}
+        self.pending_lock = RLock()
+        self.bot_data_changed = False
+
+    @classmethod
+    def from_pickle(cls, pickle_path, name):
+        """Create a lazy state out of a PicklePersistence file, it is used for migrating an existing deployment
+        :param pickle_path: str, the file used by PicklePersistence, e.g. `state.bin`
+        :param name: str, path prefix of the new state files"""
+        with open(pickle_path, "rb") as source:
+            data = pickle.load(source)  # nosec, this is our own file
+        persistence = cls(name)
+        for chat_id, user_data in data["user_data"].items():
+            persistence.store.write(USER, chat_id, user_data)
+        for key, value in data.get("bot_data", {}).items():
+            persistence.store.write(BOT, key, value)
+        persistence.flush()
+        log.info("Imported %i volunteers from %s", len(data["user_data"]), pickle_path)
+        return persistence
+
+    def get_user_data(self):
+        return self.user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return self.bot_data
+
+    def get_conversations(self, name):
+        return {}
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+    def update_user_data(self, user_id, data):
+        if self.on_flush:
+            with self.pending_lock:
+                self.pending[user_id] = data
+        else:
+            self.store.write(USER, user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        # `data` is the same LazyDict we handed to the dispatcher, only the loaded entries can have changed
+        if self.on_flush:
+            self.bot_data_changed = True
+        else:
+            self.bot_data.save()
+
+    def flush(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        for user_id, data in pending.items():
+            self.store.write(USER, user_id, data)
+        if self.bot_data_changed:
+            self.bot_data_changed = False
+            self.bot_data.save()
+        self.store.flush()
+
+
+def benchmark(volunteers, workdir):
+    """Compare the startup time of PicklePersistence and LazyPersistence, for a synthetic state
+    :param volunteers: int, how many volunteers to generate
+    :param workdir: str, where to put the state files"""
+    # pylint: disable=import-outside-toplevel
+    import time
+    from telegram.ext import PicklePersistence
+    import constants as c
+
+    user_data = {
+        100000 + i: {"state": c.State.AVAILABLE, "reviewed_request": None, "current_request": None}
+        for i in range(volunteers)
+    }
+    bot_data = {
+        "%024x" % i: {"request_id": "%024x" % i, "volunteers": list(range(100000, 100050))}
+        for i in range(volunteers // 100)
+    }
+    pickle_path = os.path.join(workdir, "bench-%i.bin" % volunteers)
+    with open(pickle_path, "wb") as out:
+        data = {"user_data": user_data, "bot_data": bot_data, "chat_data": {}, "conversations": {}}
+        pickle.dump(data, out)
+    lazy_name = os.path.join(workdir, "bench-%i" % volunteers)
+    LazyPersistence.from_pickle(pickle_path, lazy_name).store.close()
+
+    started = time.perf_counter()
+    eager = PicklePersistence(pickle_path)
+    eager.get_user_data()
+    eager.get_bot_data()
+    eager_startup = time.perf_counter() - started
+
+    started = time.perf_counter()
+    lazy = LazyPersistence(lazy_name)
+    lazy.get_user_data()
+    lazy.get_bot_data()
+    lazy_startup = time.perf_counter() - started
+
+    started = time.perf_counter()
+    _ = lazy.user_data[100000 + volunteers // 2]["state"]
+    first_access = time.perf_counter() - started
+    lazy.store.close()
+
+    print(
+        "%7i volunteers: pickle startup %8.2f ms, lazy startup %6.2f ms, first access %5.3f ms"
+        % (volunteers, eager_startup * 1000, lazy_startup * 1000, first_access * 1000)
+    )
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in (10000, 100000):
+            benchmark(count, tmp)
@@ -0,0 +1,203 @@
+"""Logging configuration. Log records are put in a queue by the thread that emits them and written by a background
+thread, so that formatting and I/O do not slow down the handlers. On the way, records are
+
+- rate limited per logger, if a logger gets too chatty, the excess debug and info records are dropped and a summary
+  is logged later
+- stripped of big payloads: dicts and lists passed as arguments are shortened, and at DEBUG level only a sample of
+  the records that carry payloads is kept
+- rendered as JSON lines (or as plain text, for local development)
+
+Log levels can be changed at runtime, see `set_level` and the `/loglevel` endpoint of the REST API."""
+
+import json
+import logging
+import random
+import reprlib
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+from threading import Lock
+
+TEXT_FORMAT = "%(asctime)s %(levelname)5s %(name)5s - %(message)s"
+
+# maximum number of records per second for each logger, the rest are dropped
+DEFAULT_RATE_LIMIT = 200
+# fraction of the DEBUG records with payloads (dicts, lists) that are kept
+DEFAULT_PAYLOAD_SAMPLE = 1.0
+# how much of a payload is kept, roughly in characters
+PAYLOAD_LENGTH = 300
+
+_listener = None  # pylint: disable=invalid-name
+
+
+class PayloadRepr(reprlib.Repr):
+    """Bounded representation of payloads, the cost does not depend on how big the payload is"""
+
+    def __init__(self):
+        super().__init__()
+        self.maxlevel = 3
+        self.maxdict = 12
+        self.maxlist = 12
+        self.maxstring = 80
+        self.maxother = 80
+
+
+_payload_repr = PayloadRepr()  # pylint: disable=invalid-name
+
+
+class RateLimitFilter(logging.Filter):
+    """Drop the records of a logger that exceed a number of records per second. When the logger calms down, a
+    summary with the number of dropped records is emitted. Warnings and errors are never dropped."""
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT):
+        super().__init__()
+        self.rate = rate
+        self.lock = Lock()
+        # logger name -> [second, count, dropped]
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = int(time.monotonic())
+        with self.lock:
+            window = self.windows.get(record.name)
+            if window is None or window[0] != now:
+                dropped = window[2] if window else 0
+                self.windows[record.name] = [now, 1, 0]
+                if dropped:
+                    record.msg = "(%i messages suppressed) " % dropped + str(record.msg)
+                return True
+            window[1] += 1
+            if window[1] > self.rate:
+                window[2] += 1
+                return False
+        return True
+
+
+class PayloadFilter(logging.Filter):
+    """Sample the DEBUG records that carry payloads and shorten the payloads. This runs in the thread that emits the
+    record, which is why the payload is never fully rendered here."""
+
+    def __init__(self, sample=DEFAULT_PAYLOAD_SAMPLE):
+        super().__init__()
+        self.sample = sample
+
+    def filter(self, record):
+        args = record.args
+        if isinstance(args, dict) and "%(" not in str(record.msg):
+            # `log.debug("%s", payload)` with a single dict is stored by `logging` as the dict itself
+            args = (args,)
+        if not args or not isinstance(args, tuple):
+            return True
+
+        if not any(isinstance(arg, (dict, list, tuple, set)) for arg in args):
+            return True
+
+        # Bandit complains this is not a proper randomizer, but it is good enough for sampling logs
+        if record.levelno <= logging.DEBUG and random.random() >= self.sample:  # nosec
+            return False
+
+        record.args = tuple(
+            _payload_repr.repr(arg) if isinstance(arg, (dict, list, tuple, set)) else arg
+            for arg in args
+        )
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Render a record as a single line of JSON"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage()[: PAYLOAD_LENGTH * 4],
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # already rendered by DeferredQueueHandler
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Unlike the stock QueueHandler, it leaves the formatting of the message to the writer thread"""
+
+    def prepare(self, record):
+        if record.exc_info:
+            # tracebacks can't travel through the queue, render them right away
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure(
+    level=logging.DEBUG,
+    json_lines=True,
+    rate_limit=DEFAULT_RATE_LIMIT,
+    payload_sample=DEFAULT_PAYLOAD_SAMPLE,
+    stream=None,
+):
+    """Set up the queued logging for the whole application
+    :param level: int or str, the level of the root logger
+    :param json_lines: bool, if True the records are written as JSON lines, otherwise as plain text
+    :param rate_limit: int, maximum number of records per second for each logger
+    :param payload_sample: float between 0 and 1, fraction of the DEBUG records with payloads that are kept
+    :param stream: optional file-like object where the logs are written, stderr by default"""
+    global _listener  # pylint: disable=global-statement,invalid-name
+    shutdown()
+
+    writer = logging.StreamHandler(stream or sys.stderr)
+    if json_lines:
+        writer.setFormatter(JsonFormatter())
+    else:
+        writer.setFormatter(logging.Formatter(TEXT_FORMAT, datefmt="%H:%M:%S"))
+
+    queue = Queue(-1)
+    handler = DeferredQueueHandler(queue)
+    handler.addFilter(RateLimitFilter(rate_limit))
+    handler.addFilter(PayloadFilter(payload_sample))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(queue, writer, respect_handler_level=False)
+    _listener.start()
+
+
+def shutdown():
+    """Write whatever is still in the queue and stop the writer thread"""
+    global _listener  # pylint: disable=global-statement,invalid-name
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_levels():
+    """Return a dictionary with the effective level of the root logger and of all the named loggers"""
+    levels = {"root": logging.getLevelName(logging.getLogger().level)}
+    for name in sorted(logging.root.manager.loggerDict):
+        logger = logging.getLogger(name)
+        if logger.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(logger.level)
+    return levels
+
+
+def set_level(name, level):
+    """Change the level of a logger at runtime
+    :param name: str, name of the logger, `root` or an empty string stands for the root logger
+    :param level: str or int, e.g. `INFO` or 20
+    :raises ValueError: if the level is not known"""
+    if isinstance(level, str):
+        if level.upper() not in logging._nameToLevel:  # pylint: disable=protected-access
+            raise ValueError("Unknown log level `%s`" % level)
+        level = level.upper()
+    logging.getLogger(None if name in ("", "root") else name).setLevel(level)
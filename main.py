@@ -4,18 +4,26 @@ import logging
 import sys
 import os
 
-from telegram.ext import Updater, PicklePersistence
+from telegram.ext import Updater
 
 from constants import VERSION
 from backend_api import Backender
 from ajubot import Ajubot
+from replay import Recorder
+from tenants import Tenants, make_persistence, parse_tokens
+from tracing import JsonlSink, Tracer
+import autoscale
+import logsetup
 
 log = logging.getLogger("main")
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s %(levelname)5s %(name)5s - %(message)s",
-    datefmt="%H:%M:%S",
+# logs are written by a background thread; set COVID_LOG_FORMAT=text to get human-readable lines instead of JSON
+logsetup.configure(
+    level=os.environ.get("COVID_LOG_LEVEL", "DEBUG"),
+    json_lines=os.environ.get("COVID_LOG_FORMAT", "json") == "json",
+    payload_sample=float(
+        os.environ.get("COVID_LOG_PAYLOAD_SAMPLE", logsetup.DEFAULT_PAYLOAD_SAMPLE)
+    ),
 )
 
 # you might want to re-enable these two lines if you really need to debug the bot's internals
@@ -25,25 +33,79 @@ logging.getLogger("JobQueue").setLevel(logging.WARNING)
 log.info("Starting Ajubot v%s", VERSION)
 
 try:
-    token = os.environ["TELEGRAM_TOKEN"]
     covid_backend_url = os.environ["COVID_BACKEND"]
     covid_backend_user = os.environ["COVID_BACKEND_USER"]
     covid_backend_pass = os.environ["COVID_BACKEND_PASS"]
+    # with TELEGRAM_TOKENS=chisinau=123:ABC,balti=456:DEF several bots run in this process, see tenants.py
+    tokens = (
+        parse_tokens(os.environ["TELEGRAM_TOKENS"]) if "TELEGRAM_TOKENS" in os.environ else None
+    )
+    token = None if tokens else os.environ["TELEGRAM_TOKEN"]
 except KeyError as key:
     sys.exit(f"Set {key} environment variable before running the bot")
+except ValueError as err:
+    sys.exit(f"TELEGRAM_TOKENS is malformed: {err}")
 
 covid_backend = Backender(covid_backend_url, covid_backend_user, covid_backend_pass)
 
-# this will be used to keep some state-related info in a file that survives across bot restarts
-pickler = PicklePersistence("state.bin")
+# the state is kept in files that survive across bot restarts. With COVID_PERSISTENCE=lazy the state is loaded on
+# demand, which makes restarts fast when there are many volunteers
+lazy = os.environ.get("COVID_PERSISTENCE", "pickle") == "lazy"
 
-updater = Updater(token=token, use_context=True, persistence=pickler)
-ajubot = Ajubot(updater, covid_backend)
+# with COVID_RECORD=traffic.jsonl, the incoming traffic is recorded (without personal data), so that it can be
+# replayed later with `python replay.py traffic.jsonl`
+record = os.environ.get("COVID_RECORD")
+
+# with COVID_CONCURRENT_UPDATES=1, the updates of different volunteers are handled in parallel, see concurrency.py
+concurrent = os.environ.get("COVID_CONCURRENT_UPDATES", "0") == "1"
+
+# with COVID_TRACE=traces.jsonl, the spans of each request's lifecycle are exported, see tracing.py
+trace = os.environ.get("COVID_TRACE")
+
+# the dispatcher's workers grow up to COVID_MAX_WORKERS when the work backs up, and shrink back when it is quiet, see
+# autoscale.py; each worker may need its own connection to Telegram
+max_workers = int(os.environ.get("COVID_MAX_WORKERS", autoscale.DEFAULT_MAXIMUM))
+
+# the log levels and the memory tracing can only be changed from the same machine, or by a caller that sends
+# `Authorization: Bearer $COVID_ADMIN_TOKEN`, see restapi.py
+admin_token = os.environ.get("COVID_ADMIN_TOKEN")
+
+if tokens:
+    server = Tenants(
+        covid_backend,
+        lazy=lazy,
+        record=record,
+        concurrent_updates=concurrent,
+        trace=trace,
+        max_workers=max_workers,
+        admin_token=admin_token,
+    )
+    for name, tenant_token in tokens.items():
+        server.add(name, tenant_token)
+else:
+    recorder = Recorder(record) if record else None
+    updater = Updater(
+        token=token,
+        use_context=True,
+        persistence=make_persistence("state", lazy),
+        request_kwargs={"con_pool_size": max_workers + 4},
+    )
+    tracer = Tracer(JsonlSink(trace) if trace else None)
+    server = Ajubot(
+        updater,
+        covid_backend,
+        recorder=recorder,
+        concurrent_updates=concurrent,
+        tracer=tracer,
+        max_workers=max_workers,
+        admin_token=admin_token,
+    )
 
 try:
-    ajubot.serve()
+    server.serve()
 except KeyboardInterrupt:
     log.debug("Interactive quit")
     sys.exit()
 finally:
     log.info("Quitting")
+    logsetup.shutdown()
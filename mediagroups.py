@@ -0,0 +1,59 @@
+"""Coalescing of the photos that are sent as an album. Telegram delivers each photo of an album as a separate update,
+all of them carrying the same `media_group_id`, and there is no way to tell which one is the last. The collector
+waits until no new photo arrived for a group during a short window, then hands over the whole group at once."""
+
+import logging
+from threading import Lock, Timer, current_thread
+
+log = logging.getLogger("mediagroups")  # pylint: disable=invalid-name
+
+# How long to wait for the next photo of an album, in seconds. Telegram sends them back-to-back, so this only has to
+# cover the jitter between updates
+DEFAULT_WINDOW = 1.5
+
+
+class MediaGroupCollector:
+    """Accumulates the items of a media group and invokes a callback once the group is complete"""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        """Initialize the collector
+        :param window: float, seconds of silence after which a group is considered complete"""
+        self.window = window
+        # media_group_id -> (list of items, Timer that will complete the group)
+        self.groups = {}
+        self.lock = Lock()
+
+    def add(self, group_id, item, on_complete):
+        """Add an item to a group, restarting the group's countdown
+        :param group_id: str, the `media_group_id` of the message
+        :param item: anything, it will be passed to `on_complete` along with the other items of the group
+        :param on_complete: callable(items), invoked once per group, from a separate thread. If items keep arriving,
+                            the callback of the most recent one is used"""
+        with self.lock:
+            items, timer = self.groups.get(group_id, ([], None))
+            if timer is not None:
+                timer.cancel()
+            items.append(item)
+            timer = Timer(self.window, self._complete, (group_id, on_complete))
+            timer.daemon = True
+            self.groups[group_id] = (items, timer)
+            timer.start()
+
+    def _complete(self, group_id, on_complete):
+        """Invoked by the group's timer when the window expires"""
+        with self.lock:
+            items, timer = self.groups.get(group_id, (None, None))
+            if timer is not current_thread():
+                # another item arrived just as the window expired, its timer will take care of the group
+                return
+            del self.groups[group_id]
+
+        log.debug("Media group %s complete, %i items", group_id, len(items))
+        try:
+            on_complete(items)
+        except Exception:  # pylint: disable=broad-except
+            # this runs in its own thread, nobody else would hear about it
+            log.exception("Could not handle media group %s", group_id)
+
+    def __len__(self):
+        return len(self.groups)
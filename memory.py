@@ -0,0 +1,254 @@
+"""Where the bot's memory goes. Three views, served by the REST API under `/memory`:
+
+- the deep size of the state: `user_data` broken down by the attributes of the sessions (e.g. the keyboards kept
+  while a volunteer answers a questionnaire), `bot_data` by key, with the largest requests listed separately
+- `tracemalloc` snapshots taken on demand, and the differences between two of them, to see what grows over time;
+  tracing is only turned on by the first snapshot, because it slows down every allocation
+- the process itself: resident memory, threads and open file descriptors by type, to spot leaked files or sockets
+
+The deep sizes are estimates, they follow containers, instance dicts and slots, and count each object once; shared
+objects such as interned strings and enums are counted wherever they are met first."""
+
+import gc
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+import types
+from collections import Counter, OrderedDict
+from threading import Lock
+
+log = logging.getLogger("memory")  # pylint: disable=invalid-name
+
+# How many of the largest entries are listed, in the breakdowns and in the snapshots
+TOP = 20
+# How many snapshots are kept; the oldest ones are dropped first
+MAX_SNAPSHOTS = 8
+# Frames kept per allocation while tracing; more frames make the tracebacks useful but cost more memory
+DEFAULT_FRAMES = 1
+# Objects that have no interesting insides, or that lead to the rest of the program rather than to the state
+ATOMIC = (
+    str,
+    bytes,
+    bytearray,
+    int,
+    float,
+    bool,
+    type(None),
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.MethodType,
+)
+
+
+def deep_size(obj, seen=None):
+    """Estimate how much memory an object takes, including what it refers to
+    :param seen: optional set of ids of the objects that were already counted, shared between calls to avoid
+                 counting an object twice
+    :returns: int, bytes"""
+    seen = set() if seen is None else seen
+    size = 0
+    pending = [obj]
+    while pending:
+        item = pending.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item, 0)
+        if isinstance(item, ATOMIC):
+            continue
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            pending.extend(item)
+        if hasattr(item, "__dict__"):
+            pending.append(item.__dict__)
+        for slot in getattr(type(item), "__slots__", ()):
+            value = getattr(item, slot, None)
+            if value is not None:
+                pending.append(value)
+    return size
+
+
+def loaded_items(data):
+    """Return the items of user_data or bot_data that are in memory; with LazyPersistence, iterating the
+    mapping would load every record from the disk"""
+    return list(dict.items(data))
+
+
+def state_sizes(user_data, bot_data, top=TOP):
+    """Measure the state of a bot
+    :param user_data: dict, chat_id -> VolunteerSession
+    :param bot_data: dict, request_id -> HelpRequest, and other entries such as the log of announcements
+    :returns: dict with the sizes in bytes, per attribute of the sessions and per key of bot_data"""
+    seen = set()
+    sessions = loaded_items(user_data)
+    attributes = Counter()
+    total = 0
+    for _, session in sessions:
+        total += sys.getsizeof(session, 0)
+        seen.add(id(session))
+        fields = getattr(type(session), "__slots__", None) or list(getattr(session, "__dict__", {}))
+        for field in fields:
+            size = deep_size(getattr(session, field, None), seen)
+            attributes[field.lstrip("_")] += size
+            total += size
+
+    requests = []
+    others = {}
+    for key, value in loaded_items(bot_data):
+        size = deep_size(value, seen)
+        if type(value).__name__ == "HelpRequest":
+            requests.append((size, key))
+        else:
+            others[str(key)] = size
+
+    requests.sort(reverse=True)
+    return {
+        "user_data": {
+            "volunteers": len(sessions),
+            "bytes": total,
+            "by_attribute": dict(attributes.most_common()),
+        },
+        "bot_data": {
+            "requests": len(requests),
+            "requests_bytes": sum(size for size, _ in requests),
+            "largest_requests": OrderedDict((key, size) for size, key in requests[:top]),
+            "by_key": others,
+        },
+    }
+
+
+def file_descriptors():
+    """Count the open file descriptors by type (file, socket, pipe, ...), as listed in /proc
+    :returns: dict, or None where /proc is not available"""
+    path = "/proc/self/fd"
+    if not os.path.isdir(path):
+        return None
+    kinds = Counter()
+    for name in os.listdir(path):
+        try:
+            target = os.readlink(os.path.join(path, name))
+        except OSError:
+            # it was closed in the meantime, e.g. the descriptor used by listdir
+            continue
+        if target.startswith("/"):
+            kinds["file"] += 1
+        else:
+            # e.g. `socket:[1234]`, `pipe:[5678]`, `anon_inode:[eventpoll]`
+            kinds[target.split(":", 1)[0]] += 1
+    return {"total": sum(kinds.values()), "by_kind": dict(kinds)}
+
+
+def resident_bytes():
+    """Return the resident set size of the process, or None if it cannot be found out"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def process_stats():
+    """Return what the process as a whole is using"""
+    return {
+        "rss_bytes": resident_bytes(),
+        "threads": threading.active_count(),
+        "gc_objects": len(gc.get_objects()),
+        "fds": file_descriptors(),
+        "tracemalloc": tracemalloc.is_tracing(),
+    }
+
+
+def _describe(stats, top):
+    return [
+        {
+            "where": str(stat.traceback[0]) if stat.traceback else "?",
+            "bytes": stat.size,
+            "count": stat.count,
+            **(
+                {"bytes_diff": stat.size_diff, "count_diff": stat.count_diff}
+                if hasattr(stat, "size_diff")
+                else {}
+            ),
+        }
+        for stat in stats[:top]
+    ]
+
+
+class Snapshots:
+    """The tracemalloc snapshots taken so far, numbered from 1. There is one set per process, because tracing is
+    process-wide, see `SNAPSHOTS`"""
+
+    # allocations made by the tracing machinery itself
+    IGNORED = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    )
+
+    def __init__(self, keep=MAX_SNAPSHOTS):
+        """:param keep: int, how many snapshots are kept"""
+        self.keep = keep
+        self.snapshots = OrderedDict()
+        self.counter = 0
+        self.lock = Lock()
+
+    def take(self, frames=DEFAULT_FRAMES, top=TOP):
+        """Take a snapshot, turning tracing on if it is not on yet; the first snapshot only sees what was
+        allocated after that
+        :param frames: int, frames kept per allocation, only used when tracing is turned on
+        :returns: dict with the snapshot's number and its largest allocation sites"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            log.info("Started tracing allocations, %i frames", frames)
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.IGNORED)
+        with self.lock:
+            self.counter += 1
+            number = self.counter
+            self.snapshots[number] = snapshot
+            while len(self.snapshots) > self.keep:
+                self.snapshots.popitem(last=False)
+        stats = snapshot.statistics("lineno")
+        return {
+            "snapshot": number,
+            "traced_bytes": sum(stat.size for stat in stats),
+            "top": _describe(stats, top),
+        }
+
+    def diff(self, first, second, top=TOP):
+        """Compare two snapshots
+        :param first: int, the older snapshot
+        :param second: int, the newer one
+        :returns: dict with the allocation sites that grew or shrank the most
+        :raises KeyError: if one of the snapshots is not kept"""
+        with self.lock:
+            older, newer = self.snapshots[first], self.snapshots[second]
+        stats = newer.compare_to(older, "lineno")
+        return {
+            "from": first,
+            "to": second,
+            "bytes_diff": sum(stat.size_diff for stat in stats),
+            "top": _describe(stats, top),
+        }
+
+    def list(self):
+        with self.lock:
+            return list(self.snapshots)
+
+    def clear(self):
+        """Drop the snapshots and turn tracing off"""
+        with self.lock:
+            self.snapshots.clear()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            log.info("Stopped tracing allocations")
+
+
+SNAPSHOTS = Snapshots()
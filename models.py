@@ -0,0 +1,283 @@
+"""In-memory models for the bot's state: the requests for assistance kept in `bot_data` and the volunteers' sessions
+kept in `user_data`. They use __slots__ to keep the per-object memory low, store states as small integers and
+repeated strings (needs, symptoms) as interned strings.
+
+Both are pickled as a versioned tuple of their fields, so the on-disk format does not depend on the class layout.
+Keep this in mind when adding fields: append them at the end, give them a default in `__init__` and bump the version.
+A tuple from an older version is shorter, the fields it lacks keep their defaults; a tuple from a newer version is
+refused, rather than losing the fields this version doesn't know about.
+
+Run `python models.py` to compare their size with the plain dictionaries they replace."""
+
+import sys
+from array import array
+
+import constants as c
+
+SERIAL_VERSION = 1
+
+
+def _intern_all(items):
+    return tuple(sys.intern(item) for item in items)
+
+
+def _restore(obj, state):
+    """Set the slots of a model that was just initialized with the defaults from a pickled state
+    :raises ValueError: if the state comes from a newer version"""
+    if state[0] > SERIAL_VERSION:
+        raise ValueError("%s was pickled by a newer version (%i)" % (type(obj).__name__, state[0]))
+    for name, value in zip(obj.__slots__, state[1:]):
+        setattr(obj, name, value)
+
+
+class HelpRequest:
+    """A request for assistance, as received from the backend, along with the details collected from the volunteer
+    who handled it"""
+
+    # (payload key, attribute, expected type, required)
+    FIELDS = (
+        ("request_id", "request_id", str, True),
+        ("beneficiary", "beneficiary", str, False),
+        ("address", "address", str, True),
+        ("needs", "needs", list, True),
+        ("gotSymptoms", "got_symptoms", bool, False),
+        ("hasDisabilities", "has_disabilities", bool, False),
+        ("safetyCode", "safety_code", str, False),
+        ("phoneNumber", "phone_number", str, False),
+        ("remarks", "remarks", list, False),
+        ("volunteers", "volunteers", list, True),
+        ("latitude", "latitude", (int, float), False),
+        ("longitude", "longitude", (int, float), False),
+    )
+
+    # details that are filled in while the request is handled
+    EXTRA = ("time", "amount", "symptoms", "wellbeing", "would_return", "further_comments")
+
+    __slots__ = tuple(attribute for _, attribute, _, _ in FIELDS) + EXTRA
+
+    def __init__(self, request_id, address, needs=(), volunteers=(), **kwargs):
+        self.request_id = request_id
+        self.address = address
+        self.needs = _intern_all(needs)
+        self.volunteers = array("q", volunteers)
+        self.beneficiary = kwargs.get("beneficiary", "")
+        self.got_symptoms = kwargs.get("got_symptoms", False)
+        self.has_disabilities = kwargs.get("has_disabilities", False)
+        self.safety_code = kwargs.get("safety_code", "")
+        self.phone_number = kwargs.get("phone_number", "")
+        self.remarks = tuple(kwargs.get("remarks", ()))
+        self.latitude = kwargs.get("latitude")
+        self.longitude = kwargs.get("longitude")
+
+        self.time = kwargs.get("time")
+        self.amount = kwargs.get("amount")
+        self.symptoms = list(kwargs.get("symptoms", []))
+        self.wellbeing = kwargs.get("wellbeing")
+        self.would_return = kwargs.get("would_return")
+        self.further_comments = kwargs.get("further_comments", "")
+
+    @classmethod
+    def from_payload(cls, data):
+        """Validate a request received from the backend and build the model out of it
+        :param data: dict, see `assistance_request` in the readme
+        :raises ValueError: if a mandatory field is missing or a field has an unexpected type"""
+        if not isinstance(data, dict):
+            raise ValueError("Expected a JSON object")
+
+        fields = {}
+        for key, attribute, kind, required in cls.FIELDS:
+            value = data.get(key)
+            if value is None:
+                if required:
+                    raise ValueError("Missing field `%s`" % key)
+                continue
+            if not isinstance(value, kind) or (kind is not bool and isinstance(value, bool)):
+                raise ValueError("Field `%s` has an unexpected type" % key)
+            fields[attribute] = value
+
+        if not all(isinstance(chat_id, int) for chat_id in fields["volunteers"]):
+            raise ValueError("Field `volunteers` must contain chat IDs")
+        if not all(isinstance(need, str) for need in fields["needs"]):
+            raise ValueError("Field `needs` must contain strings")
+        return cls(**fields)
+
+    @classmethod
+    def coerce(cls, value):
+        """Turn a request stored by an older version of the bot (a plain dict) into a model, leave anything else
+        unchanged"""
+        if not isinstance(value, dict) or "request_id" not in value:
+            return value
+        fields = {
+            attribute: value[key]
+            for key, attribute, _, _ in cls.FIELDS
+            if value.get(key) is not None
+        }
+        fields.update({key: value[key] for key in cls.EXTRA if key in value})
+        fields.setdefault("address", "")
+        return cls(**fields)
+
+    def to_dict(self):
+        """Return the request in the same form the backend sent it, plus the details collected so far. This is what
+        the message templates in `constants.py` are rendered with."""
+        result = {key: getattr(self, attribute) for key, attribute, _, _ in self.FIELDS}
+        result["needs"] = list(self.needs)
+        result["volunteers"] = list(self.volunteers)
+        result["remarks"] = list(self.remarks)
+        result.update({key: getattr(self, key) for key in self.EXTRA})
+        return result
+
+    def __getstate__(self):
+        return (SERIAL_VERSION,) + tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        self.__init__(None, "")
+        _restore(self, state)
+        self.needs = _intern_all(self.needs)
+
+    def __eq__(self, other):
+        return isinstance(other, HelpRequest) and self.__getstate__() == other.__getstate__()
+
+    def __repr__(self):
+        return "HelpRequest(%r)" % self.to_dict()
+
+
+class VolunteerSession:
+    """What the bot knows about a volunteer's current interaction with it"""
+
+    __slots__ = (
+        "_state",
+        "reviewed_request",
+        "current_request",
+        "symptom_keyboard",
+        "assist_keyboard",
+    )
+
+    def __init__(self, state=None, reviewed_request=None, current_request=None):
+        self._state = -1 if state is None else state.value
+        self.reviewed_request = reviewed_request
+        self.current_request = current_request
+        # these keep the last version of the dynamic keyboards with checkboxes, if any
+        self.symptom_keyboard = None
+        self.assist_keyboard = None
+
+    @property
+    def state(self):
+        """The state of the volunteer, one of c.State, or None if we don't know anything about them yet"""
+        return None if self._state < 0 else c.State(self._state)
+
+    @state.setter
+    def state(self, value):
+        self._state = -1 if value is None else value.value
+
+    def release(self):
+        """Forget about the requests this volunteer was dealing with; their state is changed by the state machine,
+        see `statemachine.py`"""
+        self.reviewed_request = None
+        self.current_request = None
+
+    @classmethod
+    def coerce(cls, value):
+        """Turn a session stored by an older version of the bot (a plain dict) into a model, leave anything else
+        unchanged"""
+        if not isinstance(value, dict):
+            return value
+        session = cls(
+            value.get("state"), value.get("reviewed_request"), value.get("current_request")
+        )
+        session.symptom_keyboard = value.get("symptom_keyboard")
+        session.assist_keyboard = value.get("assist_keyboard")
+        return session
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "reviewed_request": self.reviewed_request,
+            "current_request": self.current_request,
+        }
+
+    def __getstate__(self):
+        return (SERIAL_VERSION,) + tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        self.__init__()
+        _restore(self, state)
+
+    def __eq__(self, other):
+        return isinstance(other, VolunteerSession) and self.__getstate__() == other.__getstate__()
+
+    def __repr__(self):
+        return "VolunteerSession(%r)" % self.to_dict()
+
+
+def adopt(dispatcher):
+    """Make the dispatcher use the models: new volunteers get a VolunteerSession, and whatever was loaded from
+    the persistence in the old format (plain dicts) is converted.
+    :param dispatcher: telegram.ext.Dispatcher"""
+    user_data, bot_data = dispatcher.user_data, dispatcher.bot_data
+    user_data.default_factory = VolunteerSession
+
+    # Only what is already in memory is converted here; persistence backends that load records on demand, such as
+    # LazyPersistence, convert them as they are loaded
+    for chat_id, session in list(dict.items(user_data)):
+        dict.__setitem__(user_data, chat_id, VolunteerSession.coerce(session))
+    for key, value in list(dict.items(bot_data)):
+        dict.__setitem__(bot_data, key, HelpRequest.coerce(value))
+
+    if hasattr(user_data, "convert"):
+        user_data.convert = VolunteerSession.coerce
+    if hasattr(bot_data, "convert"):
+        bot_data.convert = HelpRequest.coerce
+
+
+def validate_fields(data, fields):
+    """Check the fields of a small payload, such as `assign_assistance` or `cancel_help_request`
+    :param data: dict, the payload
+    :param fields: dict, field name -> expected type
+    :returns: the payload, unchanged
+    :raises ValueError: if a field is missing or has an unexpected type"""
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object")
+    for key, kind in fields.items():
+        if not isinstance(data.get(key), kind) or isinstance(data.get(key), bool):
+            raise ValueError("Missing or invalid field `%s`" % key)
+    return data
+
+
+if __name__ == "__main__":
+    import pickle
+
+    from memory import deep_size
+
+    sample = {
+        "request_id": "fe91e4b6-e902-4d03-8500-d058673cb9bd",
+        "beneficiary": "Martina Cojocaru",
+        "address": "str. 31 August",
+        "needs": ["Medicamente", "Produse alimentare"],
+        "gotSymptoms": False,
+        "hasDisabilities": False,
+        "safetyCode": "Izvor-45",
+        "phoneNumber": "+373 777 77 777",
+        "remarks": ["Nu lucreaza ascensorul", "Are caine rau"],
+        "volunteers": list(range(253155796, 253155796 + 20)),
+        "latitude": 47.0255165,
+        "longitude": 28.8303149,
+    }
+    model = HelpRequest.from_payload(sample)
+    session = {"state": c.State.AVAILABLE, "reviewed_request": None, "current_request": None}
+    print(
+        "request  dict: %5i bytes in memory, %5i pickled"
+        % (deep_size(sample), len(pickle.dumps(sample)))
+    )
+    print(
+        "request model: %5i bytes in memory, %5i pickled"
+        % (deep_size(model), len(pickle.dumps(model)))
+    )
+    print(
+        "session  dict: %5i bytes in memory, %5i pickled"
+        % (deep_size(session), len(pickle.dumps(session)))
+    )
+    volunteer = VolunteerSession.coerce(session)
+    print(
+        "session model: %5i bytes in memory, %5i pickled"
+        % (deep_size(volunteer), len(pickle.dumps(volunteer)))
+    )
@@ -0,0 +1,432 @@
+"""Record and replay of the bot's traffic, to catch performance regressions before they reach production.
+
+Recording: set `COVID_RECORD=traffic.jsonl` when starting the bot, each incoming Telegram update and each POST to the
+REST API is appended to the file as a JSON line, with a timestamp. Personal data is scrubbed on the way: names,
+usernames, phone numbers, addresses and free text are replaced by pseudonyms, chat IDs are replaced by other numbers
+(consistently within a recording, so a volunteer's updates and the REST calls that mention them still match), and
+locations are blurred. Commands, numbers and callback data are kept, since they drive the bot's logic.
+
+Replaying: `python replay.py traffic.jsonl` feeds the recording through the real dispatcher and handlers, with a fake
+bot that answers every Telegram API call locally, and a backend that does nothing. It prints a report with the latency
+of each kind of update and REST call (p50, p95, p99, max) and the overall throughput:
+
+    python replay.py traffic.jsonl --speed 1         # in real time
+    python replay.py traffic.jsonl --speed 10        # 10x faster
+    python replay.py traffic.jsonl --speed max       # as fast as possible (default)
+    python replay.py traffic.jsonl --save base.json  # store the report as a baseline
+    python replay.py traffic.jsonl --baseline base.json --tolerance 0.2
+
+With `--baseline`, the p95 latencies are compared to the ones in the stored report and the exit code is 1 if any of
+them got slower by more than the tolerance."""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from itertools import count
+from threading import Lock, Thread
+
+from telegram import Bot, Update
+
+import callbacks
+import constants as c
+from models import HelpRequest, VolunteerSession
+
+log = logging.getLogger("replay")  # pylint: disable=invalid-name
+
+# Keys whose values identify a person, or may contain details about them
+ID_KEYS = {"id", "chat_id", "user_id", "volunteer", "volunteers"}
+PHONE_KEYS = {"phone_number", "phoneNumber", "phone"}
+TEXT_KEYS = {
+    "first_name",
+    "last_name",
+    "username",
+    "title",
+    "vcard",
+    "caption",
+    "beneficiary",
+    "address",
+    "safetyCode",
+    "remarks",
+    "further_comments",
+}
+# Message texts that are kept as they are: commands, and numbers or times (amounts, ETAs)
+SAFE_TEXT = re.compile(r"^(/\w+|[\d\s.,:]+)$")
+
+# p95 differences smaller than this are noise, they are never reported as regressions
+NOISE_MS = 1.0
+
+
+class Scrubber:
+    """Replaces personal data with pseudonyms. The pseudonyms are derived from a random key, so they are consistent
+    within a recording, but cannot be traced back to the original values"""
+
+    def __init__(self, key=None):
+        self.key = key or os.urandom(16)
+
+    def _digest(self, value, size):
+        return hashlib.blake2b(str(value).encode(), key=self.key, digest_size=size).digest()
+
+    def scrub(self, value, key=None):
+        """Return a copy of a JSON-like structure, with personal data replaced"""
+        if isinstance(value, dict):
+            return {name: self.scrub(item, name) for name, item in value.items()}
+        if isinstance(value, list):
+            return [self.scrub(item, key) for item in value]
+        if isinstance(value, bool) or value is None:
+            return value
+
+        if key in ID_KEYS and isinstance(value, int):
+            pseudonym = 10 ** 9 + int.from_bytes(self._digest(value, 4), "big")
+            return pseudonym if value >= 0 else -pseudonym
+        if key in ("latitude", "longitude") and isinstance(value, (int, float)):
+            return round(value, 1)
+        if not isinstance(value, str):
+            return value
+        if key in PHONE_KEYS:
+            return "+" + str(int.from_bytes(self._digest(value, 8), "big"))[:11]
+        if key in TEXT_KEYS or (key == "text" and not SAFE_TEXT.match(value)):
+            return "anon-" + self._digest(value, 4).hex()
+        return value
+
+
+class Recorder:
+    """Appends the incoming traffic to a JSON lines file, see the module's description"""
+
+    def __init__(self, path):
+        """Initialize the recorder
+        :param path: str, the file where the traffic is appended"""
+        self.path = path
+        self.scrubber = Scrubber()
+        self.lock = Lock()
+        self.target = open(path, "a", encoding="utf-8")
+
+    def record_state(self, user_data, bot_data):
+        """Record a snapshot of the bot's state, without it the recorded updates can't be replayed faithfully. It is
+        invoked once, when the bot starts
+        :param user_data: dict, chat_id -> VolunteerSession
+        :param bot_data: dict, request_id -> HelpRequest, among other things"""
+        # persistence backends that load records on demand can tell which ones they have
+        chat_ids = user_data.stored_keys() if hasattr(user_data, "stored_keys") else list(user_data)
+        volunteers = []
+        for chat_id in chat_ids:
+            session = user_data[chat_id]
+            volunteers.append(
+                {
+                    "chat_id": chat_id,
+                    "state": None if session.state is None else session.state.value,
+                    "reviewed_request": session.reviewed_request,
+                    "current_request": session.current_request,
+                }
+            )
+        requests = [
+            value.to_dict() for value in bot_data.values() if isinstance(value, HelpRequest)
+        ]
+        self._write("state", {"volunteers": volunteers, "requests": requests})
+
+    def record_update(self, update, _context):
+        """Invoked by the dispatcher for each update, before any other handler"""
+        # leave out the cached `_effective_*` attributes, they're not part of the update
+        data = {key: value for key, value in update.to_dict().items() if not key.startswith("_")}
+        self._write("update", data)
+
+    def record_rest(self, path, body):
+        """Invoked by the REST API for each POST request
+        :param path: str, e.g. `/help_request`
+        :param body: bytes, the body of the request"""
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        self._write("rest", data, path=path)
+
+    def _write(self, kind, data, **extra):
+        entry = {
+            "t": round(time.time(), 4),
+            "kind": kind,
+            **extra,
+            "data": self.scrubber.scrub(data),
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.target.write(line)
+            self.target.flush()
+
+    def close(self):
+        with self.lock:
+            self.target.close()
+
+
+class FakeRequest:
+    """Stands in for `telegram.utils.request.Request`: every API call succeeds locally, after an optional delay
+    that simulates the network. Calls that return a message get a plausible one."""
+
+    # checked by the Updater, there's no pool to speak of
+    con_pool_size = 64
+
+    def __init__(self, latency=0.0):
+        """:param latency: float, seconds that each API call takes"""
+        self.latency = latency
+        self.message_ids = count(1)
+        self.calls = 0
+
+    def post(self, url, data, timeout=None):  # pylint: disable=unused-argument
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        method = url.rsplit("/", 1)[-1]
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        if method == "getFile":
+            return {"file_id": data.get("file_id", "file"), "file_path": "replay.jpg"}
+        if method.startswith("send") or method.startswith("edit"):
+            return {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        return True
+
+    def get(self, url, timeout=None):
+        return self.post(url, {}, timeout)
+
+    def retrieve(self, url, timeout=None):  # pylint: disable=unused-argument
+        return b"\xff\xd8replay:" + url.encode()
+
+    def stop(self):
+        pass
+
+
+class NullBackend:
+    """Stands in for `backend_api.Backender`, all the calls do nothing"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def route_of(entry):
+    """Classify a recorded entry, e.g. `command:/start`, `callback:eta` or `rest:/help_request`"""
+    if entry["kind"] == "rest":
+        return "rest:" + entry["path"]
+    if entry["kind"] == "state":
+        return "state"
+
+    data = entry["data"]
+    if "callback_query" in data:
+        try:
+            return "callback:" + callbacks.decode(data["callback_query"].get("data", "")).route
+        except ValueError:
+            return "callback:?"
+    message = data.get("message") or {}
+    text = message.get("text") or ""
+    if text.startswith("/"):
+        return "command:" + text.split()[0]
+    for kind in ("photo", "contact", "text"):
+        if message.get(kind):
+            return kind
+    return "update"
+
+
+def percentile(values, fraction):
+    """Return the given percentile of a sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(samples):
+    """Turn a list of durations in seconds into latency statistics, in milliseconds"""
+    values = sorted(sample * 1000 for sample in samples)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.5), 3),
+        "p95_ms": round(percentile(values, 0.95), 3),
+        "p99_ms": round(percentile(values, 0.99), 3),
+        "max_ms": round(values[-1], 3) if values else 0.0,
+    }
+
+
+class Replayer:
+    """Feeds a recording through a real Ajubot, with a fake Telegram API and a null backend"""
+
+    def __init__(self, entries, api_latency=0.0, workers=4):
+        """Initialize the replayer
+        :param entries: list of recorded entries, in order
+        :param api_latency: float, seconds each Telegram API call takes
+        :param workers: int, number of dispatcher threads for the asynchronous handlers"""
+        # imported here, so that recording doesn't depend on the rest of the bot
+        from telegram.ext import Updater
+        from werkzeug.test import Client
+        from werkzeug.wrappers import Response
+
+        from ajubot import Ajubot
+
+        self.entries = [entry for entry in entries if entry["kind"] != "state"]
+        self.request = FakeRequest(api_latency)
+        self.workdir = tempfile.TemporaryDirectory(prefix="replay")
+        bot = Bot("123456:replay-token-not-used", request=self.request)
+        self.updater = Updater(bot=bot, use_context=True, workers=workers)
+        self.ajubot = Ajubot(self.updater, NullBackend(), state_dir=self.workdir.name)
+        self.ajubot.init_bot()
+        for entry in entries:
+            if entry["kind"] == "state":
+                self.restore(entry["data"])
+        self.client = Client(self.ajubot.rest, Response)
+
+        # the updates are fed directly, but the dispatcher must be running for the asynchronous handlers
+        thread = Thread(target=self.updater.dispatcher.start, name="replay", daemon=True)
+        thread.start()
+        while not self.updater.dispatcher.running and thread.is_alive():
+            time.sleep(0.01)
+
+    def restore(self, snapshot):
+        """Load the state recorded by `Recorder.record_state`"""
+        dispatcher = self.updater.dispatcher
+        for volunteer in snapshot["volunteers"]:
+            state = volunteer["state"]
+            dispatcher.user_data[volunteer["chat_id"]] = VolunteerSession(
+                None if state is None else c.State(state),
+                volunteer["reviewed_request"],
+                volunteer["current_request"],
+            )
+        for request in snapshot["requests"]:
+            dispatcher.bot_data[request["request_id"]] = HelpRequest.coerce(request)
+
+    def run(self, speed=None):
+        """Replay the entries
+        :param speed: float, 1 for real time, 10 for 10x faster, None to go as fast as possible
+        :returns: dict, the report"""
+        timings, jobs, lag = {}, [], 0.0
+        dispatcher = self.updater.dispatcher
+        origin = self.entries[0]["t"] if self.entries else 0
+        started = time.perf_counter()
+
+        for entry in self.entries:
+            if speed:
+                due = started + (entry["t"] - origin) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+
+            if entry["kind"] != "rest":
+                # a fan-out runs in the background, but in the recording it was most likely over by the time the
+                # volunteers replied to it; when going faster than real time, keep that order
+                self._wait_for_jobs(jobs)
+
+            begin = time.perf_counter()
+            if entry["kind"] == "rest":
+                response = self.client.post(entry["path"], data=json.dumps(entry["data"]))
+                if response.status_code == 200:
+                    jobs.append(json.loads(response.data)["job"])
+            else:
+                dispatcher.process_update(Update.de_json(entry["data"], dispatcher.bot))
+            timings.setdefault(route_of(entry), []).append(time.perf_counter() - begin)
+
+        elapsed = time.perf_counter() - started
+        self._wait_for_jobs(jobs)
+        for job_id in jobs:
+            job = self.ajubot.rest.jobs.get(job_id)
+            if job is not None and job.finished:
+                timings.setdefault("job:" + job.kind, []).append(job.finished - job.started)
+
+        return {
+            "entries": len(self.entries),
+            "speed": speed or "max",
+            "elapsed_s": round(elapsed, 3),
+            "throughput": round(len(self.entries) / elapsed, 1) if elapsed else None,
+            "max_lag_ms": round(lag * 1000, 3),
+            "api_calls": self.request.calls,
+            "routes": {route: summarize(samples) for route, samples in sorted(timings.items())},
+        }
+
+    def _wait_for_jobs(self, jobs, timeout=30):
+        """Wait until the fan-outs triggered by the REST calls are over"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            # an announcement is over once its digests are sent, there is no need to wait for their windows
+            self.ajubot.digests.flush_all()
+            pending = [
+                job_id
+                for job_id in jobs
+                if self.ajubot.rest.jobs.get(job_id) is not None
+                and self.ajubot.rest.jobs.get(job_id).finished is None
+            ]
+            if not pending:
+                return
+            time.sleep(0.01)
+        log.warning("Some jobs did not finish in %is", timeout)
+
+    def close(self):
+        self.updater.dispatcher.stop()
+        self.ajubot.sender.stop()
+        self.workdir.cleanup()
+
+
+def compare(report, baseline, tolerance):
+    """Compare the p95 latencies of a report with those of a baseline
+    :param tolerance: float, e.g. 0.2 means that up to 20% slower is acceptable
+    :returns: list of str, one line per regression"""
+    regressions = []
+    for route, stats in report["routes"].items():
+        reference = baseline["routes"].get(route)
+        if reference is None:
+            continue
+        current, previous = stats["p95_ms"], reference["p95_ms"]
+        if current > previous * (1 + tolerance) and current - previous > NOISE_MS:
+            regressions.append(f"{route}: p95 {previous:.3f} -> {current:.3f} ms")
+    return regressions
+
+
+def load(path):
+    """Read a recording
+    :returns: list of entries, sorted by time"""
+    with open(path, encoding="utf-8") as source:
+        entries = [json.loads(line) for line in source if line.strip()]
+    return sorted(entries, key=lambda entry: entry["t"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded traffic through the bot")
+    parser.add_argument("recording", help="JSON lines file written by the recorder")
+    parser.add_argument(
+        "--speed", default="max", help="1 for real time, N for N times faster, or max"
+    )
+    parser.add_argument("--api-latency", type=float, default=0.0, help="ms per Telegram API call")
+    parser.add_argument("--save", help="write the report to this file")
+    parser.add_argument("--baseline", help="compare with the report stored in this file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="accepted slowdown, 0.2 = 20%%"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    replayer = Replayer(load(args.recording), api_latency=args.api_latency / 1000)
+    try:
+        report = replayer.run(None if args.speed == "max" else float(args.speed))
+    finally:
+        replayer.close()
+
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w") as target:
+            json.dump(report, target, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as source:
+            regressions = compare(report, json.load(source), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,126 @@
 """This is a mini web server that the bot uses to receive input from the backend, by means of REST calls"""
 
+import hmac
+import ipaddress
 import logging
+import math
+from io import BytesIO
 from threading import Thread
-import json
 import pprint
 
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
-from werkzeug.exceptions import BadRequest, MethodNotAllowed, HTTPException
+from werkzeug.wsgi import get_content_length, get_input_stream
+from werkzeug.exceptions import (
+    BadRequest,
+    Forbidden,
+    MethodNotAllowed,
+    NotFound,
+    HTTPException,
+    RequestEntityTooLarge,
+    ServiceUnavailable,
+    TooManyRequests,
+)
+
+import logsetup
+import memory
+import models
+import serialization
+from jobs import JobTracker, QueueFull
 
 log = logging.getLogger("rest")  # pylint: disable=invalid-name
 
+# How many jobs of each kind can be waiting or running. Announcements are the expensive ones, each of them is a
+# message to every volunteer in the payload; beyond this, the backend gets a 429 and is told when to try again
+DEFAULT_LIMITS = {"help_request": 20, "cancel_help_request": 100, "assign_help_request": 100}
+# The same, for all the kinds together; beyond this, the backend gets a 503
+DEFAULT_OVERALL_LIMIT = 150
+# Largest accepted POST body, in bytes; a request for assistance is well under 1 KiB
+DEFAULT_MAX_BODY = 64 * 1024
+# /ready reports that the bot is not ready when a queue is this full, so that the backend slows down before it hits
+# the limits
+READY_THRESHOLD = 0.8
+MAX_RETRY_AFTER = 300  # seconds
+
+
+def json_response(payload, status=200):
+    """Build a response with a JSON body, see `serialization.py`"""
+    return Response(
+        serialization.dumps(payload), status=status, content_type=serialization.CONTENT_TYPE
+    )
+
+
+def read_body(environ, limit):
+    """Read the body of a call, without taking in more than `limit` bytes, even when the client did not say how long
+    it is (a chunked upload). The body is put back into `environ`, for `Request.get_data` to find it there
+    :param limit: int, largest accepted body, in bytes
+    :raises RequestEntityTooLarge: if the body is larger than that
+    :returns: bytes"""
+    length = get_content_length(environ)
+    if length is not None and length > limit:
+        raise RequestEntityTooLarge("The limit is %i bytes" % limit)
+    body = get_input_stream(environ).read(limit + 1)
+    if len(body) > limit:
+        raise RequestEntityTooLarge("The limit is %i bytes" % limit)
+    environ["wsgi.input"] = BytesIO(body)
+    environ["CONTENT_LENGTH"] = str(len(body))
+    # it is no longer chunked, and its length is known
+    environ.pop("wsgi.input_terminated", None)
+    environ.pop("HTTP_TRANSFER_ENCODING", None)
+    return body
+
 
 class BotRestApi:
     """The REST API that receives events and data from the backend"""
 
-    def __init__(self, help_handler, cancel_handler, assign_handler, introspect_handler):
+    def __init__(
+        self,
+        help_handler,
+        cancel_handler,
+        assign_handler,
+        introspect_handler,
+        recorder=None,
+        stats_handler=None,
+        traces_handler=None,
+        memory_handler=None,
+        limits=None,
+        overall_limit=DEFAULT_OVERALL_LIMIT,
+        max_body=DEFAULT_MAX_BODY,
+        admin_token=None,
+    ):
         """Initialize the REST API
         :param help_handler: callable, a function that will be invoked when a new request for assistance arrives
         :param cancel_handler: callable, will be invoked when a request for assistance was cancelled
         :param assign_handler: callable, will be invoked when a request for assistance was assigned to someone
+                               (these three are invoked with the payload and the `jobs.Job` that tracks the work)
         :param introspect_handler: callable, invoked when you go to the /introspect URL, it simply dumps the bot's state
-                                   so you can get a clue about the current situation"""
+                                   so you can get a clue about the current situation
+        :param recorder: optional replay.Recorder, it gets a copy of each POST request
+        :param stats_handler: optional callable, invoked when you go to the /stats URL, it returns a JSON-serializable
+                              summary of the resources and queues of the bot
+        :param traces_handler: optional callable, invoked when you go to the /traces URL, it returns the latency
+                               percentiles of each stage of a request's lifecycle, see `tracing.py`
+        :param memory_handler: optional callable, returns the sizes of the bot's state for the /memory URL, see
+                               `memory.state_sizes`
+        :param limits: optional dict, job kind -> how many jobs of that kind can be pending, see DEFAULT_LIMITS
+        :param overall_limit: int, how many jobs can be pending in total
+        :param max_body: int, largest accepted POST body, in bytes
+        :param admin_token: optional str, lets callers from other machines change the bot's settings, e.g. the log
+                            levels or the memory tracing, when sent as `Authorization: Bearer <token>`; without it, only calls from the
+                            same machine can, see `is_admin`"""
         self.help_request_handler = help_handler
         self.cancel_request_handler = cancel_handler
         self.assign_request_handler = assign_handler
         self.introspect_handler = introspect_handler
+        self.stats_handler = stats_handler
+        self.traces_handler = traces_handler
+        self.memory_handler = memory_handler
+        self.jobs = JobTracker()
+        self.recorder = recorder
+        self.limits = DEFAULT_LIMITS if limits is None else limits
+        self.overall_limit = overall_limit
+        self.max_body = max_body
+        self.admin_token = admin_token
         self.form = open("res/static/index.html", "rb").read()
         self.url_map = Map(
             [
@@ -34,6 +129,15 @@ class BotRestApi:
                 Rule("/cancel_help_request", endpoint="cancel_help_request"),
                 Rule("/assign_help_request", endpoint="assign_help_request"),
                 Rule("/introspect", endpoint="introspect_request"),
+                Rule("/loglevel", endpoint="log_level"),
+                Rule("/jobs", endpoint="jobs"),
+                Rule("/jobs/<job_id>", endpoint="job"),
+                Rule("/ready", endpoint="ready"),
+                Rule("/stats", endpoint="stats"),
+                Rule("/traces", endpoint="traces"),
+                Rule("/memory", endpoint="memory"),
+                Rule("/memory/snapshots", endpoint="memory_snapshots"),
+                Rule("/memory/snapshots/<int:first>/<int:second>", endpoint="memory_diff"),
             ]
         )
 
@@ -46,13 +150,38 @@ class BotRestApi:
             return e
 
     def wsgi_app(self, environ, start_response):
+        if environ.get("REQUEST_METHOD") == "POST":
+            try:
+                read_body(environ, self.max_body)
+            except RequestEntityTooLarge as err:
+                return err(environ, start_response)
         request = Request(environ)
+        if self.recorder is not None and request.method == "POST":
+            self.recorder.record_rest(request.path, request.get_data())
         response = self.dispatch_request(request)
         return response(environ, start_response)
 
     def __call__(self, environ, start_response):
         return self.wsgi_app(environ, start_response)
 
+    def is_admin(self, request):
+        """Tell whether a call may change the bot's settings: it comes from the same machine, or it carries the
+        admin token. Behind a proxy every call seems to come from the proxy, so the token is what counts there"""
+        try:
+            address = ipaddress.ip_address(request.remote_addr or "")
+        except ValueError:
+            address = None
+        if address is not None and getattr(address, "ipv4_mapped", None) is not None:
+            address = address.ipv4_mapped
+        if address is not None and address.is_loopback:
+            return True
+        if not self.admin_token:
+            return False
+        scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(
+            credentials.strip().encode("utf-8"), self.admin_token.encode("utf-8")
+        )
+
     def on_root(self, request):
         """Called when the / page is opened, it provides a form where you can manually send a JSON,
         as if it came from the backend server"""
@@ -66,15 +195,16 @@ class BotRestApi:
 
         if request.method == "POST":
             try:
-                data = json.loads(request.get_data())
+                data = serialization.loads(request.get_data())
                 log.debug("Got help request: `%s`", data)
-            except json.decoder.JSONDecodeError as err:
+                help_request = models.HelpRequest.from_payload(data)
+            except ValueError as err:
                 return BadRequest("Request malformed: %s" % err)
 
             # if we got this far, it means we're ok, so we invoke the function that does the job
             # and pass it the input parameters
-            self.help_request_handler(data)
-            return Response("Request handled")
+            job = self.admit("help_request", help_request.request_id)
+            return self.hand_over(self.help_request_handler, help_request, job)
 
     def on_cancel_help_request(self, request):
         """Called when a fixer notifies a volunteer that the request to assist has been cancelled"""
@@ -83,15 +213,16 @@ class BotRestApi:
 
         if request.method == "POST":
             try:
-                data = json.loads(request.get_data())
+                data = serialization.loads(request.get_data())
                 log.debug("Got cancel request: `%s`", data)
-            except json.decoder.JSONDecodeError as err:
+                models.validate_fields(data, {"request_id": str, "volunteer": int})
+            except ValueError as err:
                 return BadRequest("Request malformed: %s" % err)
 
             # if we got this far, it means we're ok, so we invoke the function that does the job
             # and pass it the input parameters
-            self.cancel_request_handler(data)
-            return Response("Request handled")
+            job = self.admit("cancel_help_request", data["request_id"])
+            return self.hand_over(self.cancel_request_handler, data, job)
 
     def on_assign_help_request(self, request):
         """Called when a fixer notifies a volunteer that the request to assist has been assigned to them"""
@@ -100,15 +231,146 @@ class BotRestApi:
 
         if request.method == "POST":
             try:
-                data = json.loads(request.get_data())
+                data = serialization.loads(request.get_data())
                 log.debug("Got help assign request: `%s`", data)
-            except json.decoder.JSONDecodeError as err:
+                models.validate_fields(data, {"request_id": str, "volunteer": int, "time": str})
+            except ValueError as err:
                 return BadRequest("Request malformed: %s" % err)
 
             # if we got this far, it means we're ok, so we invoke the function that does the job
             # and pass it the input parameters
-            self.assign_request_handler(data)
-            return Response("Request handled")
+            job = self.admit("assign_help_request", data["request_id"])
+            return self.hand_over(self.assign_request_handler, data, job)
+
+    def admit(self, kind, request_id):
+        """Create the job for a call, unless there is too much work pending already
+        :raises TooManyRequests: if there are too many jobs of this kind
+        :raises ServiceUnavailable: if there are too many jobs altogether
+        :returns: jobs.Job"""
+        try:
+            return self.jobs.create(kind, request_id, self.limits.get(kind), self.overall_limit)
+        except QueueFull as err:
+            retry_after = self.retry_after(kind)
+            log.warning(
+                "Refused %s for req:%s, %s, retry in %is", kind, request_id, err, retry_after
+            )
+            if err.overall:
+                raise ServiceUnavailable("Too much pending work", retry_after=retry_after)
+            raise TooManyRequests("Too many pending %s jobs" % kind, retry_after=retry_after)
+
+    def retry_after(self, kind):
+        """Estimate when a refused call should be made again: by then, about one job should have finished
+        :returns: int, seconds"""
+        average = self.jobs.average_duration(kind) or 1.0
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(average)))
+
+    def hand_over(self, handler, payload, job):
+        """Pass the work on to the bot; if it cannot take it, e.g. it is stopping, the job is given up, otherwise it
+        would keep its place in the queue forever
+        :returns: Response"""
+        try:
+            handler(payload, job)
+        except Exception as err:  # pylint: disable=broad-except
+            log.exception("Could not hand over %s for req:%s", job.kind, job.request_id)
+            job.abandon("%s: %s" % (type(err).__name__, err))
+            return ServiceUnavailable("The bot cannot take this request right now")
+        return self.accepted(job)
+
+    @staticmethod
+    def accepted(job):
+        """Build the response for a request that was handed over to the bot, it tells the backend which job to poll
+        in order to find out how it went"""
+        payload = {"result": "Request handled", "job": job.job_id}
+        return json_response(payload)
+
+    def on_jobs(self, request):
+        """Called when the backend wants the summaries of the recent jobs, newest first"""
+        return json_response(self.jobs.recent())
+
+    def on_job(self, request, job_id):
+        """Called when the backend wants to know the progress of a job, including the outcome of each recipient"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return NotFound("Unknown job `%s`" % job_id)
+        return json_response(job.to_dict())
+
+    def on_ready(self, request):
+        """Called by the backend (or a load balancer) to find out whether it should hold back: the response is 503
+        when one of the queues of pending jobs is almost full, 200 otherwise, along with the size of each queue"""
+        pending = self.jobs.pending()
+        total = sum(pending.values())
+        queues = {
+            kind: {"pending": pending.get(kind, 0), "limit": limit}
+            for kind, limit in self.limits.items()
+        }
+        saturated = [
+            kind
+            for kind, queue in queues.items()
+            if queue["pending"] >= READY_THRESHOLD * queue["limit"]
+        ]
+        ready = not saturated and total < READY_THRESHOLD * self.overall_limit
+        payload = {
+            "ready": ready,
+            "saturated": saturated,
+            "pending": total,
+            "overall_limit": self.overall_limit,
+            "queues": queues,
+        }
+        response = json_response(payload, status=200 if ready else 503)
+        if not ready:
+            response.headers["Retry-After"] = str(
+                max([self.retry_after(kind) for kind in saturated] or [1])
+            )
+        return response
+
+    def on_stats(self, request):
+        """Called by monitoring, it returns the resources used by the bot and the state of its queues"""
+        if self.stats_handler is None:
+            return NotFound("Stats are not available")
+        return json_response(self.stats_handler())
+
+    def on_traces(self, request):
+        """Called by monitoring, it returns how long requests take to reach each stage of their lifecycle"""
+        if self.traces_handler is None:
+            return NotFound("Traces are not available")
+        return json_response(self.traces_handler())
+
+    def on_memory(self, request):
+        """Called by a developer who wonders where the memory goes: the process' resident memory and file
+        descriptors, and the size of each part of the bot's state. This walks the whole state, it is not meant for
+        monitoring"""
+        payload = {"process": memory.process_stats(), "snapshots": memory.SNAPSHOTS.list()}
+        if self.memory_handler is not None:
+            payload["state"] = self.memory_handler()
+        return json_response(payload)
+
+    def on_memory_snapshots(self, request):
+        """A POST takes a tracemalloc snapshot, turning tracing on the first time; `{"frames": 5}` keeps more frames
+        per allocation. A DELETE drops the snapshots and turns tracing off; only an admin can do either, since tracing
+        slows every allocation down, see `is_admin`. A GET lists the snapshots"""
+        if request.method in ("POST", "DELETE") and not self.is_admin(request):
+            return Forbidden("Only an admin can take or drop snapshots")
+        if request.method == "POST":
+            try:
+                data = serialization.loads(request.get_data() or b"{}")
+                frames = int(data.get("frames", memory.DEFAULT_FRAMES))
+            except (AttributeError, TypeError, ValueError) as err:
+                return BadRequest("Request malformed: %s" % err)
+            payload = memory.SNAPSHOTS.take(frames)
+        elif request.method == "DELETE":
+            memory.SNAPSHOTS.clear()
+            payload = {"snapshots": []}
+        else:
+            payload = {"snapshots": memory.SNAPSHOTS.list()}
+        return json_response(payload)
+
+    def on_memory_diff(self, request, first, second):
+        """Called to see what grew between two snapshots, e.g. `/memory/snapshots/1/2`"""
+        try:
+            payload = memory.SNAPSHOTS.diff(first, second)
+        except KeyError:
+            return NotFound("Snapshots kept: %s" % memory.SNAPSHOTS.list())
+        return json_response(payload)
 
     def on_introspect_request(self, request):
         """Called when a developer wants to introspect the bot's state"""
@@ -118,6 +380,94 @@ class BotRestApi:
             result = self.introspect_handler()
             return Response(pprint.pformat(result, indent=4))
 
+    def on_log_level(self, request):
+        """Called when a developer wants to see or change the log levels at runtime. A GET returns the current
+        levels, a POST with `{"logger": "ajubot", "level": "INFO"}` changes the level of a logger; only an admin can
+        do that, see `is_admin`"""
+        if request.method == "POST":
+            if not self.is_admin(request):
+                return Forbidden("Only an admin can change the log levels")
+            try:
+                data = serialization.loads(request.get_data())
+                logsetup.set_level(data.get("logger", "root"), data["level"])
+            except (KeyError, ValueError) as err:
+                return BadRequest("Request malformed: %s" % err)
+            log.info("Log level of `%s` set to %s", data.get("logger", "root"), data["level"])
+
+        return json_response(logsetup.get_levels())
+
+
+class TenantRouter:
+    """Serves the REST APIs of several bots on a single port. The bot a call is meant for is chosen by:
+    - a path prefix, e.g. `/balti/help_request` goes to `/help_request` of the `balti` bot
+    - a `tenant` field in the JSON body of a POST, e.g. `{"tenant": "balti", "request_id": ...}`
+    - for `/jobs/<job_id>`, the bot that created that job
+    - if there is only one bot, or for `/`, `/loglevel` and `/memory/snapshots` (which are the same for everyone),
+      the first bot
+
+    `/tenants` returns the resources used by each bot"""
+
+    # paths that are not specific to a bot; the tracemalloc snapshots are taken for the whole process
+    SHARED = ("/", "/loglevel")
+    SHARED_PREFIXES = ("/memory/snapshots",)
+
+    def __init__(self, apps, footprint_handler):
+        """Initialize the router
+        :param apps: OrderedDict, tenant name -> BotRestApi
+        :param footprint_handler: callable, returns a dict of tenant name -> resources used by that tenant"""
+        self.apps = apps
+        self.footprint_handler = footprint_handler
+        self.default = next(iter(apps))
+        # the body is read before the tenant is known, so it is bounded by the most generous limit
+        self.max_body = max(app.max_body for app in apps.values())
+
+    def resolve(self, environ):
+        """Find the tenant a call is meant for, removing the tenant prefix from the path, if there is one
+        :raises RequestEntityTooLarge: if the body of a POST is larger than any tenant accepts
+        :returns: str, the tenant's name, or None if it cannot be determined"""
+        path = environ.get("PATH_INFO", "/")
+        prefix, _, rest = path.lstrip("/").partition("/")
+        if prefix in self.apps:
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + "/" + prefix
+            environ["PATH_INFO"] = "/" + rest
+            return prefix
+
+        if path.startswith("/jobs/"):
+            job_id = path[len("/jobs/") :]
+            for name, app in self.apps.items():
+                if app.jobs.get(job_id) is not None:
+                    return name
+
+        if environ.get("REQUEST_METHOD") == "POST":
+            # the body is read here, it is put back for the tenant's own API, which applies its own limit
+            body = read_body(environ, self.max_body)
+            try:
+                tenant = serialization.loads(body).get("tenant")
+            except (ValueError, AttributeError):
+                tenant = None
+            if tenant in self.apps:
+                return tenant
+
+        if len(self.apps) == 1 or path in self.SHARED or path.startswith(self.SHARED_PREFIXES):
+            return self.default
+        return None
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == "/tenants":
+            response = json_response(self.footprint_handler())
+            return response(environ, start_response)
+
+        try:
+            tenant = self.resolve(environ)
+        except RequestEntityTooLarge as err:
+            return err(environ, start_response)
+        if tenant is None:
+            response = NotFound(
+                "Unknown tenant, use a path prefix or a `tenant` field: %s" % list(self.apps)
+            )
+            return response(environ, start_response)
+        return self.apps[tenant](environ, start_response)
+
 
 def run_background(app, interface="127.0.0.1", port=5000):
     """Run the WSGI app in a separate thread, to make integration into
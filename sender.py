@@ -0,0 +1,81 @@
+"""A rate-limited, parallel sender for Telegram API calls. Telegram will not let a bot send more than ~30 messages per
+second, so instead of firing calls from whatever thread happens to need them, bulk operations (fan-outs, edits,
+deletions) are submitted here and executed by a small pool of workers that share a single token bucket."""
+
+import logging
+import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import tracing
+
+log = logging.getLogger("sender")  # pylint: disable=invalid-name
+
+# Telegram's documented global limit for bots, see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits
+DEFAULT_RATE = 30
+DEFAULT_WORKERS = 8
+
+
+class RateLimiter:
+    """Token bucket that refills at `rate` tokens per second and holds at most `burst` tokens"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=None):
+        """Initialize the limiter
+        :param rate: float, how many operations per second are allowed on average
+        :param burst: optional int, how many operations can be performed back-to-back, defaults to `rate`"""
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """Take one token from the bucket, blocking until one is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class Sender:
+    """Executes Telegram API calls in parallel, without exceeding the rate limit"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE, pool=None):
+        """Initialize the sender
+        :param workers: int, number of threads that perform the calls
+        :param rate: float, maximum number of calls per second, shared by all the workers
+        :param pool: optional ThreadPoolExecutor shared with other senders, e.g. one per bot when several bots run in
+                     the same process; each sender still has its own rate limit. `workers` is ignored in this case"""
+        self.limiter = RateLimiter(rate)
+        self.owns_pool = pool is None
+        self.pool = pool or ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sender")
+
+    def _call(self, func, args, kwargs):
+        """Wait for our turn, then perform the call"""
+        self.limiter.acquire()
+        return func(*args, **kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule a call, e.g. `submit(bot.delete_message, chat_id, message_id)`
+        :returns: Future that will hold the result of the call"""
+        # the call belongs to the span that is active in the caller's thread, if any
+        return self.pool.submit(tracing.bind(self._call), func, args, kwargs)
+
+    def run_all(self, calls):
+        """Perform a batch of calls in parallel and wait until all of them are done
+        :param calls: iterable of (func, args, kwargs) tuples
+        :returns: list of Futures, in the same order as `calls`"""
+        futures = [self.submit(func, *args, **kwargs) for func, args, kwargs in calls]
+        wait(futures)
+        return futures
+
+    def stop(self):
+        """Finish the pending calls and release the workers, unless they are shared with other senders"""
+        if self.owns_pool:
+            self.pool.shutdown(wait=True)
@@ -0,0 +1,138 @@
+"""Serialization of the JSON that goes in and out of the bot: the bodies of the REST calls made by the backend, the
+payloads sent to the backend and the files the bot keeps for itself. Everything goes through `loads` and `dumps`,
+which use the fastest library that is installed: `orjson`, then `ujson`, then the standard `json`. Neither of the
+former is required, install one of them to speed things up; `use` switches to another one at runtime.
+
+`dumps` returns bytes, ready to be written to a socket or a file, and `loads` takes the raw body of a request as it
+is: bytes, bytearray or a memoryview. With `orjson`, the body is parsed in place, without being decoded to a str
+first. `embed` puts binary data, e.g. the photo of a receipt, in a payload as base64, without the intermediate str.
+
+The files that only the bot reads, and rewrites often, can be written with `pack` instead, in the quickest encoding
+that is installed: MessagePack if `msgpack` is, otherwise JSON if `orjson` is in use, otherwise a pickle, which is
+written several times faster than the standard `json` does it. `unpack` tells them apart by their first byte."""
+
+import base64
+import json
+import logging
+import pickle
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # pylint: disable=invalid-name
+
+try:
+    import ujson
+except ImportError:
+    ujson = None  # pylint: disable=invalid-name
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # pylint: disable=invalid-name
+
+log = logging.getLogger("serialization")  # pylint: disable=invalid-name
+
+CONTENT_TYPE = "application/json"
+# Never used by MessagePack itself, it marks the output of `pack`; a pickle starts with 0x80, JSON with `{` or `[`
+MSGPACK_MARKER = b"\xc1"
+
+
+def _json_loads(data):
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def _ujson_loads(data):
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return ujson.loads(data)
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, escape_forward_slashes=False).encode()
+
+
+def _orjson_dumps(obj):
+    # the standard library turns numeric keys into strings, e.g. the chat_ids in the statistics
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+# name -> (loads, dumps) of the libraries that are installed, the fastest first
+BACKENDS = OrderedDict()
+if orjson is not None:
+    BACKENDS["orjson"] = (orjson.loads, _orjson_dumps)
+if ujson is not None:
+    BACKENDS["ujson"] = (_ujson_loads, _ujson_dumps)
+BACKENDS["json"] = (_json_loads, _json_dumps)
+
+BACKEND = next(iter(BACKENDS))
+_loads, _dumps = BACKENDS[BACKEND]
+
+
+def use(name):
+    """Switch to another library
+    :param name: str, one of `BACKENDS`
+    :raises KeyError: if it is not installed"""
+    global BACKEND, _loads, _dumps  # pylint: disable=global-statement
+    _loads, _dumps = BACKENDS[name]
+    BACKEND = name
+    log.debug("Using %s for JSON", name)
+
+
+def loads(data):
+    """Parse a JSON document
+    :param data: bytes, bytearray, memoryview or str
+    :raises ValueError: if it is not valid JSON, each library raises its own subclass"""
+    return _loads(data)
+
+
+def dumps(obj):
+    """Serialize an object to JSON
+    :returns: bytes, encoded as UTF-8"""
+    return _dumps(obj)
+
+
+def embed(payload, field, data):
+    """Serialize a dict to JSON, with an additional field that holds binary data encoded as base64. The base64 is
+    copied straight into the output, instead of becoming a str that is then escaped and encoded again
+    :param payload: dict, the other fields
+    :param field: str, the name of the field with the data
+    :param data: bytes-like, e.g. the photo of a receipt
+    :returns: bytes"""
+    head = dumps(payload)
+    return b"".join(
+        (head[:-1], b"," if payload else b"", dumps(field), b':"', base64.b64encode(data), b'"}',)
+    )
+
+
+def pack(obj):
+    """Serialize an object for a file that only the bot reads
+    :returns: bytes"""
+    if msgpack is not None:
+        return MSGPACK_MARKER + msgpack.packb(obj, use_bin_type=True)
+    if BACKEND == "orjson":
+        return dumps(obj)
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def unpack(data):
+    """Read what was written by `pack`, whatever the encoding
+    :param data: bytes
+    :raises ValueError: if the data is damaged, or it was packed with `msgpack`, which is no longer installed"""
+    if data[:1] == MSGPACK_MARKER:
+        if msgpack is None:
+            raise ValueError("This was packed with msgpack, install it to read it")
+        return msgpack.unpackb(memoryview(data)[1:], raw=False, strict_map_key=False)
+    if data[:1] == b"\x80":
+        try:
+            return pickle.loads(data)  # nosec, this is our own file
+        except (pickle.UnpicklingError, EOFError) as err:
+            raise ValueError("Damaged pickle: %s" % err)
+    return loads(data)
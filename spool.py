@@ -0,0 +1,210 @@
+"""Local spool for the shopping receipts sent by volunteers, before they are uploaded to the backend.
+
+Images are stored by the SHA-256 of their content, under `<root>/<first 2 hex digits>/<digest>`, so the same photo
+sent twice takes up space only once, and the second copy is not uploaded again for the same request. The queue of
+uploads that haven't gone through yet is kept in `<root>/spool.json`, which means that an upload that was interrupted
+(the backend was down, the bot was restarted) is resumed later instead of being lost. The queue is rewritten every
+time a receipt arrives or is uploaded; with `binary`, it is kept in `<root>/spool.bin` instead, which is quicker to
+write, see `serialization.pack`. Either file is picked up when the other one is missing, so the format can be
+changed between two runs.
+
+The spool has a size quota. When it is exceeded, the least recently used images that are no longer waiting to be
+uploaded are deleted."""
+
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import serialization
+
+log = logging.getLogger("spool")  # pylint: disable=invalid-name
+
+DEFAULT_QUOTA = 200 * 1024 * 1024  # bytes
+INDEX_NAME = "spool.json"
+BINARY_INDEX_NAME = "spool.bin"
+
+
+class ReceiptSpool:
+    """Content-addressed storage of receipts, with a persistent queue of pending uploads"""
+
+    def __init__(self, root="receipts", quota=DEFAULT_QUOTA, binary=False):
+        """Initialize the spool, resuming whatever was left in it by a previous run
+        :param root: str, the directory where images are kept, it is created if it doesn't exist
+        :param quota: int, maximum total size of the images, in bytes
+        :param binary: bool, if True the queue is kept in a binary file rather than in JSON"""
+        self.root = root
+        self.quota = quota
+        self.binary = binary
+        self.index = os.path.join(root, BINARY_INDEX_NAME if binary else INDEX_NAME)
+        self.lock = Lock()
+        # [request_id, digest] pairs waiting to be uploaded, in order of arrival
+        self.pending = []
+        # request_id -> list of digests that were already uploaded for it
+        self.uploaded = {}
+        # pending entries that are being uploaded right now
+        self.in_flight = set()
+
+        os.makedirs(root, exist_ok=True)
+        self._load()
+        self.size = sum(os.path.getsize(path) for path, _ in self._blobs())
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _blobs(self):
+        """Yield (path, digest) for all the images in the spool"""
+        for entry in os.scandir(self.root):
+            if entry.is_dir():
+                for blob in os.scandir(entry.path):
+                    if not blob.name.endswith(".tmp"):
+                        yield blob.path, blob.name
+
+    def _load(self):
+        """Read the queue left by a previous run, in either format"""
+        other = os.path.join(self.root, INDEX_NAME if self.binary else BINARY_INDEX_NAME)
+        for index in (self.index, other):
+            if os.path.exists(index):
+                with open(index, "rb") as source:
+                    state = serialization.unpack(source.read())
+                self.pending = state["pending"]
+                self.uploaded = state["uploaded"]
+                if self.pending:
+                    log.info("Resuming %i receipt uploads", len(self.pending))
+                if index == other:
+                    # from now on, the queue is written in the new format only
+                    with self.lock:
+                        self._save()
+                    os.remove(other)
+                return
+
+    def _save(self):
+        """Write the queue to disk, the caller must hold the lock"""
+        state = {"pending": self.pending, "uploaded": self.uploaded}
+        encode = serialization.pack if self.binary else serialization.dumps
+        with open(self.index + ".tmp", "wb") as target:
+            target.write(encode(state))
+        os.replace(self.index + ".tmp", self.index)
+
+    def add(self, request_id, data):
+        """Put a receipt in the spool and queue it for upload, unless the same image was already queued or uploaded
+        for this request
+        :param request_id: str, identifier of request
+        :param data: bytes, the image
+        :returns: tuple (digest, bool), the latter is False if the receipt is a duplicate"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+
+        with self.lock:
+            if os.path.exists(path):
+                # refresh its position in the LRU order
+                os.utime(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "wb") as target:
+                    target.write(data)
+                os.replace(path + ".tmp", path)
+                self.size += len(data)
+
+            if [request_id, digest] in self.pending or digest in self.uploaded.get(request_id, ()):
+                return digest, False
+
+            self.pending.append([request_id, digest])
+            self._save()
+            self._evict()
+        return digest, True
+
+    def read(self, digest):
+        """Return the content of an image
+        :param digest: str, as returned by `add`"""
+        with open(self._path(digest), "rb") as source:
+            return source.read()
+
+    def claim(self, digests=None):
+        """Take the next pending upload that nobody else is working on
+        :param digests: optional set of str, only these receipts are considered
+        :returns: tuple (request_id, digest), or None if there's nothing to do"""
+        with self.lock:
+            for request_id, digest in self.pending:
+                if digests is not None and digest not in digests:
+                    continue
+                if (request_id, digest) not in self.in_flight:
+                    self.in_flight.add((request_id, digest))
+                    return request_id, digest
+        return None
+
+    def complete(self, request_id, digest, success):
+        """Report the result of an upload obtained via `claim`
+        :param success: bool, if False the upload stays in the queue and will be attempted again later"""
+        with self.lock:
+            self.in_flight.discard((request_id, digest))
+            if success:
+                self.pending.remove([request_id, digest])
+                self.uploaded.setdefault(request_id, []).append(digest)
+                self._save()
+                self._evict()
+
+    def drain(self, upload, workers=1, digests=None):
+        """Upload everything that is pending, stopping at the first failure; the rest is attempted the next time
+        :param upload: callable(data, request_id), e.g. `Backender.upload_shopping_receipt`, that raises if the
+                       upload did not go through
+        :param workers: int, how many uploads are performed in parallel
+        :param digests: optional set of str, only these receipts are uploaded, e.g. the ones a volunteer just sent
+        :returns: int, number of receipts that were uploaded"""
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload") as pool:
+                return sum(pool.map(lambda _: self.drain(upload, 1, digests), range(workers)))
+
+        done = 0
+        while True:
+            item = self.claim(digests)
+            if item is None:
+                return done
+            request_id, digest = item
+            try:
+                upload(self.read(digest), request_id)
+            except Exception as err:  # pylint: disable=broad-except
+                log.warning("Receipt %s for req:%s not uploaded: %s", digest[:12], request_id, err)
+                self.complete(request_id, digest, False)
+                return done
+            self.complete(request_id, digest, True)
+            done += 1
+
+    def forget(self, request_id):
+        """Drop the list of receipts uploaded for a request, once it is closed; the images themselves stay until
+        they are evicted"""
+        with self.lock:
+            if self.uploaded.pop(request_id, None) is not None:
+                self._save()
+
+    def _evict(self):
+        """Delete the least recently used images until the spool fits in its quota, the caller must hold the lock"""
+        if self.size <= self.quota:
+            return
+        needed = {digest for _, digest in self.pending}
+        blobs = sorted((os.stat(path).st_mtime, path, digest) for path, digest in self._blobs())
+        for _, path, digest in blobs:
+            if self.size <= self.quota:
+                break
+            if digest in needed:
+                continue
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+            log.debug("Evicted receipt %s", digest[:12])
+
+    def stats(self):
+        """Return the number of pending uploads and the size of the spool"""
+        return {"pending": len(self.pending), "bytes": self.size, "quota": self.quota}
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    logging.basicConfig(level=logging.DEBUG)
+    with tempfile.TemporaryDirectory() as workdir:
+        spool = ReceiptSpool(workdir, quota=3000)
+        for i in range(5):
+            print(spool.add("req1", bytes([i]) * 1000))
+        print(spool.add("req1", bytes([4]) * 1000), "<- duplicate")
+        print("uploaded", spool.drain(lambda data, request_id: None), spool.stats())
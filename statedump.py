@@ -0,0 +1,443 @@
+"""Export of the bot's state to JSON lines and import back, for migrations and offline analysis. Stop the bot first,
+it keeps the state in memory and would overwrite whatever was imported.
+
+    python statedump.py export state.bin -o state.ndjson                # PicklePersistence
+    python statedump.py export state -o state.ndjson                    # LazyPersistence, state.idx + state.dat
+    python statedump.py export state --state REQUEST_SENT --state AVAILABLE
+    python statedump.py export state --request 5e8f5e9a6e9ad2e3e5b3b9a1 --kind request
+    python statedump.py import state.ndjson new-state --lazy            # new-state.idx + new-state.dat
+    python statedump.py import state.ndjson new-state.bin
+
+Each line is a record: a volunteer (`"kind": "volunteer"`, their chat_id and session), a request (`"kind": "request"`,
+the same fields the backend sends, plus the details collected from the volunteer) or another entry of bot_data
+(`"kind": "entry"`). An entry is kept as its JSON `value`; the log of announcements as its `announcements`, see
+`AnnouncementLog.to_dict`; a dict with non-string keys, such as the registrations in progress, as a list of
+`items`. Whatever else JSON can't express is kept as a base64-encoded `pickle`, which is only imported with
+`--trust-pickles`: the file is meant to be edited and shared, and unpickling a tampered one runs arbitrary code.
+Records are validated on import, invalid ones are reported and skipped, and the exit code is 1 if there were any.
+
+Records are streamed one at a time, so the memory needed does not depend on the size of the state, as long as the
+state is in the lazy format. A PicklePersistence file is a single pickle, it is loaded whole on export and built
+whole on import, like the bot itself does."""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import pickle
+import sys
+import time
+from collections import Counter
+
+from telegram import InlineKeyboardButton
+
+import constants as c
+from announcements import AnnouncementLog
+from lazypersistence import BOT, USER, RecordStore
+from models import HelpRequest, VolunteerSession
+
+log = logging.getLogger("statedump")  # pylint: disable=invalid-name
+
+KINDS = ("volunteer", "request", "entry")
+# The details of a request that are filled in while it is handled -> the types they can have, None is always allowed
+EXTRA_TYPES = {
+    "time": str,
+    "amount": (str, int, float),
+    "symptoms": list,
+    "wellbeing": int,
+    "would_return": bool,
+    "further_comments": str,
+}
+# How often the progress is logged, in records
+PROGRESS_EVERY = 100000
+# How many records are written to a lazy store before forgetting their checksums, which are only useful to the bot
+CHECKSUM_BATCH = 10000
+
+
+def read_pickle(path):
+    """Iterate over the records of a PicklePersistence file, it is loaded whole
+    :returns: iterator of (kind, key, value), where kind is USER or BOT"""
+    with open(path, "rb") as source:
+        # Bandit warns about unpickling untrusted data; this is the bot's own state
+        data = pickle.load(source)  # nosec
+    for chat_id, session in data.get("user_data", {}).items():
+        yield USER, chat_id, session
+    for key, value in data.get("bot_data", {}).items():
+        yield BOT, key, value
+
+
+def read_lazy(name):
+    """Iterate over the records of a LazyPersistence state, one at a time
+    :param name: str, path prefix of the state files
+    :returns: iterator of (kind, key, value), where kind is USER or BOT"""
+    store = RecordStore(name)
+    try:
+        for kind, offset, length in store.entries():
+            raw = os.pread(store.data.fileno(), length, offset)
+            key, value = pickle.loads(raw)  # nosec, this is our own file
+            yield kind, key, value
+    finally:
+        store.close()
+
+
+def encode_keyboard(keyboard):
+    if keyboard is None:
+        return None
+    return [[button.to_dict() for button in row] for row in keyboard]
+
+
+def decode_keyboard(keyboard, name):
+    if keyboard is None:
+        return None
+    if not isinstance(keyboard, list) or not all(
+        isinstance(row, list) and all(isinstance(button, dict) for button in row)
+        for row in keyboard
+    ):
+        raise ValueError("Field `%s` must be a list of rows of buttons" % name)
+    try:
+        return [[InlineKeyboardButton.de_json(button, None) for button in row] for row in keyboard]
+    except TypeError as err:
+        raise ValueError("Field `%s` has an invalid button" % name) from err
+
+
+def encode(kind, key, value):
+    """Turn a record of the state into a JSON-serializable dict"""
+    if kind == USER:
+        session = VolunteerSession.coerce(value)
+        return {
+            "kind": "volunteer",
+            "chat_id": key,
+            "state": None if session.state is None else session.state.name,
+            "reviewed_request": session.reviewed_request,
+            "current_request": session.current_request,
+            "symptom_keyboard": encode_keyboard(session.symptom_keyboard),
+            "assist_keyboard": encode_keyboard(session.assist_keyboard),
+        }
+
+    request = HelpRequest.coerce(value)
+    if isinstance(request, HelpRequest):
+        return {"kind": "request", **request.to_dict()}
+
+    if isinstance(value, AnnouncementLog):
+        return {"kind": "entry", "key": key, "announcements": value.to_dict()}
+    if is_json(value):
+        return {"kind": "entry", "key": key, "value": value}
+    if isinstance(value, dict):
+        # JSON turns the keys into strings, e.g. the chat_ids of the registrations
+        items = [[item_key, item] for item_key, item in value.items()]
+        if is_json(items):
+            return {"kind": "entry", "key": key, "items": items}
+    log.warning("Entry `%s` can only be exported as a pickle", key)
+    raw = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    return {"kind": "entry", "key": key, "pickle": base64.b64encode(raw).decode("ascii")}
+
+
+def is_json(value):
+    """Tell whether a value comes back the same out of JSON"""
+    try:
+        return json.loads(json.dumps(value)) == value
+    except (TypeError, ValueError):
+        return False
+
+
+def _optional(record, name, kind):
+    value = record.get(name)
+    if value is None:
+        return None
+    if not isinstance(value, kind) or (kind is not bool and isinstance(value, bool)):
+        raise ValueError("Field `%s` has an unexpected type" % name)
+    return value
+
+
+def decode(record, trust_pickles=False):
+    """Validate a record read from JSON and turn it into a record of the state
+    :param trust_pickles: bool, whether entries kept as a pickle are imported; unpickling can run arbitrary code,
+                          only do it for files that come straight from `export`
+    :returns: tuple(kind, key, value), where kind is USER or BOT
+    :raises ValueError: if the record is not valid"""
+    if not isinstance(record, dict):
+        raise ValueError("Expected a JSON object")
+    kind = record.get("kind")
+
+    if kind == "volunteer":
+        chat_id = record.get("chat_id")
+        if not isinstance(chat_id, int) or isinstance(chat_id, bool):
+            raise ValueError("Missing or invalid field `chat_id`")
+        state = record.get("state")
+        if state is not None and state not in c.State.__members__:
+            raise ValueError("Unknown state `%s`" % state)
+        session = VolunteerSession(
+            None if state is None else c.State[state],
+            _optional(record, "reviewed_request", str),
+            _optional(record, "current_request", str),
+        )
+        session.symptom_keyboard = decode_keyboard(
+            record.get("symptom_keyboard"), "symptom_keyboard"
+        )
+        session.assist_keyboard = decode_keyboard(record.get("assist_keyboard"), "assist_keyboard")
+        return USER, chat_id, session
+
+    if kind == "request":
+        request = HelpRequest.from_payload(
+            {key: record.get(key) for key, _, _, _ in HelpRequest.FIELDS}
+        )
+        for name, expected in EXTRA_TYPES.items():
+            value = _optional(record, name, expected)
+            if name == "symptoms":
+                if not all(isinstance(symptom, str) for symptom in value or ()):
+                    raise ValueError("Field `symptoms` must contain strings")
+                value = [sys.intern(symptom) for symptom in value or ()]
+            elif name == "further_comments":
+                value = value or ""
+            setattr(request, name, value)
+        if request.wellbeing is not None and not 0 <= request.wellbeing <= 4:
+            raise ValueError("Field `wellbeing` must be between 0 and 4")
+        return BOT, request.request_id, request
+
+    if kind == "entry":
+        key = record.get("key")
+        if not isinstance(key, str):
+            raise ValueError("Missing or invalid field `key`")
+        if "announcements" in record:
+            return BOT, key, AnnouncementLog.from_dict(record["announcements"])
+        if "items" in record:
+            items = record["items"]
+            if not isinstance(items, list) or not all(
+                isinstance(item, list) and len(item) == 2 for item in items
+            ):
+                raise ValueError("Field `items` must be a list of [key, value] pairs")
+            try:
+                return BOT, key, {item_key: item for item_key, item in items}
+            except TypeError as err:
+                raise ValueError("Field `items` has a key that is not hashable") from err
+        if "pickle" in record:
+            if not trust_pickles:
+                raise ValueError(
+                    "Entry `%s` is a pickle, it is only imported with --trust-pickles" % key
+                )
+            try:
+                raw = base64.b64decode(record["pickle"], validate=True)
+                # Bandit warns about unpickling untrusted data; these are exported by this tool from the bot's state
+                return BOT, key, pickle.loads(raw)  # nosec
+            except Exception as err:  # pylint: disable=broad-except
+                # anything can go wrong while unpickling a damaged record
+                raise ValueError("Field `pickle` is not a valid pickle") from err
+        if "value" not in record:
+            raise ValueError("Missing field `value`")
+        return BOT, key, record["value"]
+
+    raise ValueError("Unknown kind `%s`" % kind)
+
+
+class Selection:
+    """Decides which records are exported or imported"""
+
+    def __init__(self, states=(), request_ids=(), kinds=()):
+        """:param states: iterable of str, state names; if given, only the volunteers in these states are selected,
+                           `NONE` stands for the volunteers who have no state yet
+        :param request_ids: iterable of str; if given, only these requests and the volunteers who are reviewing or
+                            handling them are selected, no other entries
+        :param kinds: iterable of str, some of `KINDS`; if given, only these kinds of records are selected"""
+        self.states = {None if state == "NONE" else state for state in states}
+        self.request_ids = set(request_ids)
+        self.kinds = set(kinds)
+
+    def __call__(self, record):
+        kind = record["kind"]
+        if self.kinds and kind not in self.kinds:
+            return False
+        if kind == "volunteer":
+            if self.states and record["state"] not in self.states:
+                return False
+            involved = {record["reviewed_request"], record["current_request"]}
+            return not self.request_ids or bool(involved & self.request_ids)
+        if kind == "request":
+            return not self.request_ids or record["request_id"] in self.request_ids
+        return not self.request_ids
+
+
+class Progress:
+    """Counts the records as they go through, and reports the throughput"""
+
+    def __init__(self, verb):
+        self.verb = verb
+        self.counts = Counter()
+        self.bytes = 0
+        self.started = time.perf_counter()
+
+    def add(self, kind, size):
+        self.counts[kind] += 1
+        self.bytes += size
+        total = sum(self.counts.values())
+        if total % PROGRESS_EVERY == 0:
+            log.info("%s %i records so far", self.verb, total)
+
+    def report(self):
+        """:returns: str, how many records of each kind went through and how fast"""
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        total = sum(self.counts.values())
+        details = ", ".join("%s: %i" % (kind, self.counts[kind]) for kind in KINDS)
+        return "%s %i records (%s), %.1f MB in %.2f s: %.0f records/s, %.1f MB/s" % (
+            self.verb,
+            total,
+            details,
+            self.bytes / 1e6,
+            elapsed,
+            total / elapsed,
+            self.bytes / 1e6 / elapsed,
+        )
+
+
+def export_state(source, target, selection):
+    """Write the records of a state as JSON lines
+    :param source: iterator of (kind, key, value), see `read_pickle` and `read_lazy`
+    :param target: text file
+    :param selection: Selection
+    :returns: Progress"""
+    progress = Progress("Exported")
+    for kind, key, value in source:
+        record = encode(kind, key, value)
+        if not selection(record):
+            continue
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        target.write(line)
+        progress.add(record["kind"], len(line))
+    return progress
+
+
+def parse(lines, selection, errors, trust_pickles=False):
+    """Iterate over the valid and selected records in JSON lines
+    :param errors: list, where (line number, message) is appended for each invalid record
+    :param trust_pickles: bool, see `decode`
+    :returns: iterator of (kind, key, value, size)"""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            decoded = decode(record, trust_pickles)
+        except ValueError as err:
+            errors.append((number, str(err)))
+            continue
+        if selection(record):
+            yield decoded + (len(line),)
+
+
+def import_lazy(records, name):
+    """Write records to a LazyPersistence state, one at a time
+    :param records: iterator of (kind, key, value, size), see `parse`
+    :param name: str, path prefix of the state files; records that are already there are overwritten
+    :returns: Progress"""
+    progress = Progress("Imported")
+    store = RecordStore(name)
+    try:
+        for kind, key, value, size in records:
+            store.write(kind, key, value)
+            progress.add(record_kind(kind, value), size)
+            if len(store.checksums) >= CHECKSUM_BATCH:
+                store.checksums.clear()
+        store.flush()
+    finally:
+        store.close()
+    return progress
+
+
+def import_pickle(records, path):
+    """Write records to a PicklePersistence file, which is built in memory and then written in one go
+    :param records: iterator of (kind, key, value, size), see `parse`
+    :param path: str, e.g. `state.bin`; it is replaced
+    :returns: Progress"""
+    progress = Progress("Imported")
+    data = {"user_data": {}, "chat_data": {}, "bot_data": {}, "conversations": {}}
+    for kind, key, value, size in records:
+        data["user_data" if kind == USER else "bot_data"][key] = value
+        progress.add(record_kind(kind, value), size)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as target:
+        pickle.dump(data, target, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+    return progress
+
+
+def record_kind(kind, value):
+    if kind == USER:
+        return "volunteer"
+    return "request" if isinstance(value, HelpRequest) else "entry"
+
+
+def is_lazy(name):
+    """Tell whether a path is the prefix of a LazyPersistence state rather than a PicklePersistence file"""
+    return os.path.exists(name + ".idx") and not os.path.isfile(name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the bot's state to JSON lines and back")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="write the state as JSON lines")
+    export.add_argument("source", help="state.bin, or the path prefix of a lazy state")
+    export.add_argument("-o", "--output", default="-", help="JSON lines file, stdout by default")
+
+    load = commands.add_parser("import", help="build a state out of JSON lines")
+    load.add_argument("input", help="JSON lines file, - for stdin")
+    load.add_argument("target", help="state.bin, or the path prefix of a lazy state with --lazy")
+    load.add_argument("--lazy", action="store_true", help="write a LazyPersistence state")
+    load.add_argument("--force", action="store_true", help="overwrite an existing state")
+    load.add_argument(
+        "--trust-pickles",
+        action="store_true",
+        help="import the entries kept as pickles, which can run arbitrary code; only for files you exported",
+    )
+
+    for command in (export, load):
+        command.add_argument(
+            "--state", action="append", default=[], help="only volunteers in this state, repeatable"
+        )
+        command.add_argument(
+            "--request", action="append", default=[], help="only this request, repeatable"
+        )
+        command.add_argument(
+            "--kind", action="append", default=[], choices=KINDS, help="only this kind of record"
+        )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    for state in args.state:
+        if state != "NONE" and state not in c.State.__members__:
+            parser.error(
+                "unknown state %s, expected one of NONE, %s"
+                % (state, ", ".join(c.State.__members__))
+            )
+    selection = Selection(args.state, args.request, args.kind)
+
+    if args.command == "export":
+        source = read_lazy(args.source) if is_lazy(args.source) else read_pickle(args.source)
+        if args.output == "-":
+            progress = export_state(source, sys.stdout, selection)
+        else:
+            with open(args.output, "w", encoding="utf-8") as target:
+                progress = export_state(source, target, selection)
+        log.info(progress.report())
+        return 0
+
+    existing = args.target + ".idx" if args.lazy else args.target
+    if os.path.exists(existing) and not args.force:
+        parser.error("%s exists, use --force to overwrite it" % existing)
+    errors = []
+    lines = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    with lines:
+        records = parse(lines, selection, errors, args.trust_pickles)
+        progress = (
+            import_lazy(records, args.target) if args.lazy else import_pickle(records, args.target)
+        )
+    log.info(progress.report())
+    for number, message in errors[:10]:
+        log.error("Line %i: %s", number, message)
+    if errors:
+        log.error("%i invalid records were skipped", len(errors))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
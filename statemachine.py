@@ -0,0 +1,199 @@
+"""The conversation with a volunteer, as a table of transitions between the states in `c.State`. Every change of state
+goes through `StateMachine.fire`, which looks up (current state, event) in `TRANSITIONS`; if the pair is not there,
+the transition is illegal, the state is left as it is and the `on_illegal` hook decides what to tell the volunteer.
+
+The free-form input (text messages, photos) is dispatched the same way, by (current state, kind of input), see
+`StateMachine.on` and `StateMachine.handle`.
+
+The machine also keeps track of how long volunteers stay in each state: the duration of each transition, i.e. the
+time spent in the state it leaves, and a histogram of these durations per volunteer, to see where they stall. The
+time a volunteer entered their state is only kept in memory, after a restart the clock starts with the next
+transition."""
+
+import bisect
+import logging
+import time
+from collections import Counter, deque
+from threading import Lock
+
+import constants as c
+from stats import percentile_ms
+
+log = logging.getLogger("statemachine")  # pylint: disable=invalid-name
+
+S = c.State
+
+# Stands for any state, including None, in the table below
+ANY = "*"
+
+# States in which a volunteer can be sent new announcements, everywhere else they are busy with a request, or they
+# are answering questions and an announcement would interrupt them
+OPEN = (None, S.EXPECTING_PHONE_NUMBER, S.AVAILABLE, S.REQUEST_SENT, S.REQUEST_TIME_NEGOTIATION)
+REVIEWING = (S.REQUEST_SENT, S.REQUEST_TIME_NEGOTIATION)
+ONBOARDING = (None, S.EXPECTING_PHONE_NUMBER, S.EXPECTING_PROFILE_DETAILS, S.AVAILABLE)
+WORKING = (S.REQUEST_ASSIGNED, S.REQUEST_IN_PROGRESS)
+
+# (event, states it is allowed in, target state)
+RULES = (
+    ("start", ANY, S.EXPECTING_PHONE_NUMBER),
+    ("registered", ONBOARDING, S.AVAILABLE),
+    ("ask_profile", ONBOARDING, S.EXPECTING_PROFILE_DETAILS),
+    ("profile_complete", ONBOARDING, S.AVAILABLE),
+    ("announce", OPEN, S.REQUEST_SENT),
+    ("pick", OPEN, S.REQUEST_SENT),
+    ("offer", REVIEWING, S.REQUEST_TIME_NEGOTIATION),
+    ("decline", REVIEWING, S.AVAILABLE),
+    ("withdraw", REVIEWING, S.AVAILABLE),
+    ("assign", OPEN, S.REQUEST_ASSIGNED),
+    ("confirm", (S.REQUEST_ASSIGNED,), S.REQUEST_ASSIGNED),
+    ("set_off", WORKING, S.REQUEST_IN_PROGRESS),
+    ("cancel", WORKING, S.AVAILABLE),
+    ("done", WORKING, S.EXPECTING_AMOUNT),
+    ("amount", (S.EXPECTING_AMOUNT,), S.EXPECTING_RECEIPT),
+    ("no_expenses", (S.EXPECTING_AMOUNT, S.EXPECTING_RECEIPT), S.EXPECTING_EXIT_SURVEY),
+    ("receipt", (S.EXPECTING_RECEIPT,), S.EXPECTING_EXIT_SURVEY),
+    ("rated", (S.EXPECTING_EXIT_SURVEY,), S.EXPECTING_FURTHER_COMMENTS),
+    ("finish", (S.EXPECTING_FURTHER_COMMENTS,), S.REQUEST_COMPLETED),
+    ("release", ANY, S.AVAILABLE),
+)
+
+# (state, event) -> target state; the events allowed in any state are keyed as (ANY, event)
+TRANSITIONS = {
+    (state, event): target
+    for event, states, target in RULES
+    for state in ((ANY,) if states == ANY else states)
+}
+
+# Upper bounds of the buckets of the time-in-state histograms, in seconds; the last bucket has no upper bound
+BUCKETS = (10, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+BUCKET_LABELS = ("<10s", "<1m", "<5m", "<15m", "<1h", "<4h", "<1d", ">=1d")
+# How many durations are kept per transition, for the percentiles
+DURATION_SAMPLES = 256
+
+
+def state_name(state):
+    return "NONE" if state is None else state.name
+
+
+class StateMachine:
+    """Changes the volunteers' states according to a transition table and measures the time spent in each state"""
+
+    def __init__(self, transitions=None, on_illegal=None, on_transition=None):
+        """Initialize the machine
+        :param transitions: optional dict, (state, event) -> target state, `TRANSITIONS` by default
+        :param on_illegal: optional callable(chat_id, state, event), invoked when an event is not allowed in the
+                           volunteer's state; by default it is only logged
+        :param on_transition: optional callable(chat_id, event, target), invoked after a volunteer moved to a new
+                              state, e.g. to start or cancel a deadline"""
+        self.transitions = transitions or TRANSITIONS
+        self.on_illegal = on_illegal
+        self.on_transition = on_transition
+        # (state, kind of input) -> callable(update, context)
+        self.handlers = {}
+        self.lock = Lock()
+        # chat_id -> (state, monotonic time when it was entered)
+        self.entered = {}
+        # chat_id -> {state name: list of counts, one per bucket}
+        self.histograms = {}
+        # (state name, target name) -> recent durations in seconds
+        self.durations = {}
+        self.counts = Counter()
+        self.illegal = Counter()
+
+    def target(self, state, event):
+        """Return the state a volunteer would move to, or None if the event is not allowed in their state"""
+        target = self.transitions.get((state, event))
+        if target is None:
+            target = self.transitions.get((ANY, event))
+        return target
+
+    def allows(self, state, event):
+        return self.target(state, event) is not None
+
+    def fire(self, chat_id, session, event):
+        """Move a volunteer to the next state
+        :param chat_id: int, the volunteer
+        :param session: models.VolunteerSession
+        :param event: str, one of the events in `RULES`
+        :returns: bool, False if the transition is illegal, in which case the state was not changed"""
+        state = session.state
+        target = self.target(state, event)
+        if target is None:
+            with self.lock:
+                self.illegal[state_name(state), event] += 1
+            if self.on_illegal is None:
+                log.warning("Illegal event `%s` for @%s in %s", event, chat_id, state_name(state))
+            else:
+                self.on_illegal(chat_id, state, event)
+            return False
+
+        session.state = target
+        self.measure(chat_id, state, target)
+        if self.on_transition is not None:
+            self.on_transition(chat_id, event, target)
+        return True
+
+    def measure(self, chat_id, state, target):
+        """Account for the time a volunteer spent in a state, now that they move on to `target`"""
+        now = time.monotonic()
+        with self.lock:
+            previous = self.entered.get(chat_id)
+            self.entered[chat_id] = (target, now)
+            edge = state_name(state), state_name(target)
+            self.counts[edge] += 1
+            if previous is None or previous[0] != state:
+                # we don't know when they got there, e.g. the bot was restarted in the meantime
+                return
+
+            elapsed = now - previous[1]
+            self.durations.setdefault(edge, deque(maxlen=DURATION_SAMPLES)).append(elapsed)
+            histogram = self.histograms.setdefault(chat_id, {})
+            counts = histogram.setdefault(edge[0], [0] * len(BUCKET_LABELS))
+            counts[bisect.bisect_right(BUCKETS, elapsed)] += 1
+
+    def on(self, state, kind, handler):
+        """Register the handler of an input in a state
+        :param state: c.State
+        :param kind: str, e.g. `text` or `photo`
+        :param handler: callable(update, context)"""
+        self.handlers[state, kind] = handler
+
+    def handle(self, kind, update, context):
+        """Pass an input to the handler registered for the volunteer's state
+        :returns: bool, False if the input is not expected in this state"""
+        handler = self.handlers.get((context.user_data.state, kind))
+        if handler is None:
+            with self.lock:
+                self.illegal[state_name(context.user_data.state), kind] += 1
+            return False
+        handler(update, context)
+        return True
+
+    def time_in_state(self, chat_id):
+        """Return the histograms of a volunteer, state name -> {bucket label: count}"""
+        with self.lock:
+            histogram = {
+                name: list(counts) for name, counts in self.histograms.get(chat_id, {}).items()
+            }
+        return {name: dict(zip(BUCKET_LABELS, counts)) for name, counts in histogram.items()}
+
+    def stats(self):
+        """Return how many times each transition happened and how long it took to get there, as well as the
+        number of illegal events per state"""
+        with self.lock:
+            counts = dict(self.counts)
+            durations = {edge: sorted(samples) for edge, samples in self.durations.items()}
+            illegal = dict(self.illegal)
+
+        transitions = {}
+        for edge in sorted(counts):
+            samples = durations.get(edge, [])
+            transitions["%s->%s" % edge] = {
+                "count": counts[edge],
+                "p50_ms": percentile_ms(samples, 0.5),
+                "p95_ms": percentile_ms(samples, 0.95),
+            }
+        return {
+            "transitions": transitions,
+            "illegal": {"%s:%s" % key: count for key, count in sorted(illegal.items())},
+        }
@@ -0,0 +1,11 @@
+"""Small helpers for the statistics that the bot's components report on `/stats`, e.g. the latency percentiles of
+the announcements, the transitions, the saves of the state and the traces."""
+
+
+def percentile_ms(samples, fraction):
+    """Return a percentile of sorted durations in seconds, in milliseconds, or None if there are no samples
+    :param samples: sorted list of float, seconds
+    :param fraction: float, between 0 and 1, e.g. 0.95 for the 95th percentile"""
+    if not samples:
+        return None
+    return round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 1)
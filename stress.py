@@ -0,0 +1,169 @@
+"""Stress test of the bot's handlers with several workers, see `concurrency.py`. Nothing leaves the machine, the
+Telegram API is answered locally, after a delay that stands for the network, and no token is needed.
+
+    python stress.py                                  # 1, 2, 4 and 8 workers
+    python stress.py --workers 1,16 --chats 128 --latency 0.05
+
+Every volunteer is in the middle of the exit survey of their own request and ticks the symptoms on and off, each
+symptom an odd number of times, while the backend assigns and cancels other requests for the same volunteers. Each
+press is a read-modify-write of the request's list of symptoms and of the volunteer's keyboard, followed by a call
+to the Telegram API.
+
+For each number of workers, the output shows the throughput and how it compares to a single worker (1.0 = the
+throughput grows linearly with the workers). The exit code is 1 if an update got lost, i.e. a request does not end
+up with every symptom exactly once, or if the scaling is below `--min-efficiency`."""
+
+import argparse
+import json
+import logging
+import sys
+import tempfile
+import time
+from itertools import count
+from threading import Thread
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+import callbacks
+import constants as c
+from ajubot import Ajubot
+from models import HelpRequest, VolunteerSession
+from replay import FakeRequest, NullBackend
+
+log = logging.getLogger("stress")  # pylint: disable=invalid-name
+
+SYMPTOMS = ("fever", "cough", "heavybreathing")
+
+
+def request_id_of(chat_id):
+    return "%024x" % chat_id
+
+
+def press(update_ids, chat_id, arg):
+    """Build the update of a volunteer who pressed a symptom button"""
+    return {
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Vol"},
+            "chat_instance": str(chat_id),
+            "data": callbacks.encode("symptom", arg, request_id_of(chat_id)),
+            "message": {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}},
+        },
+    }
+
+
+def run(workers, chats, presses, latency):
+    """Run one round of the stress test
+    :param workers: int, the dispatcher's workers
+    :param chats: int, how many volunteers are pressing buttons at the same time
+    :param presses: int, how many times each symptom is pressed, odd
+    :param latency: float, seconds each Telegram API call takes
+    :returns: dict with the throughput and the number of lost updates"""
+    with tempfile.TemporaryDirectory(prefix="stress-") as workdir:
+        bot = Bot("123456:stress-token-not-used", request=FakeRequest(latency))
+        updater = Updater(bot=bot, use_context=True, workers=workers)
+        ajubot = Ajubot(
+            updater, NullBackend(), state_dir=workdir, digest_window=0, concurrent_updates=True
+        )
+        ajubot.init_bot()
+        dispatcher = updater.dispatcher
+        volunteers = range(1000, 1000 + chats)
+        for chat_id in volunteers:
+            request_id = request_id_of(chat_id)
+            dispatcher.bot_data[request_id] = HelpRequest(
+                request_id, "str. Stresului", volunteers=[]
+            )
+            dispatcher.user_data[chat_id] = VolunteerSession(
+                c.State.EXPECTING_EXIT_SURVEY, request_id, request_id
+            )
+
+        update_ids = count(1)
+        updates = [
+            Update.de_json(press(update_ids, chat_id, symptom), bot)
+            for _ in range(presses)
+            for symptom in SYMPTOMS
+            for chat_id in volunteers
+        ]
+        # meanwhile, other requests are announced to the same volunteers, assigned and cancelled
+        client = Client(ajubot.rest, Response)
+        others = [
+            {"request_id": "%024x" % (10 ** 6 + i), "address": "str. Alta", "needs": ["pâine"]}
+            for i in range(chats)
+        ]
+
+        thread = Thread(target=dispatcher.start, name="stress", daemon=True)
+        thread.start()
+        while not dispatcher.running:
+            time.sleep(0.01)
+
+        started = time.perf_counter()
+        for number, update in enumerate(updates):
+            dispatcher.update_queue.put(update)
+            if number % len(SYMPTOMS) == 0 and others:
+                other = others.pop()
+                other["volunteers"] = list(volunteers)
+                client.post("/help_request", data=json.dumps(other))
+                client.post(
+                    "/cancel_help_request",
+                    data=json.dumps({"request_id": other["request_id"], "volunteer": 1}),
+                )
+        dispatcher.update_queue.join()
+        ajubot.chat_queues.join()
+        elapsed = time.perf_counter() - started
+        dispatcher.stop()
+        ajubot.stop()
+
+        lost = 0
+        for chat_id in volunteers:
+            symptoms = dispatcher.bot_data[request_id_of(chat_id)].symptoms
+            if sorted(symptoms) != sorted("symptom_" + symptom for symptom in SYMPTOMS):
+                log.error("Lost update for @%s: %s", chat_id, symptoms)
+                lost += 1
+
+    return {
+        "workers": workers,
+        "updates": len(updates),
+        "elapsed_s": round(elapsed, 3),
+        "throughput": round(len(updates) / elapsed, 1),
+        "lost": lost,
+        "contended": ajubot.locks.stats()["contended"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stress test of the handlers with several workers")
+    parser.add_argument("--workers", default="1,2,4,8", help="comma-separated worker counts")
+    parser.add_argument("--chats", type=int, default=64, help="volunteers pressing buttons")
+    parser.add_argument("--presses", type=int, default=3, help="presses per symptom, odd")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per Telegram API call")
+    parser.add_argument(
+        "--min-efficiency", type=float, default=0.6, help="acceptable scaling, 1.0 = linear"
+    )
+    args = parser.parse_args(argv)
+    if args.presses % 2 == 0:
+        parser.error("--presses must be odd, so that every symptom ends up ticked")
+
+    logging.basicConfig(level=logging.ERROR)
+    results = [
+        run(int(workers), args.chats, args.presses, args.latency)
+        for workers in args.workers.split(",")
+    ]
+
+    failed = False
+    baseline = results[0]["throughput"] / results[0]["workers"]
+    for result in results:
+        result["efficiency"] = round(result["throughput"] / (baseline * result["workers"]), 2)
+        failed = failed or result["lost"] > 0 or result["efficiency"] < args.min_efficiency
+        print(
+            "%(workers)3i workers: %(throughput)8.1f updates/s, efficiency %(efficiency).2f, "
+            "%(lost)i lost, %(contended)i contended locks" % result
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""Several bots in one process, e.g. one per region. Each bot (tenant) has its own token, its own state and its own
+files, in `<root>/<tenant name>/`, so the volunteers of one region never see the requests of another. What is shared:
+- the REST API, on a single port, see `restapi.TenantRouter` for how calls reach the right bot
+- the client of the backend, with its pool of connections
+- the directory of volunteers, see `directory.py`; each bot only sees the volunteers who started a chat with it
+- the workers that perform bulk Telegram calls; each bot keeps its own rate limit, because Telegram counts them
+  separately
+
+The dispatchers' own workers (the ones behind `in_background`) cannot be shared between updaters, so each bot gets a
+smaller pool of them than a standalone bot would. `/tenants` shows how much each bot uses."""
+
+import logging
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from signal import signal, SIGINT, SIGTERM, SIGABRT
+from threading import Event
+
+from telegram.ext import Updater, PicklePersistence
+
+import restapi
+from ajubot import Ajubot
+from directory import TenantView, VolunteerDirectory
+from lazypersistence import LazyPersistence
+from replay import Recorder
+from sender import Sender, DEFAULT_WORKERS
+from tracing import JsonlSink, Tracer
+
+log = logging.getLogger("tenants")  # pylint: disable=invalid-name
+
+# `in_background` workers of each bot; a standalone bot has 4
+DISPATCHER_WORKERS = 2
+
+TENANT_NAME = re.compile(r"^[a-z0-9_-]+$")
+
+
+def parse_tokens(raw):
+    """Parse the list of bots given as `name=token,name=token`
+    :param raw: str, e.g. `chisinau=123:ABC,balti=456:DEF`
+    :returns: OrderedDict, name -> token, in the given order
+    :raises ValueError: if an entry is malformed or a name is used twice"""
+    tokens = OrderedDict()
+    for entry in raw.split(","):
+        name, _, token = entry.strip().partition("=")
+        if not TENANT_NAME.match(name) or not token:
+            raise ValueError("Expected `name=token`, with a lowercase name, got `%s`" % entry)
+        if name in tokens:
+            raise ValueError("Tenant `%s` is listed twice" % name)
+        tokens[name] = token
+    return tokens
+
+
+def make_persistence(base, lazy=False):
+    """Create the persistence of a bot
+    :param base: str, path and prefix of the files, e.g. `state` results in `state.bin`
+    :param lazy: bool, if True, use LazyPersistence, importing the pickled state if there is one
+    Either way, the changes are only written when the persistence is flushed, see `flusher.py`"""
+    if not lazy:
+        return PicklePersistence(base + ".bin", on_flush=True)
+    if os.path.exists(base + ".bin") and not os.path.exists(base + ".idx"):
+        LazyPersistence.from_pickle(base + ".bin", base).store.close()
+    return LazyPersistence(base, on_flush=True)
+
+
+class Tenants:
+    """A set of bots that share a REST API, a backend client and a pool of workers"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        backend,
+        root="tenants",
+        lazy=False,
+        record=None,
+        concurrent_updates=False,
+        trace=None,
+        max_workers=None,
+        admin_token=None,
+    ):
+        """Initialize the set, bots are added via `add`
+        :param backend: Backender, used by all the bots
+        :param root: str, the directory where each bot gets its own subdirectory
+        :param lazy: bool, whether to use LazyPersistence, see `make_persistence`
+        :param record: optional str, name of the file where each bot's traffic is recorded, in its directory
+        :param concurrent_updates: bool, whether the bots handle the updates of different volunteers in parallel
+        :param trace: optional str, name of the file where each bot's traces are exported, in its directory
+        :param max_workers: optional int, how many `in_background` workers each bot can grow to under load, see
+                            `autoscale.py`; by default each bot keeps `DISPATCHER_WORKERS`
+        :param admin_token: optional str, the token that lets another machine change the settings of the bots, see
+                            `restapi.BotRestApi.is_admin`"""
+        self.backend = backend
+        self.root = root
+        self.lazy = lazy
+        self.record = record
+        self.concurrent_updates = concurrent_updates
+        self.trace = trace
+        self.max_workers = max_workers
+        self.admin_token = admin_token
+        self.pool = ThreadPoolExecutor(max_workers=DEFAULT_WORKERS, thread_name_prefix="sender")
+        self.directory = VolunteerDirectory(backend)
+        self.bots = OrderedDict()
+
+    def add(self, name, token):
+        """Create a bot
+        :param name: str, the tenant's name, it is also the path prefix of its REST API
+        :param token: str, the bot's Telegram token
+        :returns: Ajubot"""
+        state_dir = os.path.join(self.root, name)
+        os.makedirs(state_dir, exist_ok=True)
+        updater = Updater(
+            token=token,
+            use_context=True,
+            persistence=make_persistence(os.path.join(state_dir, "state"), self.lazy),
+            workers=DISPATCHER_WORKERS,
+            request_kwargs={"con_pool_size": (self.max_workers or DISPATCHER_WORKERS) + 4},
+        )
+        recorder = Recorder(os.path.join(state_dir, self.record)) if self.record else None
+        sink = JsonlSink(os.path.join(state_dir, self.trace)) if self.trace else None
+        bot = Ajubot(
+            updater,
+            self.backend,
+            state_dir=state_dir,
+            recorder=recorder,
+            sender=Sender(pool=self.pool),
+            # the backend knows the volunteers of every bot, only the ones who talked to this one can be reached
+            directory=TenantView(self.directory, updater.dispatcher.user_data.__contains__),
+            concurrent_updates=self.concurrent_updates,
+            tracer=Tracer(sink),
+            max_workers=self.max_workers,
+            admin_token=self.admin_token,
+        )
+        self.bots[name] = bot
+        log.info("Added tenant %s, state in %s", name, state_dir)
+        return bot
+
+    def footprint(self):
+        """Return the resources used by each bot"""
+        return {name: bot.footprint() for name, bot in self.bots.items()}
+
+    def rest(self):
+        """Return the WSGI app that serves the REST APIs of all the bots"""
+        apps = OrderedDict((name, bot.rest) for name, bot in self.bots.items())
+        return restapi.TenantRouter(apps, self.footprint)
+
+    def serve(self, interface="0.0.0.0", port=5001):  # nosec
+        """The main loop: start all the bots, wait for a signal to stop, then stop them all"""
+        log.info("Starting REST API for %s in separate thread", list(self.bots))
+        restapi.run_background(self.rest(), interface, port)
+        self.directory.start()
+        for bot in self.bots.values():
+            bot.start()
+
+        self.idle()
+
+        for bot in self.bots.values():
+            bot.stop()
+        self.pool.shutdown(wait=True)
+        self.directory.stop()
+
+    def idle(self):
+        """Block until SIGINT, SIGTERM or SIGABRT; `Updater.idle` would only stop its own bot"""
+        stopped = Event()
+
+        def on_signal(signum, frame):
+            for bot in self.bots.values():
+                # this saves the bot's state and stops its updater
+                bot.updater.signal_handler(signum, frame)
+            stopped.set()
+
+        for signum in (SIGINT, SIGTERM, SIGABRT):
+            signal(signum, on_signal)
+        while not stopped.wait(1):
+            pass
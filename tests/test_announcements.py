@@ -0,0 +1,68 @@
+"""Withdrawing and reopening the announcements of a request, see `announcements.py`"""
+
+import pickle
+
+import announcements
+from announcements import AnnouncementLog
+
+
+def test_withdraw_returns_what_was_sent():
+    log = AnnouncementLog()
+    log.record("req-1", 11, 100)
+    log.record("req-1", 12, 200)
+    log.record("req-2", 11, 101)
+    assert log.withdraw("req-1") == [(11, 100), (12, 200)]
+    assert log.is_withdrawn("req-1")
+    assert not log.is_withdrawn("req-2")
+    # nothing is left to take down the second time
+    assert log.withdraw("req-1") == []
+
+
+def test_reopen():
+    log = AnnouncementLog()
+    log.record("req-1", 11, 100)
+    log.withdraw("req-1")
+    assert log.reopen("req-1")
+    assert not log.is_withdrawn("req-1")
+    assert not log.reopen("req-1")
+
+    # the next round is withdrawn on its own
+    log.record("req-1", 12, 300)
+    assert log.withdraw("req-1") == [(12, 300)]
+    assert log.is_withdrawn("req-1")
+
+
+def test_reopen_unknown_request():
+    log = AnnouncementLog()
+    assert not log.reopen("req-1")
+    assert len(log) == 0
+
+
+def test_digest_is_released_with_its_last_request():
+    log = AnnouncementLog()
+    log.record_digest(["req-1", "req-2"], 11, 100)
+    assert log.withdraw("req-1") == [(11, 100)]
+    assert not log.release(11, 100)
+    assert log.withdraw("req-2") == [(11, 100)]
+    assert log.release(11, 100)
+    # a single announcement can always be taken down
+    assert log.release(12, 200)
+
+
+def test_history_is_bounded(monkeypatch):
+    monkeypatch.setattr(announcements, "WITHDRAWN_HISTORY", 3)
+    log = AnnouncementLog()
+    for number in range(5):
+        log.withdraw("req-%i" % number)
+    assert [log.is_withdrawn("req-%i" % number) for number in range(5)] == [False, False] + [
+        True
+    ] * 3
+
+
+def test_pickled_without_the_lock():
+    log = AnnouncementLog()
+    log.record("req-1", 11, 100)
+    log.withdraw("req-2")
+    copy = pickle.loads(pickle.dumps(log))
+    assert copy.is_withdrawn("req-2")
+    assert copy.withdraw("req-1") == [(11, 100)]
@@ -0,0 +1,92 @@
+"""The sizing of the dispatcher's pool of workers, see `autoscale.py`"""
+
+import time
+from queue import Queue
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import Dispatcher
+
+import autoscale
+from autoscale import WorkerScaler
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = Dispatcher(SimpleNamespace(id=1), Queue(), workers=2, use_context=True)
+    # pylint: disable=protected-access
+    dispatcher._init_async_threads("test", dispatcher.workers)
+    # as if its loop was running, without polling anything
+    dispatcher.running = True
+    yield dispatcher
+    dispatcher.running = False
+    dispatcher.stop()
+
+
+def alive(scaler):
+    return sum(thread.is_alive() for thread in scaler.threads)
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_a_backlog_grows_the_pool(dispatcher):
+    scaler = WorkerScaler(dispatcher, maximum=4)
+    for _ in range(5):
+        dispatcher.update_queue.put("update")
+    # one busy sample is not enough
+    assert scaler.sample() == 0
+    assert scaler.sample() == 1
+    assert scaler.size == 3 and alive(scaler) == 3
+    # it keeps growing by half, up to the maximum
+    scaler.sample()
+    assert scaler.sample() == 1
+    scaler.sample()
+    assert scaler.sample() == 0
+    assert scaler.size == 4 and alive(scaler) == 4
+    assert scaler.stats()["grown"] == 2
+
+
+def test_an_idle_pool_shrinks_slowly(dispatcher):
+    scaler = WorkerScaler(dispatcher, minimum=1)
+    results = []
+    for _ in range(autoscale.SHRINK_AFTER):
+        # the probes come back right away, the lag stays low
+        assert wait_for(lambda: scaler.probe_sent is None)
+        results.append(scaler.sample())
+    assert results[-1] == -1 and not any(results[:-1])
+    assert scaler.size == 1
+    # one of the workers took the sentinel and quit
+    assert wait_for(lambda: alive(scaler) == 1)
+    # never below the minimum
+    scaler.idle = autoscale.SHRINK_AFTER
+    assert scaler.sample() == 0
+
+
+def test_the_lag_counts_the_probe_on_its_way(dispatcher):
+    scaler = WorkerScaler(dispatcher)
+    release = Event()
+    for _ in range(dispatcher.workers):
+        dispatcher.run_async(release.wait)
+    scaler.sample()
+    time.sleep(0.05)
+    assert scaler.current_lag() >= 0.05
+    release.set()
+    assert wait_for(lambda: scaler.probe_sent is None)
+    assert scaler.lag >= 0.05
+    assert scaler.stats()["p50_lag_ms"] >= 50
+
+
+def test_nothing_changes_while_the_dispatcher_is_stopped(dispatcher):
+    scaler = WorkerScaler(dispatcher, maximum=4)
+    dispatcher.running = False
+    for _ in range(5):
+        dispatcher.update_queue.put("update")
+    scaler.busy = autoscale.GROW_AFTER
+    assert scaler.sample() == 0
+    assert scaler.size == 2
@@ -0,0 +1,90 @@
+"""Encoding and decoding of the callback_data of inline buttons, see `callbacks.py`"""
+
+import pytest
+
+import callbacks
+
+OBJECT_ID = "5e84c10a9938cfffc0217ed1"
+UUID = "fe91e4b6-e902-4d03-8500-d058673cb9bd"
+
+
+@pytest.mark.parametrize("request_id", [OBJECT_ID, UUID, "req-42", "cerere-ă", None])
+@pytest.mark.parametrize("route", sorted(callbacks.ROUTES))
+def test_round_trip(route, request_id):
+    data = callbacks.encode(route, "20:45", request_id)
+    assert len(data.encode()) <= callbacks.MAX_LENGTH
+    assert callbacks.decode(data) == (route, request_id, "20:45")
+
+
+def test_ids_are_packed():
+    # 24 hex digits become 12 bytes, a UUID 16 bytes, both as base64
+    assert len(callbacks.pack_request_id(OBJECT_ID)) == 1 + 16
+    assert len(callbacks.pack_request_id(UUID)) == 1 + 22
+    assert callbacks.pack_request_id(None) == callbacks.NO_REQUEST
+
+
+def test_argument_may_contain_colons():
+    assert callbacks.decode(callbacks.encode("eta", "20:45:00", OBJECT_ID)).arg == "20:45:00"
+
+
+def test_code_is_the_legacy_form():
+    assert (
+        callbacks.decode(callbacks.encode("handle", "onmyway", OBJECT_ID)).code == "handle_onmyway"
+    )
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        ("eta_20:45", ("eta", None, "20:45")),
+        ("handle_onmyway", ("handle", None, "onmyway")),
+        ("furthercomments_no", ("further", None, "no")),
+        ("state_", ("state", None, "")),
+    ],
+)
+def test_legacy_payloads(data, expected):
+    assert callbacks.decode(data) == expected
+
+
+def test_too_long_is_rejected():
+    with pytest.raises(ValueError):
+        callbacks.encode("eta", "x" * callbacks.MAX_LENGTH, OBJECT_ID)
+
+
+def test_unknown_route_cannot_be_encoded():
+    with pytest.raises(KeyError):
+        callbacks.encode("nowhere", "x")
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        "",
+        "nowhere_x",
+        "1z-:x",  # unknown route code
+        "1e",  # nothing after the route
+        "1eo!!!:x",  # not base64
+        "1eoAAAA:x",  # too short for an object ID
+        "1exAAAA:x",  # unknown kind of ID
+        "1eu" + "A" * 5 + ":x",  # too short for a UUID
+        "1es" + "_w:x",  # not UTF-8
+    ],
+)
+def test_malformed_payloads_are_rejected(data):
+    with pytest.raises(ValueError):
+        callbacks.decode(data)
+
+
+def test_router_drops_what_it_cannot_decode_or_the_guard_refuses():
+    calls = []
+    router = callbacks.CallbackRouter(guard=lambda update, context, callback: callback.arg == "no")
+    router.add("eta", lambda update, context, callback: calls.append(callback))
+
+    def update(data):
+        return type("Update", (), {"callback_query": type("Query", (), {"data": data})})
+
+    router.dispatch(update(callbacks.encode("eta", "20:45", OBJECT_ID)), None)
+    router.dispatch(update(callbacks.encode("eta", "no", OBJECT_ID)), None)
+    router.dispatch(update("garbage"), None)
+    assert calls == [("eta", OBJECT_ID, "20:45")]
+    assert router.stats()["eta"]["calls"] == 1
@@ -0,0 +1,183 @@
+"""Retries and suppression of failed Telegram sends, see `delivery.py`"""
+
+import heapq
+import time
+
+import pytest
+from telegram.error import (
+    BadRequest,
+    ChatMigrated,
+    NetworkError,
+    RetryAfter,
+    TimedOut,
+    Unauthorized,
+)
+
+import delivery
+from delivery import BLOCKED, PERMANENT, RETRY, Delivery
+
+
+class FakeBot:
+    """Records the messages it is asked to send, failing with the errors it is given first"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, text))
+        return "message %s" % text
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.tokens = 0
+
+    def acquire(self):
+        self.tokens += 1
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "delivery.bin")
+
+
+@pytest.mark.parametrize(
+    "err, kind",
+    [
+        (RetryAfter(5), RETRY),
+        (ChatMigrated(-100), RETRY),
+        (TimedOut(), RETRY),
+        (NetworkError("Connection reset"), RETRY),
+        (Unauthorized("Forbidden: bot was blocked by the user"), BLOCKED),
+        (BadRequest("Chat not found"), BLOCKED),
+        (BadRequest("Can't parse entities"), PERMANENT),
+        (ValueError("not from Telegram"), PERMANENT),
+    ],
+)
+def test_classify(err, kind):
+    assert delivery.classify(err) == kind
+
+
+def test_backoff():
+    assert delivery.backoff(1) == delivery.BACKOFF_BASE
+    assert delivery.backoff(3) == delivery.BACKOFF_BASE * 4
+    assert delivery.backoff(50) == delivery.BACKOFF_MAX
+    # never earlier than Telegram asked
+    assert delivery.backoff(1, RetryAfter(30)) == 30
+    assert delivery.backoff(1, ChatMigrated(-100)) == 0
+
+
+def test_transient_failures_are_deferred(path):
+    bot = FakeBot(RetryAfter(30))
+    sender = Delivery(bot, path)
+    assert sender.send_message(11, "hello", tag=("announcement", "req-1")) is None
+    assert sender.stats() == {"pending": 1, "suppressed": 0}
+    due, _, attempts, method, chat_id, kwargs, tag = sender.queue[0]
+    assert due >= time.time() + 29
+    assert (attempts, method, chat_id, kwargs, tag) == (
+        1,
+        "send_message",
+        11,
+        {"text": "hello"},
+        ("announcement", "req-1"),
+    )
+
+
+def test_blocked_chats_are_suppressed(path):
+    bot = FakeBot(Unauthorized("Forbidden: bot was blocked by the user"))
+    sender = Delivery(bot, path)
+    assert sender.send_message(11, "hello") is None
+    assert sender.is_suppressed(11)
+    # nothing is even attempted until the user comes back
+    assert sender.send_message(11, "again") is None
+    assert bot.sent == []
+    sender.unsuppress(11)
+    assert sender.send_message(11, "back") == "message back"
+
+
+def test_permanent_failures_are_raised(path):
+    sender = Delivery(FakeBot(BadRequest("Can't parse entities")), path)
+    with pytest.raises(BadRequest):
+        sender.send_message(11, "*broken")
+    assert sender.stats() == {"pending": 0, "suppressed": 0}
+
+
+def test_retries_are_queued_by_due_time(path):
+    sender = Delivery(FakeBot(RetryAfter(30), RetryAfter(10), TimedOut()), path)
+    for chat_id in (11, 12, 13):
+        sender.send_message(chat_id, "hello")
+    queue = list(sender.queue)
+    order = [heapq.heappop(queue)[4] for _ in range(3)]
+    assert order == [13, 12, 11]
+
+
+def test_retries_that_are_due_go_out_in_order_through_the_limiter(path):
+    bot = FakeBot(TimedOut(), TimedOut(), TimedOut())
+    limiter = CountingLimiter()
+    sender = Delivery(bot, path, limiter=limiter)
+    delivered = []
+    sender.register("announcement", delivered=lambda tag, chat_id, message: delivered.append(tag))
+    for chat_id in (11, 12, 13):
+        sender.send_message(chat_id, "hello %i" % chat_id, tag=("announcement", chat_id))
+    for entry in sender.queue:
+        # all due at once, they keep the order in which they failed
+        entry[0] = 0
+    sender.start()
+    deadline = time.time() + 5
+    while len(bot.sent) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    sender.stop()
+    assert [chat_id for chat_id, _ in bot.sent] == [11, 12, 13]
+    assert delivered == [("announcement", 11), ("announcement", 12), ("announcement", 13)]
+    assert limiter.tokens == 3
+
+
+def test_stale_retries_are_dropped(path):
+    bot = FakeBot()
+    sender = Delivery(bot, path)
+    sender.register("announcement", stale=lambda tag, chat_id: tag[1] == "req-1")
+    sender.retry(1, "send_message", 11, {"text": "old"}, ("announcement", "req-1"))
+    sender.retry(1, "send_message", 11, {"text": "new"}, ("announcement", "req-2"))
+    assert bot.sent == [(11, "new")]
+
+
+def test_a_failed_retry_is_rescheduled(path):
+    sender = Delivery(FakeBot(TimedOut()), path)
+    sender.retry(1, "send_message", 11, {"text": "hello"}, None)
+    assert sender.queue[0][2] == 2
+
+
+def test_give_up_after_max_attempts(path):
+    sender = Delivery(FakeBot(TimedOut()), path)
+    sender.retry(delivery.MAX_ATTEMPTS - 1, "send_message", 11, {"text": "hello"}, None)
+    assert sender.stats() == {"pending": 0, "suppressed": 0}
+
+
+def test_state_survives_a_restart(path):
+    sender = Delivery(FakeBot(TimedOut(), Unauthorized("bot was blocked by the user")), path)
+    sender.send_message(11, "hello")
+    sender.send_message(12, "hello")
+    sender.start()
+    sender.stop()
+
+    restarted = Delivery(FakeBot(), path)
+    assert restarted.stats() == {"pending": 1, "suppressed": 1}
+    assert restarted.queue[0][4] == 11 and restarted.is_suppressed(12)
+    # new retries are numbered after the ones that were loaded
+    assert next(restarted.sequence) > restarted.queue[0][1]
+
+
+def test_a_burst_of_failures_is_saved_once(path, monkeypatch):
+    saves = []
+    sender = Delivery(FakeBot(*[TimedOut()] * 20), path, save_interval=60)
+    monkeypatch.setattr(sender, "save", lambda: saves.append(len(sender.queue)))
+    sender.start()
+    for chat_id in range(20):
+        sender.send_message(chat_id, "hello")
+    time.sleep(0.05)
+    assert saves == []
+    sender.stop()
+    assert saves == [20]
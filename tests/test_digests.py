@@ -0,0 +1,130 @@
+"""The coalescing of a volunteer's announcements into digests, see `digests.py`"""
+
+import time
+from threading import Event
+
+from digests import DigestBuffer
+
+
+class Collector:
+    """The `flush` of a buffer, it keeps what it got and tells when it got enough"""
+
+    def __init__(self, expected=1):
+        self.flushed = []
+        self.expected = expected
+        self.done = Event()
+
+    def __call__(self, chat_id, items):
+        self.flushed.append((chat_id, list(items)))
+        if len(self.flushed) >= self.expected:
+            self.done.set()
+
+
+def test_announcements_within_the_window_are_coalesced():
+    collector = Collector(expected=2)
+    buffer = DigestBuffer(collector, window=0.1)
+    for item in ("req-1", "req-2", "req-3"):
+        buffer.add(11, item)
+    buffer.add(12, "req-1")
+    assert len(buffer) == 2
+    assert collector.flushed == []
+    assert collector.done.wait(2)
+    assert sorted(collector.flushed) == [(11, ["req-1", "req-2", "req-3"]), (12, ["req-1"])]
+    assert len(buffer) == 0
+    buffer.stop()
+
+
+def test_the_window_is_not_extended():
+    collector = Collector()
+    buffer = DigestBuffer(collector, window=0.3)
+    buffer.add(11, "req-1")
+    closes = list(buffer.due)
+    time.sleep(0.1)
+    buffer.add(11, "req-2")
+    # the window still closes 0.3 s after the first item
+    assert buffer.due == closes
+    assert collector.done.wait(2)
+    assert collector.flushed == [(11, ["req-1", "req-2"])]
+    # the next item starts a new window
+    buffer.add(11, "req-3")
+    buffer.stop()
+    assert collector.flushed[-1] == (11, ["req-3"])
+
+
+def test_no_window_means_no_delay():
+    collector = Collector()
+    buffer = DigestBuffer(collector, window=0)
+    buffer.add(11, "req-1")
+    buffer.add(11, "req-2")
+    assert collector.flushed == [(11, ["req-1"]), (11, ["req-2"])]
+    assert buffer.thread is None
+
+
+def test_urgent_items_come_first():
+    collector = Collector()
+    urgency = {"groceries": 0, "medicine": 2, "symptoms": 1}
+    buffer = DigestBuffer(collector, window=60, priority=lambda item: urgency[item[0]])
+    for item in (("groceries", 1), ("medicine", 2), ("groceries", 3), ("symptoms", 4)):
+        buffer.add(11, item)
+    buffer.flush_all()
+    # items with the same priority keep their order of arrival
+    assert collector.flushed == [
+        (11, [("medicine", 2), ("symptoms", 4), ("groceries", 1), ("groceries", 3)])
+    ]
+    buffer.stop()
+
+
+def test_flushes_are_submitted():
+    collector = Collector()
+    submitted = []
+
+    def submit(func, *args):
+        submitted.append(args[0])
+        func(*args)
+
+    buffer = DigestBuffer(collector, window=60, submit=submit)
+    buffer.add(11, "req-1")
+    buffer.add(12, "req-1")
+    buffer.flush_all()
+    assert sorted(submitted) == [11, 12]
+    assert len(collector.flushed) == 2
+    buffer.stop()
+
+
+def test_stop_flushes_what_is_left_and_holds_nothing_back():
+    collector = Collector()
+    buffer = DigestBuffer(collector, window=60)
+    buffer.add(11, "req-1")
+    buffer.stop()
+    assert collector.flushed == [(11, ["req-1"])]
+    assert not buffer.thread.is_alive()
+    buffer.add(11, "req-2")
+    assert collector.flushed[-1] == (11, ["req-2"])
+
+
+def test_a_failed_flush_does_not_stop_the_others():
+    flushed = []
+
+    def flush(chat_id, items):
+        if chat_id == 11:
+            raise RuntimeError("Telegram is down")
+        flushed.append(chat_id)
+
+    buffer = DigestBuffer(flush, window=60)
+    buffer.add(11, "req-1")
+    buffer.add(12, "req-1")
+    buffer.flush_all()
+    assert flushed == [12]
+    buffer.stop()
+
+
+def test_one_thread_for_all_the_volunteers():
+    collector = Collector(expected=50)
+    buffer = DigestBuffer(collector, window=0.05)
+    first = None
+    for chat_id in range(50):
+        buffer.add(chat_id, "req-1")
+        first = first or buffer.thread
+    assert buffer.thread is first
+    assert collector.done.wait(2)
+    buffer.stop()
@@ -0,0 +1,118 @@
+"""The coalesced saving of the state, see `flusher.py`"""
+
+import time
+from types import SimpleNamespace
+
+from flusher import Flusher
+
+
+class Persistence:
+    """Keeps what it was asked to save, and how many times it was flushed"""
+
+    def __init__(self, failures=0):
+        self.users = {}
+        self.bot_data = None
+        self.flushes = 0
+        self.failures = failures
+
+    def update_user_data(self, chat_id, data):
+        self.users[chat_id] = data
+
+    def update_bot_data(self, data):
+        self.bot_data = dict(data)
+
+    def flush(self):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        self.flushes += 1
+
+
+def make_dispatcher(persistence):
+    return SimpleNamespace(
+        persistence=persistence,
+        user_data={11: "session 11", 12: "session 12"},
+        bot_data={"req-1": "request 1"},
+    )
+
+
+def test_changes_are_saved_together():
+    persistence = Persistence()
+    flusher = Flusher(make_dispatcher(persistence), interval=60, threshold=100)
+    flusher.mark((11,), ("req-1",))
+    flusher.mark((11, 12))
+    # a volunteer who is not in user_data anymore is skipped
+    flusher.mark((13,))
+    assert len(flusher) == 4
+    assert persistence.flushes == 0
+
+    assert flusher.flush() == 4
+    assert persistence.flushes == 1
+    assert persistence.users == {11: "session 11", 12: "session 12"}
+    assert persistence.bot_data == {"req-1": "request 1"}
+    # nothing changed since
+    assert flusher.flush() == 0
+    assert persistence.flushes == 1
+
+
+def test_the_threshold_flushes_right_away_without_a_thread():
+    persistence = Persistence()
+    flusher = Flusher(make_dispatcher(persistence), interval=60, threshold=2)
+    flusher.mark((11,))
+    assert persistence.flushes == 0
+    flusher.mark((), ("req-1",))
+    assert persistence.flushes == 1
+    assert flusher.stats()["reasons"] == {"threshold": 1}
+
+
+def test_the_threshold_wakes_the_thread_up():
+    persistence = Persistence()
+    flusher = Flusher(make_dispatcher(persistence), interval=60, threshold=2)
+    flusher.start()
+    flusher.mark((11, 12))
+    deadline = time.time() + 2
+    while persistence.flushes == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    flusher.stop()
+    assert persistence.flushes == 1
+    assert flusher.stats()["reasons"] == {"threshold": 1}
+
+
+def test_the_interval():
+    persistence = Persistence()
+    flusher = Flusher(make_dispatcher(persistence), interval=0.05, threshold=100)
+    flusher.start()
+    flusher.mark((11,))
+    deadline = time.time() + 2
+    while persistence.flushes == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    flusher.stop()
+    assert flusher.stats()["reasons"] == {"interval": 1}
+
+
+def test_stop_saves_what_is_left():
+    persistence = Persistence()
+    flusher = Flusher(make_dispatcher(persistence), interval=60, threshold=100)
+    flusher.start()
+    flusher.mark((12,))
+    flusher.stop()
+    assert persistence.users == {12: "session 12"}
+    assert flusher.stats()["reasons"] == {"shutdown": 1}
+
+
+def test_a_failed_flush_keeps_the_records():
+    persistence = Persistence(failures=1)
+    flusher = Flusher(make_dispatcher(persistence), interval=60, threshold=100)
+    flusher.mark((11,), ("req-1",))
+    assert flusher.flush() == 0
+    assert len(flusher) == 2
+    assert flusher.flush() == 2
+    stats = flusher.stats()
+    assert (stats["failures"], stats["flushes"], stats["records"], stats["dirty"]) == (1, 1, 2, 0)
+    assert stats["p50_ms"] is not None
+
+
+def test_nothing_to_save_without_a_persistence():
+    flusher = Flusher(make_dispatcher(None))
+    flusher.mark((11,))
+    assert flusher.flush() == 0
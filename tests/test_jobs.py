@@ -0,0 +1,123 @@
+"""The progress of the jobs started through the REST API, see `jobs.py`"""
+
+import pytest
+
+import jobs
+from jobs import Job, JobTracker, QueueFull
+
+
+def test_outcomes_are_counted():
+    tracker = JobTracker()
+    job = tracker.create("help_request", "req-1")
+    assert job.status == jobs.PENDING
+    with job:
+        assert job.status == jobs.RUNNING
+        job.expect(3)
+        job.record(11, jobs.SENT, 0.01)
+        job.record(12, jobs.SKIPPED_BUSY)
+        job.record(13, jobs.SKIPPED_UNKNOWN)
+    summary = job.summary()
+    assert summary["status"] == jobs.DONE
+    assert (summary["total"], summary["processed"]) == (3, 3)
+    assert summary["outcomes"][jobs.SENT] == 1 and summary["outcomes"][jobs.SKIPPED_BUSY] == 1
+    assert tracker.get(job.job_id) is job
+    assert tracker.pending() == {}
+
+
+def test_a_failed_send_makes_the_job_partial():
+    job = Job("help_request")
+    with job:
+        job.call(11, jobs.SENT, lambda: None)
+        with pytest.raises(RuntimeError):
+            job.call(12, jobs.SENT, _fail)
+    assert job.status == jobs.PARTIAL
+    recipients = {entry["chat_id"]: entry for entry in job.to_dict()["recipients"]}
+    assert recipients[11]["outcome"] == jobs.SENT
+    assert recipients[12]["outcome"] == jobs.UNDELIVERED
+    assert recipients[12]["error"] == "blocked"
+
+
+def test_a_crash_fails_the_job():
+    job = Job("cancel_help_request")
+    with pytest.raises(KeyError):
+        with job:
+            raise KeyError("req-1")
+    assert job.status == jobs.FAILED
+    assert job.error.startswith("KeyError")
+
+
+def test_a_later_outcome_replaces_the_first():
+    job = Job("assign_help_request")
+    with job:
+        job.record(11, jobs.UNDELIVERED, 0.5, "too old")
+        job.record(11, jobs.EDITED, 0.25)
+    entry = job.to_dict()["recipients"][0]
+    assert (entry["outcome"], entry["elapsed_ms"], entry["error"]) == (jobs.EDITED, 750.0, None)
+    assert job.status == jobs.DONE
+
+
+def test_held_jobs_finish_once_released():
+    finished = []
+    job = Job("help_request", on_finish=finished.append)
+    with job:
+        job.record(11, jobs.BATCHED)
+        job.hold()
+        job.hold()
+    assert job.status == jobs.RUNNING and finished == []
+    job.record(11, jobs.SENT)
+    job.release()
+    assert job.status == jobs.RUNNING
+    job.release()
+    assert job.status == jobs.DONE and finished == [job]
+
+
+def test_release_before_the_block_is_over():
+    job = Job("help_request")
+    with job:
+        job.hold()
+        job.release()
+        assert job.status == jobs.RUNNING
+    assert job.status == jobs.DONE
+
+
+def test_limits():
+    tracker = JobTracker()
+    first = tracker.create("help_request", limit=1)
+    with pytest.raises(QueueFull) as info:
+        tracker.create("help_request", limit=1)
+    assert not info.value.overall and info.value.pending == 1
+    with pytest.raises(QueueFull) as info:
+        tracker.create("cancel_help_request", overall_limit=1)
+    assert info.value.overall
+    assert tracker.pending() == {"help_request": 1}
+
+    # an abandoned job gives its slot back, once
+    first.abandon("could not be queued")
+    first.abandon("could not be queued")
+    assert first.status == jobs.FAILED
+    assert tracker.pending() == {}
+    tracker.create("help_request", limit=1)
+
+
+def test_abandon_leaves_running_jobs_alone():
+    tracker = JobTracker()
+    job = tracker.create("help_request")
+    with job:
+        job.abandon("too late")
+        assert job.status == jobs.RUNNING
+    assert job.status == jobs.DONE
+    assert tracker.average_duration("help_request") is not None
+
+
+def test_oldest_jobs_are_forgotten():
+    tracker = JobTracker(capacity=3)
+    created = [tracker.create("help_request") for _ in range(5)]
+    assert len(tracker) == 3
+    assert tracker.get(created[0].job_id) is None
+    assert [summary["job"] for summary in tracker.recent()] == [
+        job.job_id for job in reversed(created[2:])
+    ]
+
+
+def _fail():
+    raise RuntimeError("blocked")
@@ -0,0 +1,160 @@
+"""The lazily loaded state, see `lazypersistence.py`"""
+
+import os
+import pickle
+import time
+from threading import Barrier, Thread
+
+import pytest
+
+from lazypersistence import BOT, USER, LazyPersistence, RecordStore
+from models import HelpRequest, VolunteerSession
+
+
+@pytest.fixture
+def base(tmp_path):
+    return str(tmp_path / "state")
+
+
+def test_records_survive_a_reopen(base):
+    store = RecordStore(base)
+    assert store.write(USER, 42, {"state": 1})
+    assert store.write(BOT, "req-1", ["a"])
+    store.flush()
+    store.close()
+
+    store = RecordStore(base)
+    assert store.read(USER, 42) == (True, {"state": 1})
+    assert store.read(BOT, "req-1") == (True, ["a"])
+    assert store.read(USER, 43) == (False, None)
+    # the same key under another kind is a different record
+    assert not store.exists(BOT, 42)
+    store.close()
+
+
+def test_unchanged_records_are_not_written_again(base):
+    store = RecordStore(base)
+    assert store.write(USER, 42, {"state": 1})
+    size = store.data_size
+    assert not store.write(USER, 42, {"state": 1})
+    assert store.data_size == size
+    assert store.write(USER, 42, {"state": 2})
+    assert store.read(USER, 42) == (True, {"state": 2})
+    store.close()
+
+
+def test_deleted_records_are_gone(base):
+    store = RecordStore(base)
+    store.write(USER, 42, "x")
+    assert store.delete(USER, 42)
+    assert not store.delete(USER, 42)
+    assert not store.exists(USER, 42)
+    # the slot is reused
+    store.write(USER, 42, "y")
+    assert store.read(USER, 42) == (True, "y")
+    store.close()
+
+
+def test_rebuild_keeps_only_the_live_records(base):
+    store = RecordStore(base)
+    for version in range(50):
+        for chat_id in range(20):
+            store.write(USER, chat_id, {"version": version, "padding": "x" * 100})
+    store.delete(USER, 0)
+    store.rebuild()
+    assert os.path.getsize(base + ".dat") == store.live_bytes
+    assert sorted(kind for kind, _, _ in store.entries()) == [USER] * 19
+    store.close()
+
+    store = RecordStore(base)
+    assert store.read(USER, 7) == (True, {"version": 49, "padding": "x" * 100})
+    assert not store.exists(USER, 0)
+    store.close()
+
+
+def test_index_grows(base):
+    store = RecordStore(base)
+    capacity = store.capacity
+    for chat_id in range(capacity):
+        store.write(USER, chat_id, chat_id)
+    assert store.capacity > capacity
+    assert all(store.read(USER, chat_id) == (True, chat_id) for chat_id in range(capacity))
+    store.close()
+
+
+def test_not_an_index(base):
+    with open(base + ".idx", "wb") as target:
+        target.write(b"garbage" * 100)
+    with pytest.raises(TypeError):
+        RecordStore(base)
+
+
+def test_persistence_loads_records_on_demand(base):
+    persistence = LazyPersistence(base, on_flush=True)
+    persistence.user_data[42] = VolunteerSession(reviewed_request="req-1")
+    persistence.update_user_data(42, persistence.user_data[42])
+    persistence.bot_data["req-1"] = HelpRequest("req-1", "str. 31 August", ["pâine"], [42])
+    persistence.update_bot_data(persistence.bot_data)
+    # nothing is written before the flush
+    assert not persistence.store.exists(USER, 42)
+    persistence.flush()
+    persistence.store.close()
+
+    persistence = LazyPersistence(base)
+    user_data, bot_data = persistence.get_user_data(), persistence.get_bot_data()
+    assert list(user_data) == []
+    assert 42 in user_data and "req-1" in bot_data
+    assert user_data[42] == VolunteerSession(reviewed_request="req-1")
+    assert bot_data["req-1"].volunteers.tolist() == [42]
+    # a new volunteer gets the default, an unknown request does not exist
+    assert user_data[7] == {}
+    with pytest.raises(KeyError):
+        bot_data["req-2"]
+    del bot_data["req-1"]
+    assert "req-1" not in bot_data
+    assert user_data.stored_keys() == {7, 42}
+    persistence.store.close()
+
+
+def test_threads_share_the_record_they_load(base):
+    store = RecordStore(base)
+    store.write(USER, 42, {"state": 1})
+    store.close()
+
+    persistence = LazyPersistence(base)
+    user_data = persistence.get_user_data()
+
+    def slow_convert(value):
+        # widens the window in which the other threads ask for the same record
+        time.sleep(0.01)
+        return value
+
+    user_data.convert = slow_convert
+    barrier = Barrier(8)
+    loaded = []
+
+    def touch():
+        barrier.wait()
+        loaded.append(user_data[42])
+
+    threads = [Thread(target=touch) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loaded) == 8
+    assert all(session is user_data[42] for session in loaded)
+    persistence.store.close()
+
+
+def test_import_from_pickle(base, tmp_path):
+    path = str(tmp_path / "state.bin")
+    with open(path, "wb") as target:
+        pickle.dump({"user_data": {1: {"a": 1}, 2: {"b": 2}}, "bot_data": {"req": "x"}}, target)
+    persistence = LazyPersistence.from_pickle(path, base)
+    persistence.store.close()
+
+    persistence = LazyPersistence(base)
+    assert persistence.user_data[2] == {"b": 2}
+    assert persistence.bot_data["req"] == "x"
+    persistence.store.close()
@@ -0,0 +1,142 @@
+"""Validation and serialization of the models, see `models.py`"""
+
+import pickle
+
+import pytest
+
+import constants as c
+from models import SERIAL_VERSION, HelpRequest, VolunteerSession, validate_fields
+
+PAYLOAD = {
+    "request_id": "fe91e4b6-e902-4d03-8500-d058673cb9bd",
+    "beneficiary": "Martina Cojocaru",
+    "address": "str. 31 August",
+    "needs": ["Medicamente", "Produse alimentare"],
+    "gotSymptoms": False,
+    "hasDisabilities": True,
+    "safetyCode": "Izvor-45",
+    "phoneNumber": "+373 777 77 777",
+    "remarks": ["Nu lucreaza ascensorul"],
+    "volunteers": [11, 12],
+    "latitude": 47.0255165,
+    "longitude": 28,
+}
+
+
+def test_payload_is_accepted():
+    request = HelpRequest.from_payload(PAYLOAD)
+    assert request.has_disabilities is True
+    assert request.volunteers.tolist() == [11, 12]
+    assert request.to_dict()["needs"] == PAYLOAD["needs"]
+
+
+def test_optional_fields_may_be_missing_or_null():
+    payload = {key: PAYLOAD[key] for key in ("request_id", "address", "needs", "volunteers")}
+    payload["remarks"] = None
+    request = HelpRequest.from_payload(payload)
+    assert request.remarks == ()
+    assert request.latitude is None
+
+
+@pytest.mark.parametrize("key", ["request_id", "address", "needs", "volunteers"])
+def test_mandatory_fields(key):
+    payload = dict(PAYLOAD)
+    del payload[key]
+    with pytest.raises(ValueError, match=key):
+        HelpRequest.from_payload(payload)
+
+
+@pytest.mark.parametrize(
+    "key, value",
+    [
+        ("request_id", 42),
+        ("needs", "Medicamente"),
+        ("volunteers", [11, "12"]),
+        ("volunteers", 11),
+        ("needs", ["pâine", 3]),
+        ("gotSymptoms", "no"),
+        ("latitude", True),
+        ("latitude", "47.02"),
+    ],
+)
+def test_unexpected_types(key, value):
+    with pytest.raises(ValueError):
+        HelpRequest.from_payload(dict(PAYLOAD, **{key: value}))
+
+
+def test_not_an_object():
+    with pytest.raises(ValueError):
+        HelpRequest.from_payload([PAYLOAD])
+
+
+def test_small_payloads():
+    data = {"request_id": "r", "volunteer": 11}
+    assert validate_fields(data, {"request_id": str, "volunteer": int}) is data
+    for bad in ({"request_id": "r"}, {"request_id": "r", "volunteer": True}, "r"):
+        with pytest.raises(ValueError):
+            validate_fields(bad, {"request_id": str, "volunteer": int})
+
+
+def test_request_is_pickled_as_a_versioned_tuple():
+    request = HelpRequest.from_payload(PAYLOAD)
+    request.amount = 120
+    state = request.__getstate__()
+    assert state[0] == SERIAL_VERSION
+    assert len(state) == 1 + len(HelpRequest.__slots__)
+    copy = pickle.loads(pickle.dumps(request))
+    assert copy == request
+    assert copy.amount == 120
+
+
+def test_session_is_pickled_as_a_versioned_tuple():
+    session = VolunteerSession(c.State.REQUEST_SENT, reviewed_request="r")
+    state = session.__getstate__()
+    assert state[0] == SERIAL_VERSION
+    copy = pickle.loads(pickle.dumps(session))
+    assert copy == session
+    assert copy.state == c.State.REQUEST_SENT
+
+
+def test_older_pickles_get_the_defaults_of_the_newer_fields():
+    request = HelpRequest.from_payload(PAYLOAD)
+    # as if the request had been pickled before the details collected from the volunteer were added
+    older = request.__getstate__()[: 1 + len(HelpRequest.FIELDS)]
+    copy = HelpRequest.__new__(HelpRequest)
+    copy.__setstate__(older)
+    assert copy.volunteers.tolist() == [11, 12]
+    assert copy.amount is None and copy.symptoms == [] and copy.further_comments == ""
+
+    session = VolunteerSession.__new__(VolunteerSession)
+    session.__setstate__((SERIAL_VERSION, c.State.AVAILABLE.value, "r"))
+    assert session.state == c.State.AVAILABLE and session.reviewed_request == "r"
+    assert session.current_request is None and session.assist_keyboard is None
+
+
+def test_newer_pickles_are_refused():
+    state = (SERIAL_VERSION + 1,) + HelpRequest.from_payload(PAYLOAD).__getstate__()[1:]
+    with pytest.raises(ValueError, match="newer"):
+        HelpRequest.__new__(HelpRequest).__setstate__(state)
+    with pytest.raises(ValueError, match="newer"):
+        VolunteerSession.__new__(VolunteerSession).__setstate__((SERIAL_VERSION + 1, 1))
+
+
+def test_old_dicts_are_converted():
+    request = HelpRequest.coerce(dict(PAYLOAD, amount=50))
+    assert isinstance(request, HelpRequest) and request.amount == 50
+    session = VolunteerSession.coerce({"state": c.State.AVAILABLE, "current_request": "r"})
+    assert session.state == c.State.AVAILABLE and session.current_request == "r"
+    # whatever is not an old record is left alone
+    assert HelpRequest.coerce("token") == "token"
+    assert VolunteerSession.coerce(session) is session
+
+
+def test_session_without_state():
+    session = VolunteerSession()
+    assert session.state is None
+    session.state = c.State.AVAILABLE
+    session.release()
+    assert session.to_dict() == {
+        "state": c.State.AVAILABLE,
+        "reviewed_request": None,
+        "current_request": None,
+    }
@@ -0,0 +1,189 @@
+"""The REST API the backend talks to, see `restapi.py`"""
+
+import io
+import json
+import logging
+import os
+
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+import restapi
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_api(**kwargs):
+    return restapi.BotRestApi(None, None, None, None, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def in_repository(monkeypatch):
+    # the API reads its form from `res/static`
+    monkeypatch.chdir(ROOT)
+
+
+def call(api, method, path, body=None, remote_addr="127.0.0.1", headers=None):
+    client = Client(api, BaseResponse)
+    return client.open(
+        path,
+        method=method,
+        data=None if body is None else json.dumps(body),
+        environ_base={"REMOTE_ADDR": remote_addr},
+        headers=headers,
+    )
+
+
+@pytest.fixture
+def restore_levels():
+    yield
+    logging.getLogger("restapi-test").setLevel(logging.NOTSET)
+
+
+@pytest.mark.usefixtures("restore_levels")
+@pytest.mark.parametrize("remote_addr", ["127.0.0.1", "::1", "::ffff:127.0.0.1"])
+def test_log_levels_can_be_changed_locally(remote_addr):
+    api = make_api()
+    body = {"logger": "restapi-test", "level": "WARNING"}
+    response = call(api, "POST", "/loglevel", body, remote_addr)
+    assert response.status_code == 200
+    assert json.loads(response.data)["restapi-test"] == "WARNING"
+
+
+@pytest.mark.usefixtures("restore_levels")
+def test_log_levels_need_the_token_from_elsewhere():
+    api = make_api(admin_token="s3cret")
+    body = {"logger": "restapi-test", "level": "ERROR"}
+    assert call(api, "POST", "/loglevel", body, "10.0.0.7").status_code == 403
+    wrong = {"Authorization": "Bearer guess"}
+    assert call(api, "POST", "/loglevel", body, "10.0.0.7", wrong).status_code == 403
+    right = {"Authorization": "Bearer s3cret"}
+    assert call(api, "POST", "/loglevel", body, "10.0.0.7", right).status_code == 200
+    # anyone may look
+    assert call(api, "GET", "/loglevel", remote_addr="10.0.0.7").status_code == 200
+    # without a token, nobody else may change them
+    assert call(make_api(), "POST", "/loglevel", body, "10.0.0.7", right).status_code == 403
+
+
+def test_only_an_admin_takes_memory_snapshots(monkeypatch):
+    taken = []
+    monkeypatch.setattr(restapi.memory.SNAPSHOTS, "take", lambda frames: taken.append(frames) or {})
+    monkeypatch.setattr(restapi.memory.SNAPSHOTS, "clear", lambda: taken.append("clear"))
+    api = make_api(admin_token="s3cret")
+    assert call(api, "POST", "/memory/snapshots", {}, "10.0.0.7").status_code == 403
+    assert call(api, "DELETE", "/memory/snapshots", remote_addr="10.0.0.7").status_code == 403
+    assert taken == []
+    assert call(api, "GET", "/memory/snapshots", remote_addr="10.0.0.7").status_code == 200
+
+    right = {"Authorization": "Bearer s3cret"}
+    assert (
+        call(api, "POST", "/memory/snapshots", {"frames": 3}, "10.0.0.7", right).status_code == 200
+    )
+    assert call(api, "DELETE", "/memory/snapshots").status_code == 200
+    assert taken == [3, "clear"]
+
+
+def help_request(request_id):
+    return {"request_id": request_id, "address": "str. 31 August", "needs": [], "volunteers": [11]}
+
+
+def test_a_request_is_handed_over_as_a_job():
+    handled = []
+    api = restapi.BotRestApi(lambda payload, job: handled.append((payload, job)), None, None, None)
+    response = call(api, "POST", "/help_request", help_request("req-1"))
+    assert response.status_code == 200
+    job_id = json.loads(response.data)["job"]
+    ((payload, job),) = handled
+    assert payload.request_id == "req-1" and job.job_id == job_id
+    status = json.loads(call(api, "GET", "/jobs/%s" % job_id).data)
+    assert status["status"] == "pending" and status["request_id"] == "req-1"
+    assert call(api, "GET", "/jobs/unknown").status_code == 404
+
+
+def test_malformed_requests_are_refused():
+    api = restapi.BotRestApi(lambda payload, job: None, None, None, None)
+    assert call(api, "POST", "/help_request", {"request_id": "req-1"}).status_code == 400
+    assert call(api, "POST", "/assign_help_request", {"request_id": "req-1"}).status_code == 400
+    assert api.jobs.pending() == {}
+
+
+def test_too_many_jobs_of_a_kind():
+    api = restapi.BotRestApi(
+        lambda payload, job: None, None, None, None, limits={"help_request": 1}, overall_limit=10
+    )
+    assert call(api, "POST", "/help_request", help_request("req-1")).status_code == 200
+    response = call(api, "POST", "/help_request", help_request("req-2"))
+    assert response.status_code == 429
+    # nothing finished yet, so the estimate is the shortest one
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_retry_after_follows_the_duration_of_the_jobs():
+    api = make_api(limits={"help_request": 1})
+    job = api.jobs.create("help_request")
+    with job:
+        job.started -= 7.5
+    assert api.retry_after("help_request") == 8
+    job = api.jobs.create("help_request")
+    with job:
+        job.started -= 10 * restapi.MAX_RETRY_AFTER
+    assert api.retry_after("help_request") == restapi.MAX_RETRY_AFTER
+
+
+def test_too_much_work_altogether():
+    api = restapi.BotRestApi(
+        lambda payload, job: None,
+        lambda payload, job: None,
+        None,
+        None,
+        limits={"help_request": 5, "cancel_help_request": 5},
+        overall_limit=2,
+    )
+    assert call(api, "POST", "/help_request", help_request("req-1")).status_code == 200
+    cancel = {"request_id": "req-1", "volunteer": 11}
+    assert call(api, "POST", "/cancel_help_request", cancel).status_code == 200
+    response = call(api, "POST", "/help_request", help_request("req-2"))
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_a_job_that_cannot_be_handed_over_gives_its_slot_back():
+    def refuse(payload, job):
+        raise RuntimeError("stopping")
+
+    api = restapi.BotRestApi(refuse, None, None, None, limits={"help_request": 1})
+    assert call(api, "POST", "/help_request", help_request("req-1")).status_code == 503
+    assert api.jobs.pending() == {}
+    assert api.jobs.recent()[0]["status"] == "failed"
+
+
+def test_ready():
+    api = make_api(limits={"help_request": 5}, overall_limit=100)
+    assert call(api, "GET", "/ready").status_code == 200
+    for _ in range(4):
+        api.jobs.create("help_request")
+    response = call(api, "GET", "/ready")
+    assert response.status_code == 503
+    assert json.loads(response.data)["saturated"] == ["help_request"]
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_large_bodies_are_refused():
+    api = make_api(max_body=100)
+    body = help_request("x" * 200)
+    assert call(api, "POST", "/help_request", body).status_code == 413
+
+
+def test_body_without_a_length_is_bounded():
+    body = b"x" * 150
+    environ = {"wsgi.input": io.BytesIO(body), "wsgi.input_terminated": True}
+    with pytest.raises(RequestEntityTooLarge):
+        restapi.read_body(environ, 100)
+
+    environ = {"wsgi.input": io.BytesIO(body), "wsgi.input_terminated": True}
+    assert restapi.read_body(environ, 200) == body
+    assert environ["CONTENT_LENGTH"] == "150"
+    assert "wsgi.input_terminated" not in environ
+    assert environ["wsgi.input"].read() == body
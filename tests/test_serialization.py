@@ -0,0 +1,90 @@
+"""The pluggable JSON and the files packed for the bot itself, see `serialization.py`"""
+
+import base64
+import pickle
+
+import pytest
+
+import serialization
+
+PAYLOAD = {
+    "request_id": "req-1",
+    "needs": ["pâine", "Medicamente"],
+    "volunteers": [11, 12],
+    "ok": True,
+}
+
+
+@pytest.fixture(params=list(serialization.BACKENDS))
+def backend(request):
+    previous = serialization.BACKEND
+    serialization.use(request.param)
+    yield request.param
+    serialization.use(previous)
+
+
+@pytest.fixture
+def no_msgpack(monkeypatch):
+    monkeypatch.setattr(serialization, "msgpack", None)
+
+
+def test_round_trip(backend):
+    raw = serialization.dumps(PAYLOAD)
+    assert isinstance(raw, bytes)
+    for data in (raw, bytearray(raw), memoryview(raw), raw.decode()):
+        assert serialization.loads(data) == PAYLOAD
+
+
+def test_invalid_json(backend):
+    with pytest.raises(ValueError):
+        serialization.loads(b'{"request_id": ')
+
+
+def test_numeric_keys_become_strings(backend):
+    # like the standard library does, which is what the backend and the files expect
+    assert serialization.loads(serialization.dumps({11: "a"})) == {"11": "a"}
+
+
+def test_unknown_backend():
+    with pytest.raises(KeyError):
+        serialization.use("simdjson")
+
+
+@pytest.mark.parametrize("payload", [{"request_id": "req-1"}, {}])
+def test_embed(backend, payload):
+    data = bytes(range(256))
+    document = serialization.loads(serialization.embed(payload, "receipt", data))
+    assert base64.b64decode(document.pop("receipt")) == data
+    assert document == payload
+
+
+@pytest.mark.usefixtures("no_msgpack")
+def test_pack_round_trip(backend):
+    state = {"pending": [["req-1", "ab12"]], "uploaded": {"req-2": ["cd34"]}}
+    assert serialization.unpack(serialization.pack(state)) == state
+
+
+@pytest.mark.usefixtures("no_msgpack")
+def test_pack_keeps_numeric_keys_only_in_a_pickle(backend):
+    packed = serialization.pack({11: "a"})
+    if backend == "orjson":
+        # orjson is quicker than a pickle, but it turns the keys into strings, like any JSON
+        assert serialization.unpack(packed) == {"11": "a"}
+    else:
+        assert packed[:1] == b"\x80"
+        assert serialization.unpack(packed) == {11: "a"}
+
+
+@pytest.mark.usefixtures("no_msgpack")
+def test_unpack_reads_every_encoding(backend):
+    state = {"pending": [], "uploaded": {}}
+    assert serialization.unpack(pickle.dumps(state)) == state
+    assert serialization.unpack(b'{"pending":[],"uploaded":{}}') == state
+
+
+@pytest.mark.usefixtures("no_msgpack")
+def test_unpack_damaged_data():
+    with pytest.raises(ValueError):
+        serialization.unpack(pickle.dumps({"pending": []})[:-3])
+    with pytest.raises(ValueError, match="msgpack"):
+        serialization.unpack(serialization.MSGPACK_MARKER + b"\x80")
@@ -0,0 +1,111 @@
+"""The spool of receipts waiting to be uploaded, see `spool.py`"""
+
+import os
+
+import pytest
+
+from spool import BINARY_INDEX_NAME, INDEX_NAME, ReceiptSpool
+
+
+class Backend:
+    """Collects the uploads, failing the ones of the requests it is told to"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.uploads = []
+
+    def upload(self, data, request_id):
+        if request_id in self.failing:
+            raise ConnectionError("backend is down")
+        self.uploads.append((request_id, data))
+
+
+@pytest.fixture
+def root(tmp_path):
+    return str(tmp_path / "receipts")
+
+
+def test_same_photo_is_stored_and_uploaded_once(root):
+    spool = ReceiptSpool(root)
+    digest, is_new = spool.add("req-1", b"photo")
+    assert is_new
+    assert spool.add("req-1", b"photo") == (digest, False)
+    # another request may get the same photo, it is stored only once
+    assert spool.add("req-2", b"photo") == (digest, True)
+    assert spool.size == len(b"photo")
+
+    backend = Backend()
+    assert spool.drain(backend.upload) == 2
+    assert spool.read(digest) == b"photo"
+    # already uploaded for this request
+    assert spool.add("req-1", b"photo") == (digest, False)
+    assert spool.stats()["pending"] == 0
+
+
+def test_failed_uploads_stay_pending(root):
+    spool = ReceiptSpool(root)
+    spool.add("req-1", b"first")
+    spool.add("req-2", b"second")
+    backend = Backend(failing={"req-1"})
+    # the drain stops at the first failure
+    assert spool.drain(backend.upload) == 0
+    assert spool.stats()["pending"] == 2
+    backend.failing.clear()
+    assert spool.drain(backend.upload, workers=2) == 2
+    assert sorted(backend.uploads) == [("req-1", b"first"), ("req-2", b"second")]
+
+
+def test_drain_only_the_given_receipts(root):
+    spool = ReceiptSpool(root)
+    old, _ = spool.add("req-1", b"old")
+    mine, _ = spool.add("req-2", b"mine")
+    backend = Backend()
+    assert spool.drain(backend.upload, digests={mine}) == 1
+    assert backend.uploads == [("req-2", b"mine")]
+    assert spool.pending == [["req-1", old]]
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_uploads_resume_after_a_reopen(root, binary):
+    spool = ReceiptSpool(root, binary=binary)
+    spool.add("req-1", b"first")
+    spool.add("req-1", b"second")
+    spool.drain(Backend(failing={"req-1"}).upload)
+
+    spool = ReceiptSpool(root, binary=binary)
+    assert spool.stats()["pending"] == 2
+    backend = Backend()
+    assert spool.drain(backend.upload) == 2
+    assert backend.uploads == [("req-1", b"first"), ("req-1", b"second")]
+
+    spool = ReceiptSpool(root, binary=binary)
+    assert spool.stats()["pending"] == 0
+    # the uploaded receipts are remembered until the request is forgotten
+    assert not spool.add("req-1", b"first")[1]
+    spool.forget("req-1")
+    assert spool.add("req-1", b"first")[1]
+
+
+def test_the_queue_changes_format(root):
+    spool = ReceiptSpool(root)
+    spool.add("req-1", b"photo")
+    spool = ReceiptSpool(root, binary=True)
+    assert spool.stats()["pending"] == 1
+    assert os.path.exists(os.path.join(root, BINARY_INDEX_NAME))
+    assert not os.path.exists(os.path.join(root, INDEX_NAME))
+
+
+def test_least_recently_used_uploaded_photos_are_evicted(root):
+    spool = ReceiptSpool(root, quota=2500)
+    digests = []
+    for index in range(3):
+        digest, _ = spool.add("req-1", bytes([index]) * 1000)
+        digests.append(digest)
+        # the modification times decide the order of eviction
+        os.utime(spool._path(digest), (index, index))
+    # nothing was uploaded yet, so nothing can be evicted
+    assert spool.size == 3000
+    spool.drain(Backend().upload)
+    assert spool.size == 2000
+    assert not os.path.exists(spool._path(digests[0]))
+    assert all(os.path.exists(spool._path(digest)) for digest in digests[1:])
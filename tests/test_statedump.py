@@ -0,0 +1,137 @@
+"""Export of the state to JSON lines and import back, see `statedump.py`"""
+
+import json
+import pickle
+
+import pytest
+from telegram import InlineKeyboardButton
+
+import constants as c
+import statedump
+from announcements import AnnouncementLog
+from lazypersistence import BOT
+from models import HelpRequest, VolunteerSession
+
+
+def make_state():
+    session = VolunteerSession(c.State.EXPECTING_EXIT_SURVEY, current_request="req-1")
+    session.symptom_keyboard = [[InlineKeyboardButton("Febră", callback_data="fever")]]
+    request = HelpRequest("req-1", "str. 31 August", ["pâine"], [11, 12], amount=120)
+    request.symptoms = ["fever"]
+    announcements = AnnouncementLog()
+    announcements.record("req-1", 11, 100)
+    announcements.record("req-1", 12, 200)
+    announcements.withdraw("req-1")
+    announcements.record_digest(["req-2", "req-3"], 11, 300)
+    return {
+        "user_data": {11: session, 12: VolunteerSession()},
+        "bot_data": {
+            "req-1": request,
+            "announcements": announcements,
+            # registrations in progress, keyed by chat_id
+            "registrations": {1001: {"first_name": "Ana"}},
+            "counters": {"announced": [1, 2]},
+        },
+    }
+
+
+@pytest.fixture
+def state_bin(tmp_path):
+    path = str(tmp_path / "state.bin")
+    with open(path, "wb") as target:
+        pickle.dump(make_state(), target)
+    return path
+
+
+def export(source, tmp_path, *options):
+    output = str(tmp_path / "state.ndjson")
+    assert statedump.main(["export", source, "-o", output, *options]) == 0
+    return output
+
+
+def load(path):
+    return {(kind, key): value for kind, key, value in statedump.read_pickle(path)}
+
+
+def assert_same_state(imported, original):
+    assert imported.keys() == original.keys()
+    for key, value in original.items():
+        if isinstance(value, AnnouncementLog):
+            assert imported[key].to_dict() == value.to_dict()
+        else:
+            assert imported[key] == value
+
+
+def test_round_trip_through_a_pickle(state_bin, tmp_path):
+    output = export(state_bin, tmp_path)
+    target = str(tmp_path / "new.bin")
+    assert statedump.main(["import", output, target]) == 0
+    imported = load(target)
+    assert_same_state(imported, load(state_bin))
+    # the keys that JSON would have turned into strings are kept
+    assert list(imported[BOT, "registrations"]) == [1001]
+    assert imported[BOT, "req-1"].volunteers.tolist() == [11, 12]
+
+
+def test_round_trip_through_a_lazy_state(state_bin, tmp_path):
+    output = export(state_bin, tmp_path)
+    target = str(tmp_path / "lazy")
+    assert statedump.main(["import", output, target, "--lazy"]) == 0
+    # and back out of the lazy state
+    again = str(tmp_path / "again.ndjson")
+    assert statedump.main(["export", target, "-o", again]) == 0
+    with open(output) as first, open(again) as second:
+        assert sorted(first) == sorted(second)
+
+
+def test_everything_is_json(state_bin, tmp_path):
+    with open(export(state_bin, tmp_path)) as source:
+        records = [json.loads(line) for line in source]
+    assert not any("pickle" in record for record in records)
+    entries = {record["key"]: record for record in records if record["kind"] == "entry"}
+    assert entries["announcements"]["announcements"]["withdrawn"] == ["req-1"]
+    assert entries["registrations"]["items"] == [[1001, {"first_name": "Ana"}]]
+    assert entries["counters"]["value"] == {"announced": [1, 2]}
+
+
+def test_pickles_are_only_imported_when_trusted(tmp_path):
+    path = str(tmp_path / "state.bin")
+    with open(path, "wb") as target:
+        pickle.dump({"user_data": {}, "bot_data": {"seen": {11, 12}}}, target)
+    output = export(path, tmp_path)
+
+    target = str(tmp_path / "refused.bin")
+    assert statedump.main(["import", output, target]) == 1
+    assert load(target) == {}
+
+    target = str(tmp_path / "trusted.bin")
+    assert statedump.main(["import", output, target, "--trust-pickles"]) == 0
+    assert load(target) == {(BOT, "seen"): {11, 12}}
+
+
+@pytest.mark.parametrize(
+    "record, message",
+    [
+        ({"kind": "volunteer", "chat_id": "11"}, "chat_id"),
+        ({"kind": "volunteer", "chat_id": 11, "state": "ASLEEP"}, "ASLEEP"),
+        ({"kind": "request", "request_id": "req-1", "needs": [], "volunteers": []}, "address"),
+        ({"kind": "entry", "key": "announcements", "announcements": {"sent": []}}, "sent"),
+        ({"kind": "entry", "key": "registrations", "items": [[1001]]}, "items"),
+        ({"kind": "entry", "key": "seen", "pickle": "gASVAAAA"}, "trust-pickles"),
+        ({"kind": "ghost"}, "ghost"),
+        ([], "object"),
+    ],
+)
+def test_invalid_records(record, message):
+    with pytest.raises(ValueError, match=message):
+        statedump.decode(record)
+
+
+def test_selection(state_bin, tmp_path):
+    output = export(state_bin, tmp_path, "--request", "req-1")
+    with open(output) as source:
+        records = [json.loads(line) for line in source]
+    assert [(record["kind"], record.get("chat_id")) for record in records] == [
+        ("volunteer", 11),
+        ("request", None),
+    ]
@@ -0,0 +1,95 @@
+"""The transition table of the conversation with a volunteer, see `statemachine.py`"""
+
+import pytest
+
+import constants as c
+from models import VolunteerSession
+from statemachine import ANY, OPEN, RULES, TRANSITIONS, StateMachine
+
+S = c.State
+
+
+@pytest.mark.parametrize(
+    "state, event, target",
+    [
+        (None, "start", S.EXPECTING_PHONE_NUMBER),
+        (S.EXPECTING_PHONE_NUMBER, "registered", S.AVAILABLE),
+        (S.AVAILABLE, "announce", S.REQUEST_SENT),
+        (S.REQUEST_SENT, "offer", S.REQUEST_TIME_NEGOTIATION),
+        (S.REQUEST_SENT, "decline", S.AVAILABLE),
+        (S.REQUEST_TIME_NEGOTIATION, "assign", S.REQUEST_ASSIGNED),
+        (S.REQUEST_ASSIGNED, "set_off", S.REQUEST_IN_PROGRESS),
+        (S.REQUEST_IN_PROGRESS, "done", S.EXPECTING_AMOUNT),
+        (S.EXPECTING_AMOUNT, "amount", S.EXPECTING_RECEIPT),
+        (S.EXPECTING_RECEIPT, "receipt", S.EXPECTING_EXIT_SURVEY),
+        (S.EXPECTING_EXIT_SURVEY, "rated", S.EXPECTING_FURTHER_COMMENTS),
+        (S.EXPECTING_FURTHER_COMMENTS, "finish", S.REQUEST_COMPLETED),
+        (S.REQUEST_IN_PROGRESS, "release", S.AVAILABLE),
+    ],
+)
+def test_allowed(state, event, target):
+    machine = StateMachine()
+    session = VolunteerSession(state)
+    assert machine.fire(11, session, event)
+    assert session.state == target
+
+
+@pytest.mark.parametrize(
+    "state, event",
+    [
+        (S.AVAILABLE, "done"),
+        (S.REQUEST_ASSIGNED, "announce"),
+        (S.REQUEST_IN_PROGRESS, "offer"),
+        (S.EXPECTING_AMOUNT, "receipt"),
+        (S.AVAILABLE, "finish"),
+        (S.AVAILABLE, "no_such_event"),
+    ],
+)
+def test_illegal(state, event):
+    refused = []
+    machine = StateMachine(on_illegal=lambda *args: refused.append(args))
+    session = VolunteerSession(state)
+    assert not machine.fire(11, session, event)
+    assert session.state == state
+    assert refused == [(11, state, event)]
+    assert machine.stats()["illegal"] == {"%s:%s" % (state.name, event): 1}
+
+
+def test_busy_volunteers_get_no_announcements():
+    machine = StateMachine()
+    for state in [None] + list(S):
+        assert machine.allows(state, "announce") == (state in OPEN)
+
+
+def test_every_rule_is_in_the_table():
+    for event, states, target in RULES:
+        for state in (ANY,) if states == ANY else states:
+            assert TRANSITIONS[state, event] == target
+
+
+def test_transitions_are_reported():
+    moves = []
+    machine = StateMachine(on_transition=lambda *args: moves.append(args))
+    session = VolunteerSession(S.AVAILABLE)
+    machine.fire(11, session, "announce")
+    machine.fire(11, session, "decline")
+    assert moves == [(11, "announce", S.REQUEST_SENT), (11, "decline", S.AVAILABLE)]
+    stats = machine.stats()["transitions"]
+    assert stats["AVAILABLE->REQUEST_SENT"]["count"] == 1
+    # the time spent in REQUEST_SENT is known, the time spent in AVAILABLE before the first transition is not
+    assert stats["REQUEST_SENT->AVAILABLE"]["p50_ms"] is not None
+    assert sum(machine.time_in_state(11)["REQUEST_SENT"].values()) == 1
+
+
+def test_inputs_are_dispatched_by_state():
+    handled = []
+    machine = StateMachine()
+    machine.on(S.EXPECTING_AMOUNT, "text", lambda update, context: handled.append(update))
+
+    class Context:
+        user_data = VolunteerSession(S.EXPECTING_AMOUNT)
+
+    assert machine.handle("text", "120 lei", Context)
+    assert not machine.handle("photo", "receipt.jpg", Context)
+    assert handled == ["120 lei"]
+    assert machine.stats()["illegal"] == {"EXPECTING_AMOUNT:photo": 1}
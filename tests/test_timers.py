@@ -0,0 +1,105 @@
+"""The timing wheel and the persistent deadlines, see `timers.py`"""
+
+import random
+
+from timers import LEVELS, SLOTS, Deadlines, TimerWheel
+
+
+def test_deadlines_never_fire_early():
+    wheel = TimerWheel(resolution=1.0, now=0)
+    rng = random.Random(47)
+    # spread over the first three levels, with fractions of a tick
+    deadlines = {key: rng.uniform(0, 3 * SLOTS * SLOTS) for key in range(2000)}
+    for key, when in deadlines.items():
+        wheel.schedule(key, when, payload=-key)
+
+    fired = {}
+    now = 0.0
+    while now < 3 * SLOTS * SLOTS + 2:
+        now += rng.uniform(0.1, 700)
+        for key, payload in wheel.advance(now):
+            assert payload == -key
+            assert key not in fired
+            fired[key] = now
+    assert len(wheel) == 0
+    assert fired.keys() == deadlines.keys()
+    for key, when in deadlines.items():
+        # never early, and by the first advance that is at least one tick past it
+        assert when <= fired[key] < when + 700 + 1
+
+
+def test_cascading_keeps_the_exact_tick():
+    wheel = TimerWheel(resolution=1.0, now=0)
+    # around the boundaries of the levels, where a deadline is moved down
+    whens = (SLOTS - 1, SLOTS, SLOTS + 1, SLOTS * SLOTS - 1, SLOTS * SLOTS, SLOTS * SLOTS + 3)
+    for when in whens:
+        wheel.schedule(when, when)
+    fired = []
+    for now in range(1, SLOTS * SLOTS + 5):
+        fired.extend((key, now) for key, _ in wheel.advance(now))
+    # each one fires at its own tick, not at the start of the slot it was in
+    assert fired == [(when, when) for when in whens]
+
+
+def test_deadlines_go_into_the_lowest_level_that_holds_them():
+    wheel = TimerWheel(resolution=1.0, now=0)
+    wheel.schedule("soon", 10)
+    wheel.schedule("later", SLOTS * 2)
+    wheel.schedule("much later", SLOTS ** (LEVELS - 1) * 2)
+    assert wheel.entries["soon"][0] == 0
+    assert wheel.entries["later"][0] == 1
+    assert wheel.entries["much later"][0] == LEVELS - 1
+    assert wheel.due("much later") == SLOTS ** (LEVELS - 1) * 2
+    assert sorted(key for key, _, _ in wheel.items()) == ["later", "much later", "soon"]
+
+
+def test_reschedule_and_cancel():
+    wheel = TimerWheel(resolution=0.5, now=100)
+    wheel.schedule("a", 200, "first")
+    wheel.schedule("a", 101, "second")
+    assert len(wheel) == 1 and wheel.due("a") == 101
+    # deadlines in the past expire with the next tick
+    wheel.schedule("b", 50)
+    assert wheel.advance(100.5) == [("b", None)]
+    assert wheel.advance(101) == [("a", "second")]
+    wheel.schedule("c", 300)
+    assert wheel.cancel("c")
+    assert not wheel.cancel("c")
+    assert wheel.advance(400) == []
+
+
+def test_handlers_get_their_kind_of_deadline(tmp_path):
+    deadlines = Deadlines(str(tmp_path / "timers.bin"))
+    fired = []
+    deadlines.register("volunteer", lambda key, payload: fired.append((key, payload)))
+    deadlines.register("broken", lambda key, payload: 1 / 0)
+    deadlines.schedule(("volunteer", 11), 0, ("answer", "remind"))
+    deadlines.schedule(("broken",), 0)
+    deadlines.schedule(("unknown",), 0)
+    deadlines.fire(deadlines.wheel.current * deadlines.wheel.resolution + 10)
+    # a failing handler or a missing one does not stop the others
+    assert fired == [(("volunteer", 11), ("answer", "remind"))]
+    assert deadlines.stats()["fired"] == 2
+
+
+def test_deadlines_survive_a_restart(tmp_path):
+    path = str(tmp_path / "timers.bin")
+    deadlines = Deadlines(path)
+    deadlines.schedule(("volunteer", 11), 3600, ("answer", "remind"))
+    deadlines.schedule(("volunteer", 12), 0.5, ("survey", "expire"))
+    deadlines.schedule(("volunteer", 13), 60)
+    deadlines.cancel(("volunteer", 13))
+    deadlines.start()
+    deadlines.stop()
+
+    restarted = Deadlines(path)
+    assert sorted(key for key, _, _ in restarted.wheel.items()) == [
+        ("volunteer", 11),
+        ("volunteer", 12),
+    ]
+    fired = []
+    restarted.register("volunteer", lambda key, payload: fired.append(payload))
+    # the one that expired while the bot was down fires right away
+    restarted.fire(restarted.wheel.current * restarted.wheel.resolution + 2)
+    assert fired == [("survey", "expire")]
+    assert ("volunteer", 11) in restarted
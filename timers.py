@@ -0,0 +1,247 @@
+"""Deadlines, e.g. how long a volunteer has to answer an announcement before they are released. There can be one
+per volunteer and per request, hundreds of thousands in total, and most of them are cancelled long before they
+expire, because the volunteer answered in time; scheduling and cancelling must be cheap, regardless of how many are
+pending.
+
+`TimerWheel` is a hierarchical timing wheel: level 0 has one slot per tick (`resolution` seconds), each level above
+has slots that are `SLOTS` times longer. A deadline goes into the lowest level that can hold it, and moves down
+one level at a time as its time approaches. Scheduling and cancelling are O(1), and each tick only looks at one
+slot of level 0, plus, once in a while, one slot of a higher level that is spread over the levels below.
+
+`Deadlines` runs a wheel in a background thread, invokes the handler registered for the kind of each deadline that
+expires, and keeps the pending deadlines in a file, so that they survive restarts. The file is rewritten at most
+every `save_interval` seconds, and when the bot stops; the deadlines that expired while the bot was down fire right
+after it starts."""
+
+import logging
+import math
+import os
+import pickle
+import time
+from collections import Counter
+from threading import Event, Lock, Thread
+
+log = logging.getLogger("timers")  # pylint: disable=invalid-name
+
+# Slots per level, a power of two; with 1-second ticks, the levels cover 4 minutes, 18 hours, 194 days, 136 years
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+LEVELS = 4
+# Seconds per tick
+DEFAULT_RESOLUTION = 1.0
+# Seconds between two writes of the pending deadlines
+DEFAULT_SAVE_INTERVAL = 5.0
+
+
+class TimerWheel:
+    """A hierarchical timing wheel, not thread-safe. Each deadline has a key, e.g. `("answer", chat_id)`; scheduling
+    a key that is already pending replaces its deadline"""
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION, now=None):
+        """Initialize the wheel
+        :param resolution: float, seconds per tick; deadlines fire up to one tick late, never early
+        :param now: optional float, the current time, `time.time()` by default"""
+        self.resolution = resolution
+        self.current = self.tick(time.time() if now is None else now)
+        # level -> slot -> {key: (tick, payload)}
+        self.wheels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        # key -> (level, slot), where the key is now
+        self.entries = {}
+
+    def tick(self, when):
+        """Return the tick a moment falls in"""
+        return math.floor(when / self.resolution)
+
+    def schedule(self, key, when, payload=None):
+        """Add a deadline, or move it if the key is already pending
+        :param key: hashable
+        :param when: float, the time it expires, like `time.time()`
+        :param payload: anything, it is returned along with the key when the deadline expires"""
+        self.cancel(key)
+        # a deadline in the past expires with the next tick
+        self._place(key, max(math.ceil(when / self.resolution), self.current + 1), payload)
+
+    def _place(self, key, tick, payload):
+        delta = tick - self.current
+        level = 0
+        while level < LEVELS - 1 and delta >= 1 << (SLOT_BITS * (level + 1)):
+            level += 1
+        slot = (tick >> (SLOT_BITS * level)) & (SLOTS - 1)
+        self.wheels[level][slot][key] = (tick, payload)
+        self.entries[key] = (level, slot)
+
+    def cancel(self, key):
+        """Remove a deadline
+        :returns: bool, False if there was no such deadline"""
+        where = self.entries.pop(key, None)
+        if where is None:
+            return False
+        level, slot = where
+        del self.wheels[level][slot][key]
+        return True
+
+    def due(self, key):
+        """Return the time a deadline expires, or None if it is not pending"""
+        where = self.entries.get(key)
+        if where is None:
+            return None
+        level, slot = where
+        return self.wheels[level][slot][key][0] * self.resolution
+
+    def advance(self, now):
+        """Move the wheel forward to `now`
+        :returns: list of (key, payload) of the deadlines that expired, in order"""
+        target = self.tick(now)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            # at the start of a slot of a higher level, its deadlines are spread over the levels below; the highest
+            # level goes first, because its deadlines may land in a slot of the next level that starts right now
+            level = 1
+            while level < LEVELS and not self.current & ((1 << (SLOT_BITS * level)) - 1):
+                level += 1
+            for upper in range(level - 1, 0, -1):
+                slot = (self.current >> (SLOT_BITS * upper)) & (SLOTS - 1)
+                bucket, self.wheels[upper][slot] = self.wheels[upper][slot], {}
+                for key, (tick, payload) in bucket.items():
+                    self._place(key, tick, payload)
+
+            slot = self.current & (SLOTS - 1)
+            bucket = self.wheels[0][slot]
+            if bucket:
+                self.wheels[0][slot] = {}
+                for key, (_, payload) in bucket.items():
+                    del self.entries[key]
+                    expired.append((key, payload))
+        return expired
+
+    def items(self):
+        """Return (key, time it expires, payload) for each pending deadline"""
+        result = []
+        for key, (level, slot) in self.entries.items():
+            tick, payload = self.wheels[level][slot][key]
+            result.append((key, tick * self.resolution, payload))
+        return result
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+class Deadlines:
+    """A timer wheel with a thread that fires the deadlines and a file that keeps them across restarts. The first
+    element of a key is the deadline's kind, it decides which handler is invoked"""
+
+    def __init__(
+        self, path, resolution=DEFAULT_RESOLUTION, save_interval=DEFAULT_SAVE_INTERVAL,
+    ):
+        """Initialize the deadlines, loading the pending ones from disk
+        :param path: str, the file where the pending deadlines are kept
+        :param resolution: float, seconds per tick
+        :param save_interval: float, seconds between two writes of the file"""
+        self.path = path
+        self.save_interval = save_interval
+        self.wheel = TimerWheel(resolution)
+        self.handlers = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.changed = False
+        self.saved = time.monotonic()
+        self.counts = Counter()
+        self.load()
+
+    def register(self, kind, handler):
+        """Set the function invoked when a deadline of this kind expires
+        :param handler: callable(key, payload), invoked from the timer thread"""
+        self.handlers[kind] = handler
+
+    def schedule(self, key, delay, payload=None):
+        """Add a deadline, or move it if the key is already pending
+        :param key: tuple, (kind, ...), e.g. `("volunteer", chat_id)`
+        :param delay: float, seconds from now
+        :param payload: picklable, passed to the handler"""
+        with self.lock:
+            self.wheel.schedule(key, time.time() + delay, payload)
+            self.changed = True
+        self.counts["scheduled"] += 1
+
+    def cancel(self, key):
+        """Remove a deadline, if it is pending
+        :returns: bool, False if there was no such deadline"""
+        with self.lock:
+            cancelled = self.wheel.cancel(key)
+            self.changed = self.changed or cancelled
+        if cancelled:
+            self.counts["cancelled"] += 1
+        return cancelled
+
+    def load(self):
+        """Read the pending deadlines from disk"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as source:
+            # Bandit warns about unpickling untrusted data; this file is only ever written by us
+            entries = pickle.load(source)  # nosec
+        for key, when, payload in entries:
+            self.wheel.schedule(key, when, payload)
+        log.info("Loaded %i deadlines", len(entries))
+
+    def save(self):
+        """Write the pending deadlines to disk"""
+        with self.lock:
+            entries = self.wheel.items()
+            self.changed = False
+        self.saved = time.monotonic()
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as target:
+            pickle.dump(entries, target, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.path)
+
+    def start(self):
+        """Start the thread that fires the deadlines"""
+        if self.thread is not None:
+            return
+        self.thread = Thread(target=self.run, name="deadlines", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Body of the timer thread"""
+        while not self.stopped.wait(self.wheel.resolution):
+            self.fire(time.time())
+            if self.changed and time.monotonic() - self.saved >= self.save_interval:
+                self.save()
+
+    def fire(self, now):
+        """Invoke the handlers of the deadlines that expired by `now`"""
+        with self.lock:
+            expired = self.wheel.advance(now)
+            self.changed = self.changed or bool(expired)
+        for key, payload in expired:
+            handler = self.handlers.get(key[0])
+            if handler is None:
+                log.warning("No handler for deadline %s", key)
+                continue
+            self.counts["fired"] += 1
+            try:
+                handler(key, payload)
+            except Exception:  # pylint: disable=broad-except
+                # this runs in its own thread, nobody else would hear about it
+                log.exception("Deadline %s failed", key)
+
+    def stop(self):
+        """Stop the timer thread and save the pending deadlines"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.changed:
+            self.save()
+
+    def stats(self):
+        """Return how many deadlines are pending, and how many were scheduled, cancelled and fired so far"""
+        return {"pending": len(self.wheel), **self.counts}
+
+    def __contains__(self, key):
+        return key in self.wheel
@@ -0,0 +1,312 @@
+"""Tracing of the lifecycle of a request for assistance: from the moment the backend tells us about it, through the
+announcements, the volunteers' responses and the exit survey, until it is finalized or cancelled.
+
+Each request gets a trace when it arrives (`Tracer.open`). The work done on its behalf is a span of that trace
+(`Tracer.span`); the Telegram and backend calls made while a span is active become its children (`child`), and the
+calls to the backend carry a `traceparent` header (W3C Trace Context), so that the backend can link its own work to
+the same trace. Spans follow the work across threads only when it is handed over with `bind`, e.g. by `Sender`.
+
+The milestones of a request (`Tracer.mark`) are measured from the moment it arrived, their percentiles are returned
+by `Tracer.summary` and served by the REST API at `/traces`. The finished spans and milestones go to an optional
+`JsonlSink`, which writes them from a background thread, so that tracing doesn't slow down the handlers.
+
+Traces are kept in memory only; after a restart, the requests that were already open get a new trace, without the
+milestones that happened before."""
+
+import json
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+from queue import SimpleQueue
+from threading import Lock, Thread, local
+
+from stats import percentile_ms
+
+log = logging.getLogger("tracing")  # pylint: disable=invalid-name
+
+# The milestones of a request, in the order they usually happen
+STAGES = ("announced", "first_offer", "assigned", "done", "finished", "cancelled")
+# How many traces are kept in memory; the oldest ones are dropped first
+MAX_TRACES = 10000
+# How many durations are kept per stage or span name, for the percentiles
+SAMPLES = 512
+
+# the spans that are active in the current thread, innermost last
+_context = local()  # pylint: disable=invalid-name
+
+
+def _new_id(bits):
+    return "%0*x" % (bits // 4, random.getrandbits(bits))  # nosec, not used for security
+
+
+def _stack():
+    stack = getattr(_context, "stack", None)
+    if stack is None:
+        stack = _context.stack = []
+    return stack
+
+
+def current():
+    """Return the innermost active span of this thread, or None"""
+    stack = getattr(_context, "stack", None)
+    return stack[-1] if stack else None
+
+
+def headers():
+    """Return the headers that propagate the active span to another service, empty if there is none"""
+    span = current()
+    if span is None:
+        return {}
+    return {"traceparent": "00-%s-%s-01" % (span.trace.trace_id, span.span_id)}
+
+
+class _NoSpan:
+    """Stands for a span when there is no trace to attach it to"""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+def child(name, **attrs):
+    """Return a context manager for a span nested in the active one, or one that does nothing if there is none
+    :param name: str, e.g. `telegram.send_message`
+    :param attrs: JSON-serializable values that describe the work"""
+    parent = current()
+    if parent is None:
+        return NO_SPAN
+    return Span(parent.tracer, parent.trace, name, attrs, parent.span_id)
+
+
+def bind(func):
+    """Make `func` run inside the span that is active now, even if it is invoked from another thread"""
+    span = current()
+    if span is None:
+        return func
+
+    def run(*args, **kwargs):
+        stack = _stack()
+        stack.append(span)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+
+    return run
+
+
+class Trace:
+    """What is known about the trace of a request"""
+
+    __slots__ = ("trace_id", "request_id", "started", "stages")
+
+    def __init__(self, request_id, started=None):
+        self.trace_id = _new_id(128)
+        self.request_id = request_id
+        # time.time() when the request arrived, None if it arrived before the bot was restarted
+        self.started = started
+        # stage -> seconds since the request arrived
+        self.stages = {}
+
+
+class Span:
+    """A unit of work done for a request, it is a context manager that measures how long the work takes"""
+
+    __slots__ = ("tracer", "trace", "name", "attrs", "parent_id", "span_id", "started", "clock")
+
+    def __init__(self, tracer, trace, name, attrs, parent_id=None):
+        self.tracer = tracer
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.parent_id = parent_id
+        self.span_id = _new_id(64)
+        self.started = None
+        self.clock = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        _stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, _traceback):
+        elapsed = time.perf_counter() - self.clock
+        _stack().pop()
+        self.tracer.finish(self, elapsed, None if exc is None else repr(exc))
+        return False
+
+
+class JsonlSink:
+    """Appends the finished spans and milestones to a JSON lines file, from a background thread"""
+
+    def __init__(self, path):
+        """:param path: str, the file where the records are appended"""
+        self.path = path
+        self.queue = SimpleQueue()
+        self.target = open(path, "a", encoding="utf-8")
+        self.thread = Thread(target=self.run, name="traces", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        """Queue a record, it is written shortly"""
+        self.queue.put(record)
+
+    def run(self):
+        """Body of the background thread, it writes whatever is queued, in batches; None stops it"""
+        while True:
+            records = [self.queue.get()]
+            while not self.queue.empty():
+                records.append(self.queue.get())
+            lines = [
+                json.dumps(record, ensure_ascii=False, default=str)
+                for record in records
+                if record is not None
+            ]
+            if lines:
+                self.target.write("\n".join(lines) + "\n")
+                self.target.flush()
+            if None in records:
+                return
+
+    def close(self):
+        """Write what is left and close the file"""
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+        self.target.close()
+
+
+class Tracer:
+    """Keeps the traces of the open requests and the latency statistics of their milestones and spans"""
+
+    def __init__(self, sink=None, max_traces=MAX_TRACES):
+        """Initialize the tracer
+        :param sink: optional JsonlSink, where the finished spans and milestones are exported
+        :param max_traces: int, how many traces are kept in memory"""
+        self.sink = sink
+        self.max_traces = max_traces
+        # request_id -> Trace, oldest first
+        self.traces = OrderedDict()
+        self.lock = Lock()
+        # stage -> recent latencies since the request arrived, in seconds
+        self.stage_latency = {}
+        # span name -> recent durations, in seconds
+        self.span_durations = {}
+
+    def open(self, request_id):
+        """Start the trace of a request that just arrived; a request that is already traced keeps its trace"""
+        with self.lock:
+            trace = self.traces.get(request_id)
+            if trace is None:
+                trace = self._add(request_id, time.time())
+        return trace
+
+    def _add(self, request_id, started):
+        trace = self.traces[request_id] = Trace(request_id, started)
+        if len(self.traces) > self.max_traces:
+            self.traces.popitem(last=False)
+        return trace
+
+    def trace(self, request_id):
+        """Return the trace of a request, starting one if the request is not traced yet"""
+        with self.lock:
+            trace = self.traces.get(request_id)
+            if trace is None:
+                trace = self._add(request_id, None)
+        return trace
+
+    def span(self, request_id, name, **attrs):
+        """Return a context manager for a span of a request's trace; it is nested in the active span if that one
+        belongs to the same trace
+        :param request_id: str, or None if the work is not related to a request, in which case nothing is traced
+        :param name: str, e.g. `assign` or `callback.eta`
+        :param attrs: JSON-serializable values that describe the work"""
+        if request_id is None:
+            return NO_SPAN
+        trace = self.trace(request_id)
+        parent = current()
+        parent_id = parent.span_id if parent is not None and parent.trace is trace else None
+        return Span(self, trace, name, attrs, parent_id)
+
+    def finish(self, span, elapsed, error):
+        """Invoked when a span ends"""
+        with self.lock:
+            self.span_durations.setdefault(span.name, deque(maxlen=SAMPLES)).append(elapsed)
+        if self.sink is not None:
+            record = {
+                "kind": "span",
+                "trace_id": span.trace.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "request_id": span.trace.request_id,
+                "name": span.name,
+                "start": round(span.started, 6),
+                "duration_ms": round(elapsed * 1000, 3),
+            }
+            if span.attrs:
+                record["attrs"] = span.attrs
+            if error is not None:
+                record["error"] = error
+            self.sink.write(record)
+
+    def mark(self, request_id, stage):
+        """Record that a request reached a milestone; only the first time counts
+        :param stage: str, one of STAGES"""
+        if request_id is None:
+            return
+        now = time.time()
+        with self.lock:
+            trace = self.traces.get(request_id)
+            if trace is None or stage in trace.stages or trace.started is None:
+                return
+            elapsed = trace.stages[stage] = now - trace.started
+            self.stage_latency.setdefault(stage, deque(maxlen=SAMPLES)).append(elapsed)
+        if self.sink is not None:
+            self.sink.write(
+                {
+                    "kind": "stage",
+                    "trace_id": trace.trace_id,
+                    "request_id": request_id,
+                    "stage": stage,
+                    "elapsed_ms": round(elapsed * 1000, 3),
+                }
+            )
+
+    def close(self, request_id, stage):
+        """Record the last milestone of a request and forget its trace
+        :param stage: str, `finished` or `cancelled`"""
+        self.mark(request_id, stage)
+        with self.lock:
+            self.traces.pop(request_id, None)
+
+    def summary(self):
+        """Return the percentiles of the time it takes a request to reach each milestone, and of the duration of
+        each kind of span, in milliseconds"""
+        with self.lock:
+            stages = {stage: sorted(samples) for stage, samples in self.stage_latency.items()}
+            spans = {name: sorted(samples) for name, samples in self.span_durations.items()}
+            open_traces = len(self.traces)
+
+        def describe(samples):
+            return {
+                "count": len(samples),
+                "p50_ms": percentile_ms(samples, 0.5),
+                "p95_ms": percentile_ms(samples, 0.95),
+                "p99_ms": percentile_ms(samples, 0.99),
+            }
+
+        return {
+            "open": open_traces,
+            "stages": {stage: describe(stages[stage]) for stage in STAGES if stage in stages},
+            "spans": {name: describe(spans[name]) for name in sorted(spans)},
+        }
+
+    def stop(self):
+        if self.sink is not None:
+            self.sink.close()